@@ -3,12 +3,14 @@
 """BillTracker API calls, not meant to be visited directly by users"""
 
 from app import app, db
-from app.models import User, Bill, Legislator, Committee, LegSession
+from app.models import User, Bill, Legislator, Committee, LegSession, \
+    userbills
 from app.routeutils import BILLNO_PAT
-from app.bills import nmlegisbill, billrequests, accdb, billutils
+from app.bills import nmlegisbill, billrequests, accdb, billutils, \
+    refreshsched
 from .routeutils import set_session_by_request_values, make_new_bill
 
-from flask import session, request, jsonify
+from flask import session, request, jsonify, Response
 
 import re
 import json
@@ -98,6 +100,20 @@ def appinfo(key):
 #
 
 
+@app.route("/api/metrics/<key>")
+def metrics(key):
+    """Fetch-layer metrics (cache hits, network time and bytes per host
+       and kind of URL, parse times) in Prometheus text format.
+       These are per process, so with several WSGI processes,
+       each scrape sees whichever process answered.
+    """
+    if key != app.config["SECRET_KEY"]:
+        return "FAIL Bad key\n"
+
+    return Response(billrequests.metrics_text(),
+                    mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/api/refresh_allbills/<key>")
 def refresh_allbills(key):
     """Refresh the data needed for the allbills page for the current session
@@ -200,10 +216,19 @@ def refresh_one_bill():
 #               { "PERCENT": percent, "YEARCODE": yearcode, "KEY": key }).text
 @app.route("/api/refresh_percent_of_bills", methods=['GET', 'POST'])
 def refresh_percent_of_bills():
-    """Refresh a given percentage of the bill list
-       for a specified yearcode or year.
-       If a year is given, refresh that percentage of bills
-       within all yearcodes from that year.
+    """Refresh the bills that have changed, according to the
+       all-bills list, for a specified yearcode or year,
+       plus a given percentage (default none) of the rest.
+       A bill has changed if its action code or title in Legislation_List
+       is different from what's in the database, or it hasn't been
+       fully parsed yet. The percentage catches changes that don't
+       show up there, like scheduling.
+       Bills are taken in order of refreshsched.refresh_score(),
+       so changed bills come first, then popular, scheduled and
+       active ones; and no more than the hourly fetch budget allows.
+       The response shows each bill's score, and the budget used.
+       If a year is given, refresh bills within all yearcodes from
+       that year.
        This is necessary because a special session may be called
        before all the bills from the previous session have been signed.
        If neither yearcode nor year is specified, refresh the current year.
@@ -219,6 +244,8 @@ def refresh_percent_of_bills():
             percent = int(percent)
         except ValueError:
             return "FAIL: Don't understand '%s' PERCENT" % percent
+    else:
+        percent = 0
 
     yearcode = request.values.get('YEARCODE')
     if yearcode:
@@ -237,8 +264,15 @@ def refresh_percent_of_bills():
             if yc.startswith(year):
                 yearcode_list.append(yc)
 
+    budget = refreshsched.budget()
+
+    # How many users track each bill, by bill id
+    num_tracking = dict(db.session.query(userbills.c.bill_id,
+                                         db.func.count())
+                                  .group_by(userbills.c.bill_id).all())
+
     # Now yearcode_list is a list of session names (yearcodes)
-    retstr = "OK Refreshed %d%% of bills:" % percent
+    retstr = "OK Refreshed changed bills and %d%% of the rest:" % percent
     for yearcode in yearcode_list:
         allbills = Bill.query.filter_by(year=yearcode) \
                              .order_by(Bill.update_date).all()
@@ -246,20 +280,80 @@ def refresh_percent_of_bills():
             print("No bills in", yearcode, file=sys.stderr)
             continue
 
-        num2update = len(allbills) * percent // 100
-        if not num2update:
+        # Which bills changed, according to Legislation_List?
+        leg_session = LegSession.by_yearcode(yearcode)
+        billinfo = nmlegisbill.all_bills(leg_session.id, yearcode) \
+            if leg_session else None
+        if billinfo is not None:
+            # Every bill gets looked up: read the list once, and
+            # don't leave it cached in this process.
+            billinfo = dict(billinfo.items())
+        changed = []
+        unchanged = []
+        sweep = percent
+        if billinfo and any(not b.startswith('_') for b in billinfo):
+            for bill in allbills:
+                reason = nmlegisbill.refresh_reason(
+                    billinfo.get(bill.billno), bill.title,
+                    bill.get_actioncode() if bill.statustext else '')
+                if reason:
+                    changed.append(bill)
+                    print("Refreshing %s: %s" % (bill.billno, reason),
+                          file=sys.stderr)
+                else:
+                    unchanged.append(bill)
+        else:
+            # Without the list, there's nothing to compare with.
+            sweep = max(percent, 34)
+            print("No all-bills list for %s; refreshing the oldest %d%%"
+                  % (yearcode, sweep), file=sys.stderr)
+            unchanged = allbills
+
+        num2update = len(unchanged) * sweep // 100
+        if sweep and not num2update:
             num2update = 1
 
-        bill_list = allbills[:num2update]
-        print("Updating %d%% of bills in %s (%s bills): %s"
-              % (percent, yearcode, num2update,
+        # Take the changed bills, then the highest scoring others,
+        # as many as were asked for and the budget allows.
+        changed_ids = set(b.id for b in changed)
+        scores = {}
+        for bill in allbills:
+            scores[bill.id] = refreshsched.refresh_score(
+                bill.update_date, num_tracking=num_tracking.get(bill.id, 0),
+                scheduled=bool(bill.scheduled_in_future()),
+                location=bill.location,
+                last_action_date=bill.last_action_date,
+                changed=(bill.id in changed_ids))
+        candidates = sorted([ b for b in allbills if scores[b.id] ],
+                            key=lambda b: (b.id in changed_ids, scores[b.id]),
+                            reverse=True)
+        # Another process may be refreshing too: reserving checks
+        # and takes the budget in one step.
+        wanted = min(len(changed) + num2update, len(candidates))
+        bill_list = candidates[:budget.reserve(wanted)]
+        if len(bill_list) < wanted:
+            print("Refresh budget allows only %d of %d bills in %s"
+                  % (len(bill_list), wanted, yearcode), file=sys.stderr)
+        if not bill_list:
+            retstr += "\n%4s: Nothing to update" % yearcode
+            continue
+        print("Updating %d changed bills and %d%% of the rest in %s "
+              "(%s bills): %s"
+              % (len(changed), sweep, yearcode, len(bill_list),
                  ', '.join([b.billno for b in bill_list])),
               file=sys.stderr)
 
+        # Fetch and parse the pages all at once (parsing in other
+        # processes); the database is only updated here.
+        # Anything chosen is worth fetching again, even if it's
+        # in the cache.
+        parsed = nmlegisbill.parse_bill_pages(
+            [ b.billno for b in bill_list ], yearcode,
+            cachesecs=refreshsched.MIN_REFRESH_SECS)
+
         updated_bills = []
         failed_updates = []
-        for bill in bill_list:
-            b = nmlegisbill.parse_bill_page(bill.billno, yearcode)
+        for bill, b in zip(bill_list, parsed):
             if not b:
                 print("Failed to refresh:", bill, file=sys.stderr)
                 failed_updates.append(bill.billno)
@@ -269,12 +363,15 @@ def refresh_percent_of_bills():
             db.session.add(bill)
 
         retstr += "\n%4s: Updated %s" % (
-            yearcode, ' '.join([b.billno for b in updated_bills]))
+            yearcode, ' '.join([ "%s (%.1f)" % (b.billno, scores[b.id])
+                                 for b in updated_bills ]))
         if failed_updates:
             retstr += "\n      Failed to update: %s" % (
             ' '.join([str(b) for b in failed_updates]))
 
     db.session.commit()
+    retstr += "\nBudget: %d of %d bill fetches used this hour" \
+        % (budget.spent(), budget.per_hour)
     return retstr
 
 
@@ -945,6 +1042,34 @@ def update_tracking_lists(key, yearcode=None):
             return 'xx' + billno_key
         return billno_key
 
+    # Bills on tracking lists that aren't in the database yet will
+    # need their pages fetched and parsed. Do them all at once up front.
+    new_billnos = set()
+    for jsonfile in os.listdir(trackingdir):
+        if not jsonfile.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(trackingdir, jsonfile)) as jfp:
+                trackingdata = json.load(jfp)["tracking"]
+        except Exception:
+            # Will be reported in the main loop
+            continue
+        for topicdic in trackingdata:
+            for billdict in topicdic['bills']:
+                if not billdict.get('billno'):
+                    continue
+                billno = billutils.sanitize_billno(billdict['billno'])
+                if BILLNO_PAT.match(billno) and \
+                   not Bill.query.filter_by(billno=billno,
+                                            year=yearcode).first():
+                    new_billnos.add(billno)
+    new_bills_parsed = {}
+    if new_billnos:
+        new_billnos = sorted(new_billnos)
+        new_bills_parsed = dict(zip(new_billnos,
+                                    nmlegisbill.parse_bill_pages(new_billnos,
+                                                                 yearcode)))
+
     for jsonfile in os.listdir(trackingdir):
         if not jsonfile.endswith('.json'):
             continue
@@ -977,7 +1102,10 @@ def update_tracking_lists(key, yearcode=None):
                                             year=yearcode).first()
                 if not bill:
                     try:
-                        bill = make_new_bill(billdict['billno'], yearcode)
+                        bill = make_new_bill(
+                            billdict['billno'], yearcode,
+                            new_bills_parsed.get(billutils.sanitize_billno(
+                                billdict['billno'])))
                         print("Making a new bill", billdict['billno'],
                               "in yearcode", yearcode, file=sys.stderr)
                     except RuntimeError:
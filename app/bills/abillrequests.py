@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""
+An asyncio counterpart to billrequests: aget, ahead and
+asoup_from_cache_or_net, using the same cache files, the same
+LOCAL_MODE, and the same per-host rate limits.
+
+That lets a scraper fan out hundreds of fetches on one event loop,
+    responses = await asyncio.gather(*[ aget(url) for url in urls ])
+rather than needing a thread for each one.
+
+Uses aiohttp if it's installed. Without it, each fetch runs the
+regular billrequests.get in the event loop's default thread pool,
+which works the same, just with threads underneath.
+"""
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import asyncio
+import functools
+import os, sys
+import time
+
+from . import billrequests, standin
+from .billrequests import CustomResponse, url_to_cache_filename
+
+
+# aiohttp sessions and semaphores belong to a single event loop,
+# so keep one of each per loop.
+_loop_state = {}
+
+
+def _state():
+    """Return (session, semaphore) for the running event loop,
+       creating them if needed. session is None without aiohttp.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _loop_state:
+        semaphore = asyncio.Semaphore(billrequests.MAX_CONCURRENT_FETCHES)
+        session = None
+        if aiohttp:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=billrequests.POOL_SIZE)
+            session = aiohttp.ClientSession(connector=connector)
+        _loop_state[loop] = (session, semaphore)
+    return _loop_state[loop]
+
+
+async def aclose():
+    """Close the running loop's aiohttp session.
+       Call this before the event loop finishes.
+    """
+    loop = asyncio.get_running_loop()
+    if loop in _loop_state:
+        session, semaphore = _loop_state.pop(loop)
+        if session:
+            await session.close()
+
+
+async def _wait_for_rate_limit(url):
+    limiter = billrequests.rate_limiter(url)
+    if limiter:
+        delay = limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def _in_thread(func, *args, **kwargs):
+    """Run func, which reads or writes the cache files or index,
+       in the event loop's default thread pool, so a slow disk
+       or a locked SQLite file doesn't hold up every other fetch.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
+
+
+def _cached_or_failed(url, cachefile, cachesecs):
+    """A fresh enough cached copy of url, or a recent failure,
+       or None if it has to be fetched.
+    """
+    return billrequests.cached_response(url, cachefile, cachesecs) \
+        or billrequests.cached_failure(url, cachefile)
+
+
+def _client_timeout(kwargs):
+    """aiohttp's version of a requests timeout in kwargs,
+       defaulting to billrequests.FETCH_TIMEOUT like net_request does.
+    """
+    return aiohttp.ClientTimeout(
+        total=kwargs.pop("timeout", None) or billrequests.FETCH_TIMEOUT)
+
+
+async def _session_get(session, url, params, headers, **kwargs):
+    """One GET through the aiohttp session, read into a CustomResponse,
+       and recorded if there's a RECORD_DIR. Raises on network errors.
+    """
+    response = CustomResponse()
+    start = time.monotonic()
+    async with session.get(billrequests.standin_url(url), params=params,
+                           headers=headers, **kwargs) as netresp:
+        response.status_code = netresp.status
+        response.headers = dict(netresp.headers)
+        if netresp.status != 304:
+            response.content = await netresp.read()
+    if billrequests.RECORD_DIR and response.status_code != 304:
+        await _in_thread(standin.record_cassette, billrequests.RECORD_DIR,
+                         "GET", url, response.status_code, response.headers,
+                         response.content, time.monotonic() - start)
+    return response
+
+
+async def aget(url, params=None, **kwargs):
+    """Async version of billrequests.get: same arguments
+       (including cachefile and cachesecs), same cache files,
+       returns a CustomResponse.
+    """
+    if 'cachefile' in kwargs and kwargs["cachefile"]:
+        cachefile = kwargs['cachefile']
+    else:
+        cachefile = url_to_cache_filename(url)
+    cachesecs = kwargs.get('cachesecs', billrequests.CACHESECS)
+
+    if billrequests.LOCAL_MODE:
+        return await _in_thread(billrequests.local_response, url, cachefile)
+
+    response = await _in_thread(_cached_or_failed, url, cachefile, cachesecs)
+    if response:
+        return response
+
+    session, semaphore = _state()
+
+    if not session:
+        # No aiohttp: do it synchronously in a thread.
+        async with semaphore:
+            return await _in_thread(billrequests.get, url, params, **kwargs)
+
+    kwargs.pop("cachefile", None)
+    kwargs.pop("cachesecs", None)
+    kwargs["timeout"] = _client_timeout(kwargs)
+    plain_headers = kwargs.pop("headers", None)
+    validators, headers = await _in_thread(billrequests.conditional_headers,
+                                           cachefile, plain_headers)
+
+    # No retries here, but do respect the host's circuit breaker.
+    breaker = billrequests.circuit_breaker(url)
+    if not breaker.allow():
+        return await _in_thread(billrequests.stale_fallback, url, cachefile) \
+            or CustomResponse()
+
+    if billrequests.RECORD_DIR or billrequests.STANDIN_URL:
+        url = billrequests.full_url(url, params)
+        params = None
+    async with semaphore:
+        await _wait_for_rate_limit(url)
+        print("NETWORK aget", url, file=sys.stderr)
+        try:
+            response = await _session_get(session, url, params,
+                                          headers or None, **kwargs)
+            if response.status_code == 304 and validators:
+                breaker.success()
+                revalidated = await _in_thread(
+                    billrequests.not_modified_response,
+                    cachefile, response.headers)
+                if revalidated:
+                    return revalidated
+                # The old copy vanished since its validators were read.
+                print("Cached copy of", url, "is gone, fetching it again",
+                      file=sys.stderr)
+                await _in_thread(billrequests.forget_cache_entry, cachefile)
+                await _wait_for_rate_limit(url)
+                response = await _session_get(session, url, params,
+                                              plain_headers, **kwargs)
+        except Exception as e:
+            breaker.failure()
+            print("*** NETWORK ERROR fetching %s: %s" % (url, str(e)),
+                  file=sys.stderr)
+            return await _in_thread(billrequests.stale_fallback,
+                                    url, cachefile) or CustomResponse()
+
+    if response.status_code in billrequests.RETRY_STATUSES:
+        breaker.failure()
+    else:
+        breaker.success()
+
+    if response.status_code == 200:
+        await _in_thread(billrequests.save_to_cache, url, cachefile,
+                         response.content, response.headers)
+    else:
+        print("*** NETWORK ERROR fetching %s: status code was %d"
+              % (url, response.status_code), file=sys.stderr)
+        await _in_thread(billrequests.save_failure, url, cachefile,
+                         response.status_code)
+        if response.status_code >= 500:
+            return await _in_thread(billrequests.stale_fallback,
+                                    url, cachefile) or response
+    return response
+
+
+def _cached_head(url, cachefile, cachesecs):
+    """The part of billrequests.head() before it goes to the network:
+       a counted response from the cache, or None.
+    """
+    response = billrequests.cached_head(url, cachefile, cachesecs)
+    if response:
+        return billrequests.counted("head", url, "cache_hit", response)
+
+    if billrequests.LOCAL_MODE and not billrequests.cache_stat(cachefile):
+        response = CustomResponse()
+        response.status_code = 404
+        return billrequests.counted("head", url, "local", response)
+
+    response = billrequests.cached_failure(url, cachefile, "HEAD")
+    if response:
+        return billrequests.counted("head", url, "negative_hit", response)
+    return None
+
+
+async def ahead(url, **kwargs):
+    """Async version of billrequests.head. Like it, never raises
+       for network trouble: the status is 503 instead.
+    """
+    session, semaphore = _state()
+    if not session:
+        async with semaphore:
+            return await _in_thread(billrequests.head, url, **kwargs)
+
+    if 'cachefile' in kwargs and kwargs["cachefile"]:
+        cachefile = kwargs['cachefile']
+    else:
+        cachefile = url_to_cache_filename(url)
+    cachesecs = kwargs.get('cachesecs', billrequests.CACHESECS)
+
+    response = await _in_thread(_cached_head, url, cachefile, cachesecs)
+    if response:
+        return response
+
+    kwargs.pop("cachefile", None)
+    kwargs.pop("cachesecs", None)
+    kwargs["timeout"] = _client_timeout(kwargs)
+    response = CustomResponse()
+    response.status_code = 503
+
+    breaker = billrequests.circuit_breaker(url)
+    if not breaker.allow():
+        print("*** NETWORK ERROR on HEAD %s: circuit open" % url,
+              file=sys.stderr)
+        return billrequests.counted("head", url, "error", response)
+
+    async with semaphore:
+        await _wait_for_rate_limit(url)
+        try:
+            async with session.head(billrequests.standin_url(url),
+                                    **kwargs) as netresp:
+                response.status_code = netresp.status
+                response.headers = dict(netresp.headers)
+        except Exception as e:
+            breaker.failure()
+            print("*** NETWORK ERROR on HEAD %s: %s" % (url, str(e)),
+                  file=sys.stderr)
+            return billrequests.counted("head", url, "error", response)
+
+    if response.status_code in billrequests.RETRY_STATUSES:
+        breaker.failure()
+    else:
+        breaker.success()
+
+    await _in_thread(billrequests.save_failure, url, cachefile,
+                     response.status_code, "HEAD")
+    return billrequests.counted(
+        "head", url, "fetched" if response.status_code < 400 else "error",
+        response)
+
+
+async def asoup_from_cache_or_net(url, billdic=None,
+                                  cachesecs=billrequests.CACHESECS):
+    """Async version of billrequests.soup_from_cache_or_net.
+       Return a BS soup of the contents, or None.
+    """
+    cachefile = url_to_cache_filename(url, billdic)
+    response = await aget(url, cachefile=cachefile, cachesecs=cachesecs)
+
+    if response.status_code != 200:
+        print("No soup! Response was", response.status_code, file=sys.stderr)
+        print("  on cache %s,\n  URL %s" % (cachefile, url), file=sys.stderr)
+        return None
+
+    return billrequests.parsed_soup(cachefile, response)
@@ -15,20 +15,19 @@
 import subprocess
 from datetime import datetime
 from dateutil.parser import parse as parsedate
-import requests
 import time
 import re
 import zipfile
 import json
-from io import BytesIO
 import os
 import sys
+import traceback
 
 from app import db
 from app.models import Bill
 
-# The main accdb file is downloaded with the regular requests module,
-# but billrequests is used for things like the cachedir
+# billrequests is used for the cachedir, and to download
+# the accdb zip file (uncached, streamed to disk)
 from app.bills import billrequests
 
 # How long is too long to wait for a lock file while downloading the accdb?
@@ -164,20 +163,20 @@ def fetch_accdb_if_needed(yearcode, localdir):
     jsoncache = os.path.join(localdir, accjsonname)
     localdbfile = os.path.join(localdir, "LegInfo%s.accdb" % yearcode)
 
-    print("In fetch_accdb_if_needed:", file=sys.stderr)
-    os.system("ls -l %s %s" % (jsoncache, localdbfile))
-    try:
-        jsonfiletime = datetime.fromtimestamp(
-            os.stat(jsoncache).st_mtime).astimezone()
-    except Exception as e:
+    print("In fetch_accdb_if_needed:", jsoncache, localdbfile,
+          file=sys.stderr)
+    filestat = billrequests.cache_stat(jsoncache)
+    if filestat:
+        jsonfiletime = datetime.fromtimestamp(filestat[0]).astimezone()
+    else:
         jsonfiletime = None
-        print("Couldn't get JSON file time", e)
-    try:
-        dbfiletime = datetime.fromtimestamp(
-            os.stat(localdbfile).st_mtime).astimezone()
-    except Exception as e:
+        print("Couldn't get JSON file time", file=sys.stderr)
+    filestat = billrequests.cache_stat(localdbfile)
+    if filestat:
+        dbfiletime = datetime.fromtimestamp(filestat[0]).astimezone()
+    else:
         dbfiletime = None
-        print("Couldn't get accdb file time", e)
+        print("Couldn't get accdb file time", file=sys.stderr)
 
     if billrequests.LOCAL_MODE:
         # Does the JSON file exist, and is it newer than the accdb file?
@@ -238,9 +237,17 @@ def fetch_accdb_if_needed(yearcode, localdir):
                 break
 
     print("Fetching", url, "last mod date", urltime, file=sys.stderr)
+    # The zip file can be big, so stream it to disk rather than
+    # holding it in memory, and unzip it from there.
+    zipfilename = localdbfile + ".zip"
+    accdbname = None
+    newfile = localdbfile + ".new"
     try:
-        r = requests.get(url)
-        with zipfile.ZipFile(BytesIO(r.content)) as zip:
+        r = billrequests.download(url, zipfilename)
+        if r.status_code != 200:
+            raise RuntimeError("Status %d downloading %s"
+                               % (r.status_code, url))
+        with zipfile.ZipFile(zipfilename) as zip:
             names = zip.namelist()
             if len(names) > 1:
                 print("Too many names in zip archive:", ' '.join(names),
@@ -251,11 +258,10 @@ def fetch_accdb_if_needed(yearcode, localdir):
                     base, ext = os.path.splitext(accdbname)
                     break
             if not accdbname:
-                os.unlink(lockfile)
-                raise RuntimeError("No zipfile in %s" % url)
+                # The lockfile is removed in the except clause
+                raise RuntimeError("No accdb file in %s" % url)
 
             # Rename accdbname to the new file path
-            newfile = localdbfile + ".new"
             zip.getinfo(accdbname).filename = newfile
             # then extract it
             zip.extract(accdbname)
@@ -269,6 +275,12 @@ def fetch_accdb_if_needed(yearcode, localdir):
         os.unlink(lockfile)
         return
 
+    finally:
+        try:
+            os.unlink(zipfilename)
+        except OSError:
+            pass
+
     os.unlink(lockfile)
 
     # Now the localdbfile is presumed to exist
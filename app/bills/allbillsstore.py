@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+A store for the all-bills lists (g_allbills in nmlegisbill) that
+every web server process shares, so each process doesn't have to
+json.load the whole allbills_<yearcode>.json file into memory
+whenever it changes.
+
+Each entry in a session's list (each bill, plus the "_" entries
+like _sessionid and _rowhashes) is a row in a SQLite file, read only
+when it's asked for. Each session also has a generation number that
+goes up every time its list is replaced, so a reader can tell with
+one small query whether anything it has cached is out of date.
+
+update_allbills() still builds the whole list in memory, in the one
+process holding the lock, and publishes it here with replace().
+"""
+
+from collections import OrderedDict
+from collections.abc import Mapping
+import json
+import sqlite3
+import threading
+import time
+
+
+# How many decoded bills a StoredAllBills keeps, most recently used
+MAX_CACHED_BILLS = 256
+
+
+class AllBillsStore:
+    """All-bills lists kept in the SQLite file dbfile.
+       Like CacheIndex, safe to share between threads and processes.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.local = threading.local()
+        db = self._db()
+        db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                          yearcode TEXT,
+                          key TEXT,
+                          value TEXT,
+                          PRIMARY KEY (yearcode, key))""")
+        db.execute("""CREATE TABLE IF NOT EXISTS generations (
+                          yearcode TEXT PRIMARY KEY,
+                          generation INTEGER,
+                          replaced_at REAL)""")
+
+    def _db(self):
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.dbfile, timeout=10,
+                                            isolation_level=None)
+            self.local.db.execute("PRAGMA journal_mode=WAL")
+            self.local.db.execute("PRAGMA synchronous=NORMAL")
+        return self.local.db
+
+    def generation(self, yearcode):
+        """How many times yearcode's list has been replaced; 0 for never."""
+        return self.state(yearcode)[0]
+
+    def state(self, yearcode):
+        """(generation, time it was last replaced) for yearcode's list,
+           (0, 0) if it never has been.
+        """
+        row = self._db().execute("SELECT generation, replaced_at"
+                                 " FROM generations WHERE yearcode = ?",
+                                 (yearcode,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def get(self, yearcode, key):
+        """One entry (e.g. a billno) in yearcode's list, or None."""
+        row = self._db().execute("SELECT value FROM entries"
+                                 " WHERE yearcode = ? AND key = ?",
+                                 (yearcode, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def keys(self, yearcode):
+        return [ row[0] for row in
+                 self._db().execute("SELECT key FROM entries"
+                                    " WHERE yearcode = ? ORDER BY rowid",
+                                    (yearcode,)) ]
+
+    def items(self, yearcode):
+        """Yield (key, value) for everything in yearcode's list,
+           in the order it was stored.
+        """
+        for key, value in self._db().execute(
+                "SELECT key, value FROM entries WHERE yearcode = ?"
+                " ORDER BY rowid", (yearcode,)):
+            yield key, json.loads(value)
+
+    def load(self, yearcode):
+        """yearcode's whole list as a dict, for updating."""
+        return dict(self.items(yearcode))
+
+    def read_all(self, yearcode):
+        """((generation, replaced_at), [ (key, value), ... ]) for
+           yearcode's list, read in one transaction so the entries
+           are all from that generation.
+        """
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            state = self.state(yearcode)
+            items = list(self.items(yearcode))
+        finally:
+            db.execute("COMMIT")
+        return state, items
+
+    def replace(self, yearcode, allbills):
+        """Make the dict allbills yearcode's list, in one transaction,
+           and return the new generation.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM entries WHERE yearcode = ?", (yearcode,))
+            db.executemany("INSERT INTO entries VALUES (?, ?, ?)",
+                           [ (yearcode, key, json.dumps(value))
+                             for key, value in allbills.items() ])
+            generation = self.generation(yearcode) + 1
+            db.execute("INSERT OR REPLACE INTO generations VALUES (?, ?, ?)",
+                       (yearcode, generation, time.time()))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return generation
+
+
+class _Snapshot:
+    """What a StoredAllBills knows about one generation of its list.
+       A new one replaces it when the generation changes, so readers
+       holding the old one never see it half reset.
+    """
+
+    def __init__(self, generation, replaced_at):
+        self.generation = generation
+        self.replaced_at = replaced_at
+        self.keys = None        # (list, set), read when first needed
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+
+class StoredAllBills(Mapping):
+    """A read-only dict-like view of one session's list in an
+       AllBillsStore, which is what all_bills() returns when there's
+       a store. It's shared by all threads. Entries are read as
+       they're asked for, and the last MAX_CACHED_BILLS are kept until
+       refresh() sees a new generation. items() and values() read
+       everything in one transaction without keeping it.
+    """
+
+    def __init__(self, store, yearcode):
+        self.store = store
+        self.yearcode = yearcode
+        self._snapshot = _Snapshot(None, 0)
+        self.refresh()
+
+    @property
+    def generation(self):
+        return self._snapshot.generation
+
+    @property
+    def replaced_at(self):
+        """When the list was last replaced, as of the last refresh()."""
+        return self._snapshot.replaced_at
+
+    def refresh(self):
+        """Forget what's been read if the list has been replaced since.
+           Return the current generation.
+        """
+        return self._move_to(self.store.state(self.yearcode))
+
+    def _move_to(self, state):
+        generation, replaced_at = state
+        if generation != self._snapshot.generation:
+            self._snapshot = _Snapshot(generation, replaced_at)
+        return generation
+
+    def _keys(self, snapshot):
+        keys = snapshot.keys
+        if keys is None:
+            keylist = self.store.keys(self.yearcode)
+            keys = snapshot.keys = (keylist, set(keylist))
+        return keys
+
+    def __getitem__(self, key):
+        snapshot = self._snapshot
+        with snapshot.lock:
+            if key in snapshot.cache:
+                snapshot.cache.move_to_end(key)
+                return snapshot.cache[key]
+        value = self.store.get(self.yearcode, key)
+        if value is None:
+            raise KeyError(key)
+        with snapshot.lock:
+            snapshot.cache[key] = value
+            if len(snapshot.cache) > MAX_CACHED_BILLS:
+                snapshot.cache.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        return key in self._keys(self._snapshot)[1]
+
+    def __iter__(self):
+        return iter(self._keys(self._snapshot)[0])
+
+    def __len__(self):
+        return len(self._keys(self._snapshot)[0])
+
+    def items(self):
+        """Everything in the list, all from the newest generation,
+           which the view then moves to, so it agrees with keys()
+           and lookups made afterward.
+        """
+        state, items = self.store.read_all(self.yearcode)
+        self._move_to(state)
+        return items
+
+    def values(self):
+        return [ value for key, value in self.items() ]
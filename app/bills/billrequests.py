@@ -22,13 +22,34 @@ import re
 from bs4 import BeautifulSoup
 import json
 import os, sys
+import sqlite3
 import time
+import random
+import hashlib
+import shutil
+from datetime import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from contextlib import contextmanager
 import dateutil.parser
 import traceback
 
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 from ftplib import FTP, error_perm
 
+# fcntl is only for coordinating fetches between processes,
+# and doesn't exist on Windows.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import cachestore
+from .cacheindex import CacheIndex
+from . import standin
+from .fetchmetrics import METRICS
+
 
 #
 # Some globals
@@ -48,7 +69,89 @@ LOCAL_MODE = False
 # Verbose debugging
 DEBUG = False
 
-hrefpat = re.compile('href="([^"]*)">([^<]+)<', flags=re.IGNORECASE)
+# Cache files go in subdirectories of CACHEDIR by session and by a hash
+# of the name, e.g. cache/25/3f/2025-HB123.html, rather than all in
+# CACHEDIR. Files from the old flat layout are still found, and
+#   python3 -m app.bills.billrequests migrate [cachedir]
+# moves them. Set to False for the flat layout.
+SHARDED_CACHE = True
+
+# How cache files are stored: an object from cachestore.
+# None means plain files (cachestore.FlatFileStore).
+CACHE_STORE = None
+
+# Roughly how much memory (bytes) parsed soups may hold onto,
+# in each process. A soup takes around SOUP_SIZE_FACTOR times the
+# size of its HTML. It's meant for pages that are parsed over and
+# over, like Legislation_List and the session listings; bill pages
+# are parsed once per fetch (then parsememo has them), so they
+# don't go through it. 0 disables the soup cache.
+SOUP_CACHE_BYTES = 24 * 1024 * 1024
+SOUP_SIZE_FACTOR = 10
+
+# Name of the SQLite index of cached files, kept in CACHEDIR.
+# None means no index: freshness comes from stat-ing the files.
+CACHE_INDEX_NAME = "cacheindex.sqlite"
+
+# For benchmarking (see standin.py): if RECORD_DIR is set, save every
+# network response there as a cassette. If STANDIN_URL is set, like
+# "http://127.0.0.1:8642", send every request to that stand-in server
+# instead of the real host.
+RECORD_DIR = None
+STANDIN_URL = None
+
+# Network timeout (secs) for each attempt, unless the caller passes one
+FETCH_TIMEOUT = 30
+
+# How many times to retry a fetch that times out, can't connect,
+# or gets one of RETRY_STATUSES, and the backoff between tries:
+# RETRY_BACKOFF secs, doubling each time up to RETRY_BACKOFF_MAX,
+# with random jitter so retries from many threads don't line up.
+FETCH_RETRIES = 2
+RETRY_BACKOFF = 1.
+RETRY_BACKOFF_MAX = 10.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Circuit breaker: after BREAKER_FAILURES failures in a row from
+# a host, stop trying it for BREAKER_RESET_SECS, failing fast
+# (or serving stale cache files) instead. After that, one request
+# is let through to see if the host is back.
+BREAKER_FAILURES = 5
+BREAKER_RESET_SECS = 60
+
+# How long (secs) to remember that a URL wasn't there (4xx),
+# or that the server had an error (5xx), before asking again.
+NEGATIVE_CACHESECS = 15*60
+ERROR_CACHESECS = 60
+
+# With stale_ok, how far past its cachesecs (secs) a cached page
+# can be and still be returned while it's refreshed in the background.
+MAX_STALE = 24*60*60
+
+# How many background refreshes for stale_ok can run at once
+REFRESH_WORKERS = 2
+
+# When another process is already fetching a URL, how long (secs)
+# to wait for it before giving up and fetching it anyway.
+# None for as long as that fetch could take, retries and all
+# (see max_fetch_secs()), so a slow fetch isn't duplicated.
+FETCH_LOCK_TIMEOUT = None
+
+# Maximum number of keep-alive connections kept open per host.
+# Set before the first fetch; after that, call close_session() to resize.
+POOL_SIZE = 10
+
+# How many fetches get_many() and soup_many() run at once
+MAX_CONCURRENT_FETCHES = 8
+
+# How fast we're willing to hit each host:
+# (requests per second, burst size). Hosts not listed aren't limited.
+# A leading "www." is ignored, so nmlegis.gov and www.nmlegis.gov
+# share one limit.
+HOST_RATE_LIMITS = {
+    "nmlegis.gov": (4, 8),
+    "nmlegis.edsantiago.com": (2, 4),
+}
 
 
 # requests.Response doesn't allow setting the text member,
@@ -58,6 +161,9 @@ class CustomResponse:
         self.status_code = 404
         self.content = None    # bytes
         self.headers = {}
+        # True if this is an old copy from the cache, served because
+        # of stale_ok or because the server failed
+        self.stale = False
 
     # self.text (a string) is a property generated from self.content
     def get_text(self):
@@ -74,6 +180,312 @@ class CustomResponse:
         return json.loads(self.text)
 
 
+_flat_file_store = cachestore.FlatFileStore()
+
+
+def cache_store():
+    """The store that cache files are read from and written to."""
+    if CACHE_STORE is None:
+        return _flat_file_store
+    # Whatever the store evicts should leave the index too.
+    if getattr(CACHE_STORE, "on_evict", False) is None:
+        CACHE_STORE.on_evict = forget_cache_entry
+    return CACHE_STORE
+
+
+# dbfile: CacheIndex, or None if it couldn't be opened
+_cache_indexes = {}
+_cache_indexes_lock = threading.Lock()
+
+
+def cache_index():
+    """The CacheIndex for the current CACHEDIR, or None if there isn't one.
+       LOCAL_MODE doesn't care how fresh anything is, so it uses no index.
+    """
+    if not CACHE_INDEX_NAME or LOCAL_MODE:
+        return None
+    dbfile = os.path.join(CACHEDIR, CACHE_INDEX_NAME)
+    with _cache_indexes_lock:
+        if dbfile not in _cache_indexes:
+            try:
+                _cache_indexes[dbfile] = CacheIndex(dbfile)
+            except sqlite3.Error as e:
+                print("Couldn't open cache index", dbfile, ":", e,
+                      file=sys.stderr)
+                _cache_indexes[dbfile] = None
+        return _cache_indexes[dbfile]
+
+
+def cache_stat(cachefile):
+    """Return (fetched time, size) for a cache file,
+       or None if it isn't cached.
+       Use this rather than os.stat on anything written by get():
+       it's one lookup in the cache index, and the store may keep
+       the file under a different name.
+    """
+    index = cache_index()
+    if index:
+        entry = index.lookup(cachefile)
+        if entry:
+            return entry["fetched_at"], entry["size"]
+    return cache_store().stat(cachefile)
+
+
+def forget_cache_entry(cachefile):
+    """The index has an entry for cachefile but the store doesn't have
+       the file (evicted, or removed by hand). Drop the entry.
+    """
+    index = cache_index()
+    if index:
+        index.forget(cachefile)
+
+
+#
+# Connection pooling and rate limiting.
+# Every network fetch goes through one shared requests.Session,
+# so fetching a few hundred bill pages reuses a handful of
+# keep-alive connections instead of doing a TCP+TLS handshake for each,
+# and through a per-host token bucket so we don't get blocked.
+#
+
+class RateLimiter:
+    """A thread-safe token bucket: allows rate requests per second
+       on average, and up to burst requests back to back.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returning how many seconds the caller
+           must wait before using it (0 if one is available now).
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def wait(self):
+        """Block until a request is allowed."""
+        delay = self.reserve()
+        if delay > 0:
+            if DEBUG:
+                print("Rate limit: sleeping %.2f sec" % delay, file=sys.stderr)
+            time.sleep(delay)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """A host has been failing, so a request wasn't even tried."""
+    pass
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures from one host.
+       Thread-safe; one per host, from circuit_breaker(url).
+    """
+    def __init__(self, host, max_failures, reset_secs):
+        self.host = host
+        self.max_failures = max_failures
+        self.reset_secs = reset_secs
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Should a request to this host be tried now?"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_secs:
+                return False
+            # Half open: let this one request through,
+            # and keep failing fast for everyone else meanwhile.
+            self.opened_at = time.monotonic()
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print("Circuit breaker closed: %s is back" % self.host,
+                      file=sys.stderr)
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                if self.opened_at is None:
+                    print("*** Circuit breaker open: %s failed %d times"
+                          % (self.host, self.failures), file=sys.stderr)
+                self.opened_at = time.monotonic()
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None
+
+
+_rate_limiters = {}
+_circuit_breakers = {}
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def rate_limiter(url):
+    """Return the RateLimiter for url's host, or None if it isn't limited.
+    """
+    host = urlparse(url).hostname or ''
+    if host.startswith("www."):
+        host = host[4:]
+    if host not in HOST_RATE_LIMITS:
+        return None
+    with _session_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(*HOST_RATE_LIMITS[host])
+        return _rate_limiters[host]
+
+
+def circuit_breaker(url):
+    """Return the CircuitBreaker for url's host."""
+    host = urlparse(url).hostname or ''
+    if host.startswith("www."):
+        host = host[4:]
+    with _session_lock:
+        if host not in _circuit_breakers:
+            _circuit_breakers[host] = CircuitBreaker(host, BREAKER_FAILURES,
+                                                     BREAKER_RESET_SECS)
+        return _circuit_breakers[host]
+
+
+def http_session():
+    """Return the shared, pooled requests.Session, creating it if needed.
+       Each process gets its own: a pool inherited across a fork
+       (as when WSGI forks workers) would share sockets with the parent.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def close_session():
+    """Close the pooled connections. The next fetch will open a new pool,
+       using the current POOL_SIZE.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
+
+
+def net_request(method, url, **kwargs):
+    """A request through the shared session, after waiting for
+       the host's rate limit, retrying with backoff on timeouts,
+       connection errors and RETRY_STATUSES. No caching.
+       Raises CircuitOpenError without trying if the host's
+       circuit breaker is open.
+    """
+    kwargs.setdefault("timeout", FETCH_TIMEOUT)
+    breaker = circuit_breaker(url)
+    limiter = rate_limiter(url)
+    if RECORD_DIR or STANDIN_URL:
+        # Cassettes are keyed by the whole URL, query string and all
+        url = full_url(url, kwargs.pop("params", None))
+    sendurl = standin_url(url)
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError("%s has been failing, not trying %s"
+                                   % (breaker.host, url))
+        if limiter:
+            limiter.wait()
+        try:
+            start = time.monotonic()
+            response = http_session().request(method, sendurl, **kwargs)
+            count_network(method, url, response, time.monotonic() - start,
+                          not kwargs.get("stream"))
+            if RECORD_DIR and not kwargs.get("stream"):
+                standin.record_cassette(RECORD_DIR, method, url,
+                                        response.status_code,
+                                        response.headers, response.content,
+                                        response.elapsed.total_seconds())
+            if response.status_code not in RETRY_STATUSES:
+                breaker.success()
+                return response
+            breaker.failure()
+            if attempt >= FETCH_RETRIES:
+                return response
+            why = "status %d" % response.status_code
+            # Give the connection back to the pool (matters with stream)
+            response.close()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            METRICS.inc("billtracker_network_errors_total",
+                        url_labels(url, method=method,
+                                   error=type(e).__name__))
+            breaker.failure()
+            if attempt >= FETCH_RETRIES:
+                raise
+            why = str(e)
+
+        delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2**attempt) \
+            * random.uniform(.5, 1)
+        print("Retrying %s in %.1f secs (%s)" % (url, delay, why),
+              file=sys.stderr)
+        time.sleep(delay)
+        attempt += 1
+
+
+def full_url(url, params=None):
+    """url with params added to its query string."""
+    if not params:
+        return url
+    req = requests.models.PreparedRequest()
+    req.prepare_url(url, params)
+    return req.url
+
+
+def standin_url(url):
+    """Where to actually send a request for url: url itself,
+       or with STANDIN_URL, the stand-in server.
+       (url should already include any params.)
+    """
+    if not STANDIN_URL:
+        return url
+    return "%s/%s" % (STANDIN_URL, quote(url, safe=''))
+
+
+def net_get(url, params=None, **kwargs):
+    """requests.get through the shared session: rate limited,
+       retried and circuit broken as in net_request. No caching.
+    """
+    return net_request("GET", url, params=params, **kwargs)
+
+
+def net_head(url, **kwargs):
+    """requests.head through the shared session, as in net_request.
+       No caching.
+    """
+    kwargs.setdefault("allow_redirects", False)
+    return net_request("HEAD", url, **kwargs)
+
+
 #
 # Override the three important requests module functions
 # to consult the cache.
@@ -87,6 +499,15 @@ def get(url, params=None, **kwargs):
                     otherwise it will be calculated.
          cachesecs: how old a file can be before being replaced,
                     default: CACHESECS
+         stale_ok:  if the cache file is too old, but by no more than
+                    MAX_STALE, return it anyway, and refresh it
+                    in the background. For pages a user is waiting on.
+       When an old cache file is replaced, the request is conditional
+       on the ETag/Last-Modified saved from the previous fetch,
+       so an unchanged page costs only a 304.
+       If other threads or processes ask for the same page while it's
+       being fetched, they wait for that fetch rather than starting
+       their own.
     """
     if DEBUG:
         if LOCAL_MODE:
@@ -106,54 +527,17 @@ def get(url, params=None, **kwargs):
     else:
         cachesecs = CACHESECS
 
-    # The response that will be returned
-    response = CustomResponse()
+    stale_ok = kwargs.pop("stale_ok", False)
 
     if LOCAL_MODE:
-        if os.path.exists(cachefile):
-            if DEBUG:
-                print("LOCAL_MODE: Fetching from cachefile:", cachefile)
-            with open(cachefile, 'rb') as fp:
-                response.content = fp.read()
-                response.status_code = 200
-                return response
-            print("Eek, cachefile existed but didn't return?")
-        # Cache file doesn't exist, but it's local mode so
-        # can't use the net.
-        if DEBUG:
-            print("*** billrequests.get(): LOCAL_MODE, but "
-                  "cachefile %s doesn't exist" % cachefile)
-            print("  for URL", url)
-        response.status_code = 404
-        response.content = b''
-        return response
+        return counted("get", url, "local", local_response(url, cachefile))
 
     if DEBUG:
         print("**** billrequests.get: NOT LOCAL MODE")
 
-    if os.path.exists(cachefile):
-        filestat = os.stat(cachefile)
-        if (time.time() - filestat.st_mtime) < cachesecs or cachesecs < 0:
-            if DEBUG:
-                print("Already cached:", url, '->', cachefile, file=sys.stderr)
-            with open(cachefile, 'rb') as fp:
-                try:
-                    response.content = fp.read()
-                    response.status_code = 200
-                    response.headers['Last-Modified'] = \
-                        time.strftime('%a, %d %b %Y %X %Z',
-                                      time.localtime(filestat.st_mtime))
-                    return response
-                except UnicodeDecodeError as e:
-                    # This is most likely to happen due to apache2
-                    # defaulting to ascii. See note in README.
-                    print("UnicodeDecodeError", e, file=sys.stderr)
-                    print("url was", url, file=sys.stderr)
-                    print("Was reading cachefile", cachefile, file=sys.stderr)
-                    print("preferred encoding is",
-                          locale.getpreferredencoding(), file=sys.stderr)
-                    print("system encoding is",
-                          sys.getfilesystemencoding(), file=sys.stderr)
+    response = cached_response(url, cachefile, cachesecs)
+    if response:
+        return counted("get", url, "cache_hit", response)
 
     # The cachefile doesn't exist or was too old. Fetch from the net
     # and write to the cachefile.
@@ -162,22 +546,623 @@ def get(url, params=None, **kwargs):
         del kwargs["cachefile"]
     if "cachesecs" in kwargs:
         del kwargs["cachesecs"]
-    print("NETWORK get", url, file=sys.stderr)
-    try:
-        response = requests.get(url, params, **kwargs)
-        if response.status_code == 200:
-            # encoding is supposed to default to utf-8, but sometimes
-            # it defaults to ascii despite all reason. If so, add
-            # encoding='utf-8' to this open.
-            with open(cachefile, "wb") as cachefp:
-                cachefp.write(response.content)
-        else:
-            print("*** NETWORK ERROR fetching %s: status code was %d"
+
+    # A stale copy now beats a fresh one after a wait on the network.
+    if stale_ok and cachesecs >= 0:
+        response = cached_response(url, cachefile, cachesecs + MAX_STALE)
+        if response:
+            response.stale = True
+            refresh_in_background(url, params, cachefile, cachesecs,
+                                  **kwargs)
+            return counted("get", url, "stale", response)
+
+    # Did it fail recently? Then don't ask again yet.
+    response = cached_failure(url, cachefile)
+    if response:
+        if response.status_code >= 500:
+            return counted("get", url, "negative_hit",
+                           stale_fallback(url, cachefile) or response)
+        return counted("get", url, "negative_hit", response)
+
+    # If another thread is already fetching this, share its response.
+    return single_flight(cachefile,
+                         lambda: fetch_to_cache(url, params, cachefile,
+                                                cachesecs, **kwargs))
+
+
+def fetch_to_cache(url, params, cachefile, cachesecs, **kwargs):
+    """The network part of get(): fetch url and save it to cachefile.
+       If another process is fetching the same cachefile,
+       wait for it and use what it fetched.
+    """
+    with fetch_lock(cachefile):
+        # Maybe another process fetched it while we waited for the lock.
+        response = cached_response(url, cachefile, cachesecs)
+        if response:
+            return counted("get", url, "cache_hit", response)
+
+        # If there's an old copy, ask the server to send the page
+        # only if it has changed since then.
+        plain_headers = kwargs.get("headers")
+        validators, kwargs["headers"] = conditional_headers(
+            cachefile, plain_headers)
+
+        # The response that will be returned if the fetch fails
+        response = CustomResponse()
+
+        print("NETWORK get", url, file=sys.stderr)
+        try:
+            netresponse = net_get(url, params, **kwargs)
+            if netresponse.status_code == 304 and validators:
+                if DEBUG:
+                    print("Not modified:", url, file=sys.stderr)
+                revalidated = not_modified_response(cachefile,
+                                                    netresponse.headers)
+                if revalidated:
+                    return counted("get", url, "revalidated", revalidated)
+                # The old copy vanished since its validators were read.
+                print("Cached copy of", url, "is gone, fetching it again",
+                      file=sys.stderr)
+                forget_cache_entry(cachefile)
+                kwargs["headers"] = plain_headers
+                netresponse = net_get(url, params, **kwargs)
+
+            response = netresponse
+            if response.status_code == 200:
+                save_to_cache(url, cachefile, response.content,
+                              response.headers)
+            else:
+                print("*** NETWORK ERROR fetching %s: status code was %d"
+                      % (url, response.status_code), file=sys.stderr)
+                save_failure(url, cachefile, response.status_code)
+                if response.status_code >= 500:
+                    return counted("get", url, "error",
+                                   stale_fallback(url, cachefile) or response)
+                return counted("get", url, "error", response)
+        except Exception as e:
+            print("*** NETWORK ERROR fetching %s: %s" % (url, str(e)),
+                  file=sys.stderr)
+            return counted("get", url, "error",
+                           stale_fallback(url, cachefile) or response)
+
+    return counted("get", url, "fetched", response)
+
+
+# How much of a streamed download to hold in memory at once
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def download(url, outfile, **kwargs):
+    """Fetch url straight to outfile, a chunk at a time, so even a
+       huge file never has to fit in memory. Like net_get (rate limited,
+       retried, circuit broken) but doesn't use the cache.
+       outfile is written to a temp file, synced and renamed into place,
+       and is left alone if the fetch fails.
+       Returns the response; its headers and status_code are usable,
+       its content is not.
+    """
+    print("NETWORK download", url, "->", outfile, file=sys.stderr)
+    response = net_get(url, stream=True, **kwargs)
+    with response:
+        if response.status_code != 200:
+            print("*** NETWORK ERROR downloading %s: status code was %d"
                   % (url, response.status_code), file=sys.stderr)
-    except Exception as e:
-        print("*** NETWORK ERROR fetching %s: %s" % (url, str(e)),
+            return response
+        cachestore.write_atomically(
+            outfile, response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+            fsync=True)
+
+    if RECORD_DIR:
+        with open(outfile, "rb") as fp:
+            standin.record_cassette(RECORD_DIR, "GET", url,
+                                    response.status_code, response.headers,
+                                    fp.read(),
+                                    response.elapsed.total_seconds())
+    return response
+
+
+def stale_fallback(url, cachefile):
+    """The server is down or broken: return the cached copy
+       of url however old it is, or None if there isn't one.
+    """
+    response = cached_response(url, cachefile, -1)
+    if response:
+        print("Serving stale", cachefile, "since", url, "failed",
               file=sys.stderr)
+        response.stale = True
+    return response
 
+
+#
+# Metrics: see fetchmetrics.py, and /api/metrics.
+#
+
+def url_class(url):
+    """A rough category for a URL, for metrics: bill, billlist,
+       committee, dirlist, json, document or other.
+    """
+    if bill_url_pat.match(url):
+        return "bill"
+    parsed = urlparse(url)
+    path = parsed.path.lower()
+    if path.endswith(".json"):
+        return "json"
+    if "legislation_list" in path:
+        return "billlist"
+    if "committee" in path or "committee" in parsed.query.lower():
+        return "committee"
+    lastpart = path.rstrip('/').rsplit('/', 1)[-1]
+    if "/sessions/" in path and '.' not in lastpart:
+        return "dirlist"
+    if '.' in lastpart:
+        return "document"
+    return "other"
+
+
+def url_labels(url, **extra):
+    host = urlparse(url).hostname or ''
+    if host.startswith("www."):
+        host = host[4:]
+    labels = { "host": host, "urlclass": url_class(url) }
+    labels.update(extra)
+    return labels
+
+
+def counted(call, url, outcome, response):
+    """Count how a get() or head() of url was answered,
+       and return the response.
+    """
+    METRICS.inc("billtracker_%s_total" % call,
+                url_labels(url, outcome=outcome))
+    return response
+
+
+def count_network(method, url, response, elapsed, has_body):
+    labels = url_labels(url, method=method)
+    METRICS.observe("billtracker_network_seconds", labels, elapsed)
+    METRICS.inc("billtracker_network_requests_total",
+                url_labels(url, method=method,
+                           status=response.status_code))
+    if has_body and response.content:
+        METRICS.inc("billtracker_network_bytes_total", labels,
+                    len(response.content))
+
+
+def metrics_text():
+    """All the fetch metrics, in Prometheus text format."""
+    soupstats = soup_cache_stats()
+    negstats = negative_cache_stats()
+    with _session_lock:
+        breakers = list(_circuit_breakers.values())
+    gauges = {
+        "billtracker_soup_cache": (
+            "Parsed soup cache counts",
+            { (("stat", stat),): value
+              for stat, value in soupstats.items() }),
+        "billtracker_negative_cache": (
+            "Negative cache counts",
+            { (("stat", stat),): value
+              for stat, value in negstats.items() }),
+        "billtracker_circuit_open": (
+            "1 if the host's circuit breaker is open",
+            { (("host", b.host),): int(b.is_open()) for b in breakers }),
+    }
+    return METRICS.prometheus_text(gauges)
+
+
+#
+# Negative caching: remember for a little while that a URL failed,
+# so pages that don't exist aren't requested over and over.
+#
+
+_negative_cache_stats = { "hits": 0, "saved": 0 }
+
+
+def negative_cachesecs(status):
+    """How long to remember a failure with this HTTP status."""
+    if status >= 500:
+        return ERROR_CACHESECS
+    return NEGATIVE_CACHESECS
+
+
+def cached_failure(url, cachefile, method="GET"):
+    """If fetching url with method failed recently enough to be
+       remembered, return a response with the same status, otherwise None.
+       A failed GET answers for a HEAD too, but a failed HEAD
+       doesn't stop a GET: some servers refuse HEAD for pages they serve.
+    """
+    index = cache_index()
+    if not index:
+        return None
+    for m in ((method, "GET") if method != "GET" else ("GET",)):
+        failure = index.lookup_failure(cachefile, m)
+        if failure and time.time() - failure["fetched_at"] < \
+           negative_cachesecs(failure["status"]):
+            break
+    else:
+        return None
+
+    if DEBUG:
+        print("Recently failed with %d: %s" % (failure["status"], url),
+              file=sys.stderr)
+    _negative_cache_stats["hits"] += 1
+    response = CustomResponse()
+    response.status_code = failure["status"]
+    response.content = b''
+    return response
+
+
+def save_failure(url, cachefile, status, method="GET"):
+    """Remember that fetching url with method failed
+       with an HTTP error status.
+    """
+    if status < 400:
+        return
+    index = cache_index()
+    if index:
+        index.record_failure(cachefile, url, status, method=method)
+        _negative_cache_stats["saved"] += 1
+
+
+def negative_cache_stats():
+    """Return a dict of how many failures were saved,
+       and how many requests were answered from them.
+    """
+    return dict(_negative_cache_stats)
+
+
+#
+# Background refreshes, for stale_ok.
+#
+
+_refresh_executor = None
+_refresh_pid = None
+_refreshing = set()     # cachefiles queued or being refreshed
+_refresh_lock = threading.Lock()
+
+
+def refresh_in_background(url, params, cachefile, cachesecs, **kwargs):
+    """Queue a get() of url to refresh cachefile,
+       unless it's already queued.
+    """
+    global _refresh_executor, _refresh_pid
+
+    def refresh():
+        try:
+            get(url, params, cachefile=cachefile, cachesecs=cachesecs,
+                **kwargs)
+        except Exception as e:
+            print("*** Background refresh of %s failed: %s" % (url, e),
+                  file=sys.stderr)
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(cachefile)
+
+    with _refresh_lock:
+        if cachefile in _refreshing:
+            return
+        # Like the http session, a forked process needs its own threads.
+        if _refresh_executor is None or _refresh_pid != os.getpid():
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=REFRESH_WORKERS,
+                thread_name_prefix="cache-refresh")
+            _refresh_pid = os.getpid()
+            _refreshing.clear()
+        _refreshing.add(cachefile)
+        print("Serving stale", cachefile, "while refreshing", url,
+              file=sys.stderr)
+        _refresh_executor.submit(refresh)
+
+
+def refresh_pending(cachefile):
+    """Is a background refresh of cachefile queued or in progress?"""
+    with _refresh_lock:
+        return cachefile in _refreshing
+
+
+#
+# Single-flight fetching: when several threads or processes want
+# the same expired page at once, only one of them downloads it.
+#
+
+_inflight = {}          # cachefile: Future for the fetch in progress
+_inflight_lock = threading.Lock()
+
+
+def single_flight(key, fetch):
+    """Call fetch() and return its result, unless another thread
+       is already doing that for key, in which case wait for
+       that thread and return its result instead.
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not leader:
+        if DEBUG:
+            print("Waiting for in-flight fetch of", key, file=sys.stderr)
+        METRICS.inc("billtracker_coalesced_total", {})
+        return future.result()
+
+    try:
+        result = fetch()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+def max_fetch_secs():
+    """The longest a net_get() can take: every attempt timing out,
+       plus the longest backoffs between them.
+    """
+    backoff = sum(min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2**attempt)
+                  for attempt in range(FETCH_RETRIES))
+    return (FETCH_RETRIES + 1) * FETCH_TIMEOUT + backoff
+
+
+def fetch_lock_file(cachefile):
+    """The lock file for fetching cachefile: one per cache file,
+       so fetches of different pages never wait for each other.
+       (Fetches of the same page in one process are already
+       merged by single_flight().)
+    """
+    key = hashlib.sha1(os.path.abspath(cachefile).encode()).hexdigest()
+    return os.path.join(CACHEDIR, ".fetchlocks", key[:2], key[2:] + ".lock")
+
+
+@contextmanager
+def fetch_lock(cachefile):
+    """Hold an exclusive lock, shared with other processes using
+       the same CACHEDIR, while fetching cachefile.
+       Gives up waiting after FETCH_LOCK_TIMEOUT seconds,
+       or max_fetch_secs() if that's None.
+    """
+    if not fcntl:
+        yield
+        return
+
+    lockfile = fetch_lock_file(cachefile)
+    try:
+        os.makedirs(os.path.dirname(lockfile), exist_ok=True)
+        lockfp = open(lockfile, "w")
+    except OSError as e:
+        print("Couldn't open fetch lock:", e, file=sys.stderr)
+        yield
+        return
+
+    locked = False
+    timeout = FETCH_LOCK_TIMEOUT
+    if timeout is None:
+        timeout = max_fetch_secs() + 5
+    give_up = time.time() + timeout
+    try:
+        while True:
+            try:
+                fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+                break
+            except BlockingIOError:
+                if time.time() > give_up:
+                    print("Gave up waiting for fetch lock on", cachefile,
+                          file=sys.stderr)
+                    break
+                time.sleep(.1)
+        yield
+    finally:
+        if locked:
+            fcntl.flock(lockfp, fcntl.LOCK_UN)
+        lockfp.close()
+
+
+#
+# Pieces of get() that are shared with the asyncio version
+# in abillrequests.
+#
+
+def local_response(url, cachefile):
+    """In LOCAL_MODE, return a response from the cachefile, however old,
+       or a 404 if there isn't one.
+    """
+    response = CustomResponse()
+    content = cache_store().read(cachefile)
+    if content is not None:
+        if DEBUG:
+            print("LOCAL_MODE: Fetching from cachefile:", cachefile)
+        response.content = content
+        response.status_code = 200
+        return response
+
+    # Cache file doesn't exist, but it's local mode so
+    # can't use the net.
+    if DEBUG:
+        print("*** billrequests.get(): LOCAL_MODE, but "
+              "cachefile %s doesn't exist" % cachefile)
+        print("  for URL", url)
+    response.status_code = 404
+    response.content = b''
+    return response
+
+
+def cached_response(url, cachefile, cachesecs):
+    """Return a response from the cachefile if it's newer than cachesecs
+       (or cachesecs is negative), otherwise None.
+    """
+    filestat = cache_stat(cachefile)
+    if not filestat:
+        return None
+    mtime, size = filestat
+    if (time.time() - mtime) >= cachesecs and cachesecs >= 0:
+        return None
+
+    if DEBUG:
+        print("Already cached:", url, '->', cachefile, file=sys.stderr)
+    content = cache_store().read(cachefile)
+    if content is None:
+        forget_cache_entry(cachefile)
+        return None
+    response = CustomResponse()
+    response.content = content
+    response.status_code = 200
+    response.headers['Last-Modified'] = \
+        time.strftime('%a, %d %b %Y %X %Z', time.localtime(mtime))
+    return response
+
+
+def conditional_headers(cachefile, headers=None):
+    """If there's an old copy of cachefile with saved validators,
+       return (validators, headers) where headers is a copy of headers
+       plus If-None-Match and/or If-Modified-Since.
+       Otherwise return ({}, headers).
+    """
+    if not cache_store().stat(cachefile):
+        # The index can outlive the body (evicted, or removed by hand):
+        # a 304 would leave nothing to return.
+        forget_cache_entry(cachefile)
+        return {}, headers
+    validators = read_validators(cachefile)
+    if not validators:
+        return {}, headers
+    headers = dict(headers or {})
+    if "ETag" in validators:
+        headers["If-None-Match"] = validators["ETag"]
+    if "Last-Modified" in validators:
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+    return validators, headers
+
+
+def not_modified_response(cachefile, headers):
+    """The server said 304 Not Modified: the cached copy is still good.
+       Touch it so it counts as fresh for another cachesecs,
+       but don't rewrite the body. Return a 200 response from the cache,
+       or None if the cached copy has gone missing after all.
+    """
+    content = cache_store().read(cachefile)
+    if content is None:
+        return None
+    try:
+        cache_store().touch(cachefile)
+    except OSError:
+        return None
+    index = cache_index()
+    if index:
+        index.touch(cachefile)
+    response = CustomResponse()
+    response.content = content
+    response.status_code = 200
+    response.headers = headers
+    return response
+
+
+def save_to_cache(url, cachefile, content, headers):
+    """Write a freshly fetched body to the cachefile,
+       and record it, along with its validators, in the cache index.
+    """
+    cache_store().write(cachefile, content)
+    index = cache_index()
+    if not index:
+        write_validators(cachefile, headers)
+        return
+
+    # Header names are case-insensitive, but not every library's dict is
+    headers = requests.structures.CaseInsensitiveDict(headers)
+    index.record(cachefile, url, len(content),
+                 etag=headers.get("ETag"),
+                 last_modified=headers.get("Last-Modified"))
+    # Validators from before there was an index are now out of date
+    write_validators(cachefile, {})
+
+
+#
+# Conditional revalidation: when a cache file gets too old,
+# rather than re-downloading the whole page, send the ETag and
+# Last-Modified the server gave us last time. If nothing changed
+# the server answers 304 Not Modified with no body.
+# The validators are kept in the cache index, or if there's no index,
+# in a small JSON file next to the cache file.
+#
+
+VALIDATOR_HEADERS = ("ETag", "Last-Modified")
+
+
+def validators_filename(cachefile):
+    """Where the ETag/Last-Modified for a cache file are kept."""
+    return cachefile + ".hdrs"
+
+
+def read_validators(cachefile):
+    """Return a dict of whichever of ETag and Last-Modified
+       were saved for this cache file, possibly empty.
+    """
+    index = cache_index()
+    entry = index.lookup(cachefile) if index else None
+    if entry:
+        validators = {}
+        if entry["etag"]:
+            validators["ETag"] = entry["etag"]
+        if entry["last_modified"]:
+            validators["Last-Modified"] = entry["last_modified"]
+        return validators
+
+    try:
+        with open(validators_filename(cachefile)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_validators(cachefile, headers):
+    """Save the ETag and Last-Modified from a response's headers,
+       or remove any stale validators if the server didn't send any.
+    """
+    # Header names are case-insensitive, but not every library's dict is
+    headers = requests.structures.CaseInsensitiveDict(headers)
+    validators = { h: headers[h] for h in VALIDATOR_HEADERS if h in headers }
+    hdrsfile = validators_filename(cachefile)
+    try:
+        if validators:
+            with open(hdrsfile, "w") as fp:
+                json.dump(validators, fp)
+        elif os.path.exists(hdrsfile):
+            os.unlink(hdrsfile)
+    except OSError as e:
+        print("Couldn't save validators for", cachefile, ":", e,
+              file=sys.stderr)
+
+
+def cached_head(url, cachefile, cachesecs):
+    """If cachefile is newer than cachesecs, return a fake head response
+       with its size and modification time, otherwise None.
+    """
+    filestat = cache_stat(cachefile)
+    if not filestat:
+        return None
+
+    print("cache file", cachefile, "exists, returning fake header",
+          file=sys.stderr)
+    mtime, size = filestat
+    if (time.time() - mtime) >= cachesecs and cachesecs >= 0:
+        return None
+
+    response = CustomResponse()
+    response.status_code = 200
+    response.headers = {
+        'Content-Length': size,
+        # nmlegis, at least, gives timestamps in format
+        # 'Thu, 25 Jan 2024 00:47:23 GMT'
+        # Note that it's in GMT, whereas
+        # datetime.fromtimestamp(mtime) is in unaware
+        # localtime, so need to convert
+        'Last-Modified': datetime.utcfromtimestamp(mtime) \
+            .strftime("%a, %d %b %Y %H:%M:%S GMT")
+    }
     return response
 
 
@@ -185,6 +1170,8 @@ def head(url, **kwargs):
     """Wrapper for requests.head that can fetch from cache instead.
        Optional cachefile argument specifies the location of the
        cache file, otherwise it will be calculated.
+       Never raises for network trouble: if the host can't be reached,
+       or its circuit breaker is open, the status is 503.
     """
     if DEBUG:
         if LOCAL_MODE:
@@ -202,33 +1189,35 @@ def head(url, **kwargs):
     else:
         cachesecs = CACHESECS
 
-    # The response that will be returned
-    response = CustomResponse()
-
-    if os.path.exists(cachefile):
-        print("cache file", cachefile, "exists, returning fake header",
-              file=sys.stderr)
-        filestat = os.stat(cachefile)
-        if (time.time() - filestat.st_mtime) < cachesecs or cachesecs < 0:
-            response.status_code = 200
-            response.headers = {
-                'Content-Length': filestat.st_size,
-                # nmlegis, at least, gives timestamps in format
-                # 'Thu, 25 Jan 2024 00:47:23 GMT'
-                # Note that it's in GMT, whereas
-                # datetime.fromtimestamp(filestat.st_mtime) is in unaware
-                # localtime, so need to convert
-                'Last-Modified': datetime.utcfromtimestamp(filestat.st_mtime) \
-                    .strftime("%a, %d %b %Y %H:%M:%S GMT")
-            }
-            return response
+    response = cached_head(url, cachefile, cachesecs)
+    if response:
+        return counted("head", url, "cache_hit", response)
 
-    elif LOCAL_MODE:
+    if LOCAL_MODE and not cache_stat(cachefile):
         print("head LOCAL MODE:", url, "->", cachefile, file=sys.stderr)
+        response = CustomResponse()
         response.status_code = 404
-        return response
+        return counted("head", url, "local", response)
+
+    response = cached_failure(url, cachefile, "HEAD")
+    if response:
+        return counted("head", url, "negative_hit", response)
 
-    return requests.head(url, **kwargs)
+    kwargs.pop("cachefile", None)
+    kwargs.pop("cachesecs", None)
+    try:
+        response = net_head(url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        # Including CircuitOpenError: callers just want a status,
+        # like the one get() gives when the server is down.
+        print("*** NETWORK ERROR on HEAD %s: %s" % (url, e), file=sys.stderr)
+        response = CustomResponse()
+        response.status_code = 503
+        return counted("head", url, "error", response)
+    save_failure(url, cachefile, response.status_code, "HEAD")
+    return counted("head", url,
+                   "fetched" if response.status_code < 400 else "error",
+                   response)
 
 
 #
@@ -249,38 +1238,138 @@ def url_to_cache_filename(url, billdic=None):
     """Calculate the cache filename for the given url.
        If billdic is provided, it will be used for keys 'billno' and 'year'
        otherwise all such information will be parsed from the URL.
+       With SHARDED_CACHE, if the file isn't in the sharded layout
+       but was cached in the old flat layout, return the flat name.
     """
+    name = cache_basename(url, billdic)
+    flatfile = os.path.join(CACHEDIR, name)
+    if not SHARDED_CACHE:
+        return flatfile
+
+    cachefile = sharded_cache_filename(name)
+    if not cache_stat(cachefile) and cache_store().stat(flatfile):
+        return flatfile
+    return cachefile
+
+
+def cache_basename(url, billdic=None):
+    """The name of the cache file for url, without any directory."""
     # Is it a bill URL? That's true if billdic is set,
     # or if the bill fits this pattern:
     if billdic:
-        return os.path.join(CACHEDIR,
-                            '20%s-%s.html' % (billdic['year'],
-                                              billdic['billno']))
+        return '20%s-%s.html' % (billdic['year'], billdic['billno'])
 
     bill_url_matcher = bill_url_pat.match(url)
     if bill_url_matcher:
         chamber, billtype, number, yearcode = bill_url_matcher.groups()
-        return os.path.join(CACHEDIR,
-                            '20%s-%s%s%s.html' % (yearcode, chamber,
-                                                  billtype, number))
+        return '20%s-%s%s%s.html' % (yearcode, chamber, billtype, number)
 
     # It wasn't a bill URL. Fall back to making a filename
     # that's similar to the one in the URL.
-    return os.path.join(CACHEDIR,
-                        url.replace('https://www.nmlegis.gov/', '') \
-                        .replace('/Legislation', '') \
-                        .replace('/', '_') \
-                        .replace('?', '_') \
-                        .replace('&', '_'))
+    return url.replace('https://www.nmlegis.gov/', '') \
+              .replace('/Legislation', '') \
+              .replace('/', '_') \
+              .replace('?', '_') \
+              .replace('&', '_')
+
+
+# Cache names that belong to a session: bill pages like 2025-HB123.html,
+# and anything under Sessions/25%20Regular/ etc.
+bill_cachename_pat = re.compile(r'20(\d\d(?:s\d?|x)?)-[HS]')
+session_cachename_pat = re.compile(
+    r'Sessions_(\d\d)%20(Regular|Special(\d?)|Extraordinary)')
+
+
+def cache_shard(name):
+    """Which session subdirectory a cache name belongs in:
+       a yearcode like "25" or "20s2", or "other".
+    """
+    m = bill_cachename_pat.match(name)
+    if m:
+        return m.group(1)
+    m = session_cachename_pat.match(name)
+    if m:
+        if m.group(2) == "Regular":
+            return m.group(1)
+        if m.group(2) == "Extraordinary":
+            return m.group(1) + 'x'
+        return m.group(1) + 's' + m.group(3)
+    return "other"
+
+
+def sharded_cache_filename(name):
+    """Where a cache file called name goes in the sharded layout:
+       CACHEDIR/session/hh/name, where hh is from a hash of the name
+       so no directory gets too big.
+    """
+    return os.path.join(CACHEDIR, cache_shard(name),
+                        hashlib.sha1(name.encode()).hexdigest()[:2], name)
 
 
-def soup_from_cache_or_net(url, billdic=None, cachesecs=CACHESECS):
+# Files in a flat cache directory that came from url_to_cache_filename.
+# Anything else there (allbills JSON, accdb files, the cache index...)
+# stays where it is.
+flat_cachename_pat = re.compile(
+    r'(20\d\d(s\d?|x)?-[HS]\w+\.html'
+    r'|(Sessions|Committee|Legislation|Legislator|Members|Entity)_'
+    r'|https?:_)')
+
+
+def migrate_to_sharded(cachedir=None):
+    """Move cache files from the flat layout in cachedir (default CACHEDIR)
+       into the sharded layout, along with their .hdrs or .gz
+       companions, updating the cache index.
+       Returns the number of files moved.
+    """
+    global CACHEDIR
+    saved_cachedir = CACHEDIR
+    if cachedir:
+        CACHEDIR = cachedir
+    try:
+        index = cache_index()
+        moved = 0
+        # (old, new) cache file names, without any .gz,
+        # for the cache files themselves
+        renames = []
+        for name in sorted(os.listdir(CACHEDIR)):
+            if not flat_cachename_pat.match(name) or name.endswith(".tmp"):
+                continue
+            oldpath = os.path.join(CACHEDIR, name)
+            if not os.path.isfile(oldpath):
+                continue
+            # The .hdrs or .gz goes along with the file it belongs to
+            basename = name
+            for suffix in (".hdrs", ".gz"):
+                if basename.endswith(suffix):
+                    basename = basename[:-len(suffix)]
+            newbase = sharded_cache_filename(basename)
+            newpath = os.path.join(os.path.dirname(newbase), name)
+
+            os.makedirs(os.path.dirname(newpath), exist_ok=True)
+            shutil.move(oldpath, newpath)
+            # The index knows a GzipStore entry X.gz as X
+            if not name.endswith(".hdrs"):
+                renames.append((os.path.join(CACHEDIR, basename), newbase))
+                if index:
+                    index.rename(renames[-1][0], newbase)
+            moved += 1
+        cache_store().moved(renames)
+        print("Moved %d files in %s to the sharded layout"
+              % (moved, CACHEDIR), file=sys.stderr)
+        return moved
+    finally:
+        CACHEDIR = saved_cachedir
+
+
+def soup_from_cache_or_net(url, billdic=None, cachesecs=CACHESECS,
+                           stale_ok=False):
     """url is a full URL including https://www.nmlegis.gov/ .
        If there is a recent cached version, use it,
        otherwise fetch the file and cache it.
        If the cache file is older than cachesecs, replace it.
        If billdic is provided, it will be used for keys 'billno' and 'year'
        to make a cleaner cache file name, like '2020-HB31.html'.
+       stale_ok is as in get().
        Either way, return a BS soup of the contents.
     """
     if DEBUG:
@@ -288,7 +1377,8 @@ def soup_from_cache_or_net(url, billdic=None, cachesecs=CACHESECS):
 
     cachefile = url_to_cache_filename(url, billdic)
 
-    response = get(url, cachefile=cachefile, cachesecs=cachesecs)
+    response = get(url, cachefile=cachefile, cachesecs=cachesecs,
+                   stale_ok=stale_ok)
 
     if response.status_code != 200:
         print("No soup! Response was", response.status_code, file=sys.stderr)
@@ -299,7 +1389,7 @@ def soup_from_cache_or_net(url, billdic=None, cachesecs=CACHESECS):
             # print("wget '%s' -O %s" % (url, cachefile), file=sys.stderr)
         return None
 
-    soup = BeautifulSoup(response.text, "lxml")
+    soup = parsed_soup(cachefile, response)
     if not soup:
         print("No soup! On cache %s,\n  URL %s" % (cachefile, url),
               file=sys.stderr)
@@ -310,6 +1400,131 @@ def soup_from_cache_or_net(url, billdic=None, cachesecs=CACHESECS):
     return soup
 
 
+#
+# Parsed soups, so pages that haven't changed aren't parsed again.
+# Keyed by cachefile; each entry remembers the (mtime, size) it was
+# parsed from, so a refreshed cache file is parsed again.
+# Soups are shared between callers, so treat them as read-only.
+#
+
+_soup_cache = OrderedDict()     # cachefile: ((mtime, size), soup, nbytes)
+_soup_cache_lock = threading.Lock()
+_soup_cache_stats = { "hits": 0, "misses": 0, "bytes": 0 }
+
+
+def parsed_soup(cachefile, response):
+    """Return a BeautifulSoup for response, which came from cachefile,
+       reusing an earlier parse if the cache file hasn't changed since.
+    """
+    filestat = cache_stat(cachefile) if SOUP_CACHE_BYTES else None
+    if not filestat:
+        return timed_soup(response)
+
+    with _soup_cache_lock:
+        entry = _soup_cache.get(cachefile)
+        if entry and entry[0] == filestat:
+            _soup_cache.move_to_end(cachefile)
+            _soup_cache_stats["hits"] += 1
+            return entry[1]
+        _soup_cache_stats["misses"] += 1
+
+    soup = timed_soup(response)
+    nbytes = len(response.content) * SOUP_SIZE_FACTOR
+
+    with _soup_cache_lock:
+        old = _soup_cache.pop(cachefile, None)
+        if old:
+            _soup_cache_stats["bytes"] -= old[2]
+        if nbytes <= SOUP_CACHE_BYTES:
+            _soup_cache[cachefile] = (filestat, soup, nbytes)
+            _soup_cache_stats["bytes"] += nbytes
+        while _soup_cache_stats["bytes"] > SOUP_CACHE_BYTES:
+            oldfile, old = _soup_cache.popitem(last=False)
+            _soup_cache_stats["bytes"] -= old[2]
+
+    return soup
+
+
+def timed_soup(response):
+    start = time.monotonic()
+    soup = BeautifulSoup(response.text, "lxml")
+    METRICS.observe("billtracker_parse_seconds", { "kind": "soup" },
+                    time.monotonic() - start)
+    return soup
+
+
+def soup_cache_stats():
+    """Return a dict of hits, misses, entries and (estimated) bytes
+       for the parsed soup cache.
+    """
+    with _soup_cache_lock:
+        stats = dict(_soup_cache_stats)
+        stats["entries"] = len(_soup_cache)
+    return stats
+
+
+def clear_soup_cache():
+    with _soup_cache_lock:
+        _soup_cache.clear()
+        _soup_cache_stats["bytes"] = 0
+
+
+#
+# Batch fetching: fetch a list of URLs in a bounded thread pool.
+# Each fetch goes through get(), so it honors the cache, LOCAL_MODE
+# and the per-host rate limits; the pool just overlaps the waiting.
+#
+
+def _url_and_billdic(item):
+    """Items passed to get_many can be a URL or a (url, billdic) tuple."""
+    if isinstance(item, str):
+        return item, None
+    return item
+
+
+def get_many(items, cachesecs=CACHESECS, max_workers=None):
+    """Fetch many URLs concurrently, yielding (url, response) tuples
+       in the order they complete.
+       items is a list of URLs, or of (url, billdic) tuples
+       where billdic is used for the cache filename as in
+       url_to_cache_filename.
+       At most max_workers (default MAX_CONCURRENT_FETCHES)
+       fetches are in flight at once.
+    """
+    if not max_workers:
+        max_workers = MAX_CONCURRENT_FETCHES
+
+    def fetch(item):
+        url, billdic = _url_and_billdic(item)
+        return url, get(url, cachefile=url_to_cache_filename(url, billdic),
+                        cachesecs=cachesecs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [ executor.submit(fetch, item) for item in items ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def soup_many(items, cachesecs=CACHESECS, max_workers=None):
+    """Like get_many, but yield (url, soup) tuples.
+       soup is None if the page couldn't be fetched.
+    """
+    items = list(items)
+    cachefiles = {}
+    for item in items:
+        url, billdic = _url_and_billdic(item)
+        cachefiles[url] = url_to_cache_filename(url, billdic)
+
+    for url, response in get_many(items, cachesecs=cachesecs,
+                                  max_workers=max_workers):
+        if response.status_code != 200:
+            print("No soup! Response was", response.status_code,
+                  "on", url, file=sys.stderr)
+            yield url, None
+            continue
+        yield url, parsed_soup(cachefiles[url], response)
+
+
 # Seriously? requests can't handle ftp?
 def ftp_get(server, dir, filename, outfile):
     """Fetch a file via ftp.
@@ -328,14 +1543,100 @@ def ftp_get(server, dir, filename, outfile):
         raise FileNotFoundError(str(e))
 
 
+# One file in an html dir listing: a line like
+#  1/25/2020  7:32 PM       133392 <A HREF="/Sessions/20%20Regular/firs/HB0019.PDF">HB0019.PDF</A><br>
+# Subdirectories have <dir> instead of a size, so don't match.
+dirlist_pat = re.compile(r'(\d+/\d+/\d+) +(\d+:\d+) ([AP]M) +(\d+) '
+                         r'<A HREF="/*([^"]*)">([^<]+)</A>',
+                         flags=re.IGNORECASE)
+
+
+class DirEntry:
+    """A file in an html dir listing. Readable like the dicts
+       get_html_dirlist used to return, e.g. entry['name'],
+       with keys name, url, size and 'Last Modified'.
+       Only the matched strings are stored;
+       url and Last Modified are put together when asked for.
+    """
+    __slots__ = ("name", "_size", "_href", "_date", "_time", "_ampm")
+
+    KEYS = { "name": "name", "url": "url", "size": "size",
+             "Last Modified": "last_modified" }
+
+    def __init__(self, date, time, ampm, size, href, name):
+        self._date = date
+        self._time = time
+        self._ampm = ampm
+        self._size = size
+        self._href = href
+        self.name = name
+
+    @property
+    def url(self):
+        return "https://www.nmlegis.gov/" + self._href
+
+    @property
+    def size(self):
+        return int(self._size)
+
+    @property
+    def last_modified(self):
+        # Like '1/24/2019\t1:19 PM MST'
+        return "%s\t%s %s MST" % (self._date, self._time, self._ampm)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.KEYS[key])
+        except KeyError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self.KEYS:
+            return self[key]
+        return default
+
+    def __repr__(self):
+        return "DirEntry(%s, %s, %d)" % (self.name, self.last_modified,
+                                         self.size)
+
+
+def parse_html_dirlist(listing):
+    """Yield a DirEntry for each file in the text of an html dir listing.
+    """
+    # Only look inside the <pre>.
+    # This is a large file, and string find is much faster than re.
+    start = listing.find("<pre>")
+    if start < 0:
+        start = listing.find("<PRE>")
+    end = listing.find("</pre>", start)
+    if end < 0:
+        end = listing.find("</PRE>", start)
+    if start < 0:
+        start = 0
+    if end < 0:
+        end = len(listing)
+
+    for match in dirlist_pat.finditer(listing, start, end):
+        yield DirEntry(*match.groups())
+
+
+# Parsed listings, so an unchanged listing isn't parsed again:
+# cachefile: (hash of the listing, [ DirEntry, ... ])
+# Keyed on the body, not the file's mtime, which a 304 updates.
+_dirlist_cache = OrderedDict()
+_dirlist_cache_lock = threading.Lock()
+DIRLIST_CACHE_SIZE = 64
+
+
 def get_html_dirlist(url):
-    """Read an html dir listing page; return the contents as a list of dics,
-       [ { 'name': 'SB0048SFL1.pdf, 'size': '136 KB',
+    """Read an html dir listing page; return the contents as a list of
+       DirEntry, which can be read like dicts:
+       [ { 'name': 'SB0048SFL1.pdf, 'size': 136000,
            "url": "https://www.nmlegis.gov/Sessions/20%20Regular/firs/HB0004.PDF",
-           'Last Modified': '1/24/19 	1:19:00 PM MST
+           'Last Modified': '1/24/19 	1:19 PM MST'
          }
        ]
-       Note that times are datetimes but no timezone is set.
+       The list is shared with other callers, so don't modify it.
        Frustratingly, if you view the ftp: URL in a web server it shows
        timezones, but actually retrieving the listing via ftp drops them.
     """
@@ -353,59 +1654,49 @@ def get_html_dirlist(url):
         print("No listing, cachefile was", cachefile)
         return []
 
-    ls = []
+    bodyhash = hashlib.sha1(response.content).hexdigest()
+    with _dirlist_cache_lock:
+        if cachefile in _dirlist_cache \
+           and _dirlist_cache[cachefile][0] == bodyhash:
+            _dirlist_cache.move_to_end(cachefile)
+            return _dirlist_cache[cachefile][1]
 
-    # The listing is inside a <pre>, with lines separated by <br>,
-    # and each line is formatted like this:
-    #  1/25/2020  7:32 PM       133392 <A HREF="/Sessions/20%20Regular/firs/HB0019.PDF">HB0019.PDF</A><br>
-    # Strip off everything that's not inside <pre></pre>
-    # This is a large file, and using re on it takes forEVER.
-    # String find is much faster.
-    pre = listing.find("<pre>")
-    if pre < 0:
-        pre = listing.find("<PRE>")
-    if pre > 0:
-        listing = listing[pre+5:]
-    pre = listing.find("</pre>")
-    if pre < 0:
-        pre = listing.find("</PRE>")
-    if pre > 0:
-        listing = listing[:pre]
-
-    lines = listing.split("<br>")
-    for line in lines:
-        words = line.split()
-        if len(words) != 6:
-            continue
-        try:
-            dic = {}
-            try:
-                dic["size"] = int(words[3])
-                month, day, year = [int(n) for n in words[0].split("/")]
-                hour, minute = [int(n) for n in words[1].split(":")]
-                if words[2] == "PM":
-                    hour += 12
-                dic["Last Modified"] = "%s\t%s %s MST" % tuple(words[0:3])
-                # words[5] looks like:
-                # 'HREF="/Sessions/20%20Regular/firs/HB0001.PDF">HB0001.PDF</A>'
-                match = hrefpat.match(words[5])
-                url = match.group(1)
-                while url.startswith('/'):
-                    url = url[1:]
-                dic["url"] = "https://www.nmlegis.gov/" + url
-                dic["name"] = match.group(2)
-            except Exception as e:
-                # print("Couldn't parse line of directory listing in", url, ":",
-                #       line, file=sys.stderr)
-                continue
+    start = time.monotonic()
+    ls = list(parse_html_dirlist(listing))
+    METRICS.observe("billtracker_parse_seconds", { "kind": "dirlist" },
+                    time.monotonic() - start)
 
-            ls.append(dic)
-        except RuntimeError as e:
-            continue
+    with _dirlist_cache_lock:
+        _dirlist_cache[cachefile] = (bodyhash, ls)
+        _dirlist_cache.move_to_end(cachefile)
+        while len(_dirlist_cache) > DIRLIST_CACHE_SIZE:
+            _dirlist_cache.popitem(last=False)
 
     return ls
 
 
+def get_html_dirlists(urls, max_workers=None):
+    """Fetch and parse several html dir listings concurrently,
+       yielding (url, dirlist, seconds) tuples in the order they complete,
+       where dirlist is as from get_html_dirlist() and seconds is
+       how long that listing took.
+       At most max_workers (default MAX_CONCURRENT_FETCHES)
+       fetches are in flight at once.
+    """
+    if not max_workers:
+        max_workers = MAX_CONCURRENT_FETCHES
+
+    def fetch(url):
+        start = time.monotonic()
+        dirlist = get_html_dirlist(url)
+        return url, dirlist, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [ executor.submit(fetch, url) for url in urls ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
 def ftp_index(server, ftpdir):
     """Read an ftp index page; return the contents as a list of dics,
        [ { 'name': 'SB0048SFL1.pdf, 'size': '136 KB',
@@ -469,5 +1760,8 @@ def ftp_url_index(url):
 
 
 if __name__ == '__main__':
-    pass
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        migrate_to_sharded(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        print("Usage: python3 -m app.bills.billrequests migrate [cachedir]")
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+A SQLite index of what billrequests has cached:
+for each cache file, the URL it came from, when it was fetched,
+its size, its ETag/Last-Modified validators and the HTTP status.
+
+billrequests consults it for freshness checks instead of stat-ing
+files in a big flat directory, and keeps it up to date as it fetches.
+It also remembers recent failures (404s, server errors) so they
+aren't re-requested every time.
+Files that aren't in the index (e.g. fixtures in tests/cache, or
+anything cached before the index existed) still work: billrequests
+falls back to the filesystem for those.
+
+Run this file to list what's cached, oldest first:
+    python3 -m app.bills.cacheindex cache/cacheindex.sqlite
+"""
+
+import sqlite3
+import threading
+import os, sys
+import time
+
+
+COLUMNS = ("cachefile", "url", "fetched_at", "size",
+           "etag", "last_modified", "status")
+
+
+class CacheIndex:
+    """The index for one cache directory, kept in dbfile.
+       Safe to share between threads (each gets its own connection)
+       and between processes (SQLite handles the locking).
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.local = threading.local()
+        db = self._db()
+        db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                          cachefile TEXT PRIMARY KEY,
+                          url TEXT,
+                          fetched_at REAL,
+                          size INTEGER,
+                          etag TEXT,
+                          last_modified TEXT,
+                          status INTEGER)""")
+        db.execute("CREATE INDEX IF NOT EXISTS cache_fetched_at"
+                   " ON cache (fetched_at)")
+        # Negative entries: the last fetch of url failed with status.
+        # Kept apart from the cache table so a failure doesn't lose
+        # what's known about an older good copy.
+        # A failed HEAD has its own row, keyed "HEAD:cachefile",
+        # since a server may refuse HEAD for a page it will GET.
+        db.execute("""CREATE TABLE IF NOT EXISTS failures (
+                          cachefile TEXT PRIMARY KEY,
+                          url TEXT,
+                          fetched_at REAL,
+                          status INTEGER)""")
+
+    def _db(self):
+        if not hasattr(self.local, "db"):
+            # isolation_level=None: each statement commits by itself
+            self.local.db = sqlite3.connect(self.dbfile, timeout=10,
+                                            isolation_level=None)
+            self.local.db.row_factory = sqlite3.Row
+            self.local.db.execute("PRAGMA journal_mode=WAL")
+            self.local.db.execute("PRAGMA synchronous=NORMAL")
+        return self.local.db
+
+    @staticmethod
+    def _key(cachefile):
+        return os.path.abspath(cachefile)
+
+    @classmethod
+    def _failure_keys(cls, cachefile):
+        """The failures rows for cachefile, from a GET and a HEAD."""
+        key = cls._key(cachefile)
+        return (key, "HEAD:" + key)
+
+    @classmethod
+    def _failure_key(cls, cachefile, method):
+        key = cls._key(cachefile)
+        return key if method == "GET" else method + ":" + key
+
+    def lookup(self, cachefile):
+        """Return a dict of the COLUMNS for cachefile, or None."""
+        row = self._db().execute("SELECT * FROM cache WHERE cachefile = ?",
+                                 (self._key(cachefile),)).fetchone()
+        return dict(row) if row else None
+
+    def record(self, cachefile, url, size, etag=None, last_modified=None,
+               status=200, fetched_at=None):
+        """Note that cachefile was just fetched from url."""
+        if fetched_at is None:
+            fetched_at = time.time()
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO cache VALUES "
+                   "(?, ?, ?, ?, ?, ?, ?)",
+                   (self._key(cachefile), url, fetched_at, size,
+                    etag, last_modified, status))
+        db.execute("DELETE FROM failures WHERE cachefile IN (?, ?)",
+                   self._failure_keys(cachefile))
+
+    def record_failure(self, cachefile, url, status, fetched_at=None,
+                       method="GET"):
+        """Note that fetching url (for cachefile) just failed with status.
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+        self._db().execute("INSERT OR REPLACE INTO failures VALUES "
+                           "(?, ?, ?, ?)",
+                           (self._failure_key(cachefile, method), url,
+                            fetched_at, status))
+
+    def lookup_failure(self, cachefile, method="GET"):
+        """Return a dict (cachefile, url, fetched_at, status)
+           for the last failed fetch of cachefile with method, or None.
+        """
+        row = self._db().execute("SELECT * FROM failures"
+                                 " WHERE cachefile = ?",
+                                 (self._failure_key(cachefile, method),)
+                                 ).fetchone()
+        return dict(row) if row else None
+
+    def touch(self, cachefile, fetched_at=None):
+        """The server says cachefile is still current (e.g. a 304)."""
+        if fetched_at is None:
+            fetched_at = time.time()
+        self._db().execute("UPDATE cache SET fetched_at = ?"
+                           " WHERE cachefile = ?",
+                           (fetched_at, self._key(cachefile)))
+
+    def rename(self, oldfile, newfile):
+        """A cache file was moved."""
+        db = self._db()
+        db.execute("UPDATE cache SET cachefile = ? WHERE cachefile = ?",
+                   (self._key(newfile), self._key(oldfile)))
+        for newkey, oldkey in zip(self._failure_keys(newfile),
+                                  self._failure_keys(oldfile)):
+            db.execute("UPDATE failures SET cachefile = ?"
+                       " WHERE cachefile = ?", (newkey, oldkey))
+
+    def forget(self, cachefile):
+        db = self._db()
+        db.execute("DELETE FROM cache WHERE cachefile = ?",
+                   (self._key(cachefile),))
+        db.execute("DELETE FROM failures WHERE cachefile IN (?, ?)",
+                   self._failure_keys(cachefile))
+
+    def inventory(self, older_than=None):
+        """Yield a dict for each cached entry, oldest first.
+           If older_than (seconds) is given, only entries
+           fetched longer ago than that.
+        """
+        if older_than is None:
+            rows = self._db().execute(
+                "SELECT * FROM cache ORDER BY fetched_at")
+        else:
+            rows = self._db().execute(
+                "SELECT * FROM cache WHERE fetched_at < ?"
+                " ORDER BY fetched_at", (time.time() - older_than,))
+        for row in rows:
+            yield dict(row)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: %s cachedir/cacheindex.sqlite" % sys.argv[0])
+        sys.exit(1)
+
+    now = time.time()
+    for entry in CacheIndex(sys.argv[1]).inventory():
+        print("%8.1fh %9s %3s  %s" % ((now - entry["fetched_at"]) / 3600,
+                                       entry["size"], entry["status"],
+                                       entry["url"]))
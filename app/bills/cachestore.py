@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+Storage backends for the billrequests cache.
+
+billrequests decides which cache file a URL maps to and whether it's
+fresh; a store decides how the bytes for that cache file are kept.
+
+FlatFileStore is the original layout: each cache file is a plain file
+at its cache path. It's what billrequests uses unless told otherwise.
+
+GzipStore keeps each body gzipped at cachepath + ".gz" and holds
+the whole cache under a byte budget, evicting the least recently used
+entries. It still reads plain files left from the flat layout
+(like the fixtures in tests/cache), so switching is painless.
+To use it, before any fetching:
+    billrequests.CACHE_STORE = cachestore.GzipStore(billrequests.CACHEDIR,
+                                                    max_bytes=2*1024**3)
+"""
+
+import gzip
+import json
+import os, sys
+import struct
+import threading
+import time
+
+
+def write_atomically(path, chunks, fsync=False):
+    """Write an iterable of bytes chunks to path, by way of a temp file
+       in the same directory that's renamed into place at the end,
+       so a reader never sees a partly written file.
+       If fsync, make sure it's on disk before renaming.
+    """
+    tmpfile = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    try:
+        with open(tmpfile, "wb") as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+            if fsync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(tmpfile, path)
+    except BaseException:
+        try:
+            os.unlink(tmpfile)
+        except OSError:
+            pass
+        raise
+
+
+class FlatFileStore:
+    """Each cache file is stored as-is at its path."""
+
+    def stat(self, cachefile):
+        """Return (mtime, size) for cachefile, or None if it isn't cached."""
+        try:
+            st = os.stat(cachefile)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def read(self, cachefile):
+        """Return the cached bytes, or None."""
+        try:
+            with open(cachefile, 'rb') as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def write(self, cachefile, content):
+        write_atomically(cachefile, [ content ])
+
+    def touch(self, cachefile):
+        """Mark cachefile as freshly fetched without rewriting it."""
+        os.utime(cachefile)
+
+    def moved(self, renames):
+        """Cache files were moved on disk (by migrate_to_sharded),
+           as a list of (oldfile, newfile). Nothing to do for plain files.
+        """
+        pass
+
+
+class GzipStore(FlatFileStore):
+    """Compressed cache entries with least-recently-used eviction.
+
+       Compressed entries live at cachefile + ".gz".
+       An index, saved as .cacheindex.json in rootdir, remembers when
+       each entry was last used. When the entries under rootdir
+       (including its subdirectories) add up to more than max_bytes
+       (compressed), the least recently used are removed until the
+       total is back under low_water (default 90%) of max_bytes.
+
+       Only .gz entries are ever evicted; other files in the cache
+       directory (allbills JSON, accdb files etc.) are left alone.
+    """
+
+    INDEXNAME = ".cacheindex.json"
+
+    # Save the index at most this often (seconds). It's only a hint
+    # for eviction order, so losing a few updates doesn't matter.
+    INDEX_SAVE_SECS = 60
+
+    def __init__(self, rootdir, max_bytes, low_water=.9, compresslevel=6):
+        self.rootdir = rootdir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.compresslevel = compresslevel
+        self.lock = threading.Lock()
+        # { relative path: atime }, the estimated total size,
+        # and when the index was last saved; loaded when first needed.
+        self.atimes = None
+        self.total = 0
+        self.saved = 0
+        # Called with each evicted cachefile; billrequests sets it
+        # to drop the entry from its index.
+        self.on_evict = None
+
+    #
+    # The index
+    #
+
+    def _load_index(self):
+        """Load the index and size the cache the first time it's needed.
+           Call with self.lock held.
+        """
+        if self.atimes is not None:
+            return
+        try:
+            with open(os.path.join(self.rootdir, self.INDEXNAME)) as fp:
+                self.atimes = json.load(fp)
+        except (OSError, ValueError):
+            self.atimes = {}
+        self.total = sum(size for relpath, size, mtime in self._entries())
+        self.saved = time.time()
+
+    def _entries(self):
+        """Yield (relative path, size, mtime) for each compressed entry
+           under rootdir.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.rootdir):
+            for name in filenames:
+                if not name.endswith(".gz"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield os.path.relpath(path, self.rootdir), \
+                    st.st_size, st.st_mtime
+
+    def _used(self, cachefile, sizechange=0):
+        """Note that cachefile was just read or written."""
+        relpath = os.path.relpath(cachefile + ".gz", self.rootdir)
+        with self.lock:
+            self._load_index()
+            self.atimes[relpath] = time.time()
+            self.total += sizechange
+            if self.total > self.max_bytes:
+                self._evict()
+            elif time.time() - self.saved > self.INDEX_SAVE_SECS:
+                self._save_index()
+
+    def _save_index(self):
+        indexfile = os.path.join(self.rootdir, self.INDEXNAME)
+        try:
+            write_atomically(indexfile, [ json.dumps(self.atimes).encode() ])
+        except OSError as e:
+            print("Couldn't save cache index", indexfile, ":", e,
+                  file=sys.stderr)
+        self.saved = time.time()
+
+    def _evict(self):
+        """Remove least recently used entries until under the low water mark.
+           Sizes come from the directory tree itself, since other
+           processes may have added entries this one doesn't know about.
+        """
+        entries = sorted(self._entries(),
+                         key=lambda e: self.atimes.get(e[0], e[2]))
+        total = sum(e[1] for e in entries)
+        target = self.max_bytes * self.low_water
+        evicted = 0
+        for relpath, size, mtime in entries:
+            if total <= target:
+                break
+            path = os.path.join(self.rootdir, relpath)
+            try:
+                os.unlink(path)
+                total -= size
+                evicted += 1
+            except OSError:
+                continue
+            self.atimes.pop(relpath, None)
+            # Also remove the saved ETag/Last-Modified
+            try:
+                os.unlink(path[:-3] + ".hdrs")
+            except OSError:
+                pass
+            if self.on_evict:
+                try:
+                    self.on_evict(path[:-3])
+                except Exception as e:
+                    print("Couldn't forget evicted", path, ":", e,
+                          file=sys.stderr)
+        print("Cache eviction removed %d entries from %s, now %d bytes"
+              % (evicted, self.rootdir, total), file=sys.stderr)
+        self.total = total
+        self._save_index()
+
+    #
+    # The store interface
+    #
+
+    def stat(self, cachefile):
+        """(mtime, uncompressed size), falling back to a plain file."""
+        try:
+            st = os.stat(cachefile + ".gz")
+        except OSError:
+            return FlatFileStore.stat(self, cachefile)
+
+        # gzip keeps the uncompressed size (mod 2**32) in its last 4 bytes
+        try:
+            with open(cachefile + ".gz", "rb") as fp:
+                fp.seek(-4, os.SEEK_END)
+                size = struct.unpack("<I", fp.read(4))[0]
+        except (OSError, struct.error):
+            size = st.st_size
+        return st.st_mtime, size
+
+    def read(self, cachefile):
+        try:
+            with gzip.open(cachefile + ".gz", "rb") as fp:
+                content = fp.read()
+        except FileNotFoundError:
+            return FlatFileStore.read(self, cachefile)
+        except (OSError, EOFError) as e:
+            print("Corrupt cache entry", cachefile, ":", e, file=sys.stderr)
+            return None
+        self._used(cachefile)
+        return content
+
+    def write(self, cachefile, content):
+        gzfile = cachefile + ".gz"
+        try:
+            oldsize = os.stat(gzfile).st_size
+        except OSError:
+            oldsize = 0
+
+        write_atomically(gzfile, [ gzip.compress(
+            content, compresslevel=self.compresslevel) ])
+
+        # If there was an uncompressed copy from the flat layout,
+        # it's now out of date.
+        try:
+            os.unlink(cachefile)
+        except OSError:
+            pass
+
+        self._used(cachefile, os.stat(gzfile).st_size - oldsize)
+
+    def touch(self, cachefile):
+        if os.path.exists(cachefile + ".gz"):
+            os.utime(cachefile + ".gz")
+            self._used(cachefile)
+        else:
+            FlatFileStore.touch(self, cachefile)
+
+    def moved(self, renames):
+        """Carry the index's last-used times over to the new paths."""
+        with self.lock:
+            self._load_index()
+            for oldfile, newfile in renames:
+                atime = self.atimes.pop(
+                    os.path.relpath(oldfile + ".gz", self.rootdir), None)
+                if atime is not None:
+                    self.atimes[os.path.relpath(newfile + ".gz",
+                                                self.rootdir)] = atime
+            self._save_index()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Counters and latency histograms for the fetch layer,
+and a Prometheus text rendering of them for /api/metrics.
+
+Deliberately tiny, rather than depending on prometheus_client:
+billrequests calls
+    METRICS.inc(name, labels)
+    METRICS.observe(name, labels, seconds)
+and METRICS.prometheus_text() renders everything.
+Counts are per process, like everything else in billrequests.
+"""
+
+import threading
+
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+# Descriptions for the # HELP lines
+HELP = {
+    "billtracker_get_total":
+        "get() calls, by how they were answered",
+    "billtracker_coalesced_total":
+        "get() calls that waited for another thread's fetch of the same page",
+    "billtracker_head_total":
+        "head() calls, by how they were answered",
+    "billtracker_network_requests_total":
+        "HTTP requests actually sent, including retries",
+    "billtracker_network_errors_total":
+        "HTTP requests that failed to connect or timed out",
+    "billtracker_network_bytes_total":
+        "Body bytes received over the network",
+    "billtracker_network_seconds":
+        "Time for each HTTP request, to the end of the body if not streamed",
+    "billtracker_parse_seconds":
+        "Time spent parsing fetched pages",
+    "billtracker_dirlist_seconds":
+        "Time to fetch and parse each session directory listing",
+}
+
+
+def _labelkey(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _labelstr(labelkey, extra=()):
+    pairs = list(labelkey) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                                   .replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # name: { labelkey: value }
+            self.counters = {}
+            # name: { labelkey: [ bucket counts..., sum, count ] }
+            self.histograms = {}
+
+    def inc(self, name, labels, amount=1):
+        key = _labelkey(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = _labelkey(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = [0] * len(LATENCY_BUCKETS) + [0., 0]
+            hist = series[key]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def counter(self, name, labels):
+        """The current value of a counter (mostly for tests)."""
+        with self.lock:
+            return self.counters.get(name, {}).get(_labelkey(labels), 0)
+
+    def prometheus_text(self, gauges=None):
+        """Everything in Prometheus text exposition format.
+           gauges is an optional { name: (help, { labelkey: value }) }
+           of point-in-time values to include.
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines.append("# HELP %s %s" % (name, HELP.get(name, name)))
+                lines.append("# TYPE %s counter" % name)
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append("%s%s %s" % (name, _labelstr(key), value))
+
+            for name in sorted(self.histograms):
+                lines.append("# HELP %s %s" % (name, HELP.get(name, name)))
+                lines.append("# TYPE %s histogram" % name)
+                for key, hist in sorted(self.histograms[name].items()):
+                    for i, bound in enumerate(LATENCY_BUCKETS):
+                        lines.append("%s_bucket%s %d"
+                                     % (name,
+                                        _labelstr(key, [("le", bound)]),
+                                        hist[i]))
+                    lines.append("%s_bucket%s %d"
+                                 % (name, _labelstr(key, [("le", "+Inf")]),
+                                    hist[-1]))
+                    lines.append("%s_sum%s %f"
+                                 % (name, _labelstr(key), hist[-2]))
+                    lines.append("%s_count%s %d"
+                                 % (name, _labelstr(key), hist[-1]))
+
+        for name, (helpstr, series) in sorted((gauges or {}).items()):
+            lines.append("# HELP %s %s" % (name, helpstr))
+            lines.append("# TYPE %s gauge" % name)
+            for key, value in sorted(series.items()):
+                lines.append("%s%s %s" % (name, _labelstr(key), value))
+
+        return "\n".join(lines) + "\n"
+
+
+# The singleton
+METRICS = Metrics()
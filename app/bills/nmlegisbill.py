@@ -4,6 +4,9 @@ from __future__ import print_function
 
 from .billutils import year_to_2digit, billno_to_parts, URLmapper
 from . import billrequests
+from .fetchmetrics import METRICS
+from .parsememo import ParseMemo, body_hash
+from .allbillsstore import AllBillsStore, StoredAllBills
 
 # Scrape bill data from bill pages from nmlegis.org.
 
@@ -14,10 +17,15 @@ import re
 import posixpath
 from collections import OrderedDict
 from bs4 import BeautifulSoup
+import lxml.html
 import json
+import hashlib
+import sqlite3
 import xlrd
 import threading
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 
 # A bill pattern, allowing for any number of extra leading zeros
@@ -44,12 +52,44 @@ sponcode_pat = re.compile(r'.*/Legislator\?SponCode=([A-Z]+)')
 more_spon_links = r'MainContent_tabContainerLegislation_tabPanelSponsors_dataListSponsors_linkSponsor_.*'
 action_pat = re.compile(r"MainContent_gridViewLegislation_lblActions_[0-9]")
 
+# Parse the Legislation_List with lxml directly rather than BeautifulSoup,
+# which is much faster on a page with thousands of bills.
+# Set to False to go back to the BeautifulSoup parser.
+FAST_ALLBILLS_PARSER = True
+
 # Patterns used in parse_bill_page
 scheduled_for_pat = re.compile(r"Scheduled for.*on ([0-9/]*)")
 sponcode_pat = re.compile(r".*[&?]SponCode\=([A-Z]+)")
 cspat = re.compile(r"MainContent_dataListLegislationCommitteeSubstitutes_linkSubstitute.*")
 comsubpat = re.compile(r'MainContent_dataListLegislationCommitteeSubstitutes_linkSubstitute_.*')
 
+# Parsed bill pages are remembered in this file in billrequests.CACHEDIR
+# (see parsememo.py), so an unchanged page isn't parsed again.
+# None to parse every time.
+PARSE_MEMO_NAME = "parsememo.sqlite"
+
+# All processes share the all-bills lists through this file
+# in billrequests.CACHEDIR (see allbillsstore.py).
+# None to have each process read allbills_<yearcode>.json itself.
+ALLBILLS_STORE_NAME = "allbills.sqlite"
+
+# Bump this whenever parse_bill_soup changes what it returns,
+# so pages parsed by the old version get parsed again.
+BILL_PARSER_VERSION = 2
+
+# parse_bill_pages() can parse in a pool of this many worker
+# processes; 0 or 1 (the default) parses in the calling process.
+# Each worker imports the whole app, so it's only worth it with
+# several CPUs: the pool is started once per process and kept, and
+# only used for at least PARSE_POOL_MIN pages, and only while it has
+# been faster per page than parsing in the calling process.
+PARSE_WORKERS = 0
+PARSE_POOL_MIN = 8
+
+# The Python the workers run: None for sys.executable, which under
+# mod_wsgi may be the web server instead, so set it there.
+PARSE_PYTHON = None
+
 # RE patterns needed for parsing committee pages
 tbl_bills_scheduled = re.compile(r"MainContent_formViewCommitteeInformation_gridViewScheduledLegislation")
 
@@ -121,7 +161,32 @@ def legislator_summary_url(leg):
 # XXX Eventually parse_bill_page should be rendered obsolete,
 # once there's a way to get bill location and status from the
 # actions code in the Legislation_List page.
-def parse_bill_page(billno, yearcode, cache_locally=True, cachesecs=2*60*60):
+# dbfile: ParseMemo, or None if it couldn't be opened
+_parse_memos = {}
+_parse_memos_lock = threading.Lock()
+
+
+def parse_memo():
+    """The ParseMemo for the current cache directory, or None.
+       LOCAL_MODE (e.g. the tests) doesn't use one,
+       so as not to leave files among the fixtures.
+    """
+    if not PARSE_MEMO_NAME or billrequests.LOCAL_MODE:
+        return None
+    dbfile = os.path.join(billrequests.CACHEDIR, PARSE_MEMO_NAME)
+    with _parse_memos_lock:
+        if dbfile not in _parse_memos:
+            try:
+                _parse_memos[dbfile] = ParseMemo(dbfile)
+            except sqlite3.Error as e:
+                print("Couldn't open parse memo", dbfile, ":", e,
+                      file=sys.stderr)
+                _parse_memos[dbfile] = None
+        return _parse_memos[dbfile]
+
+
+def parse_bill_page(billno, yearcode, cache_locally=True, cachesecs=2*60*60,
+                    stale_ok=False):
     """Download and parse a bill's page on nmlegis.org.
        Yearcode is the session code, like 19 or 20s2.
 
@@ -135,20 +200,258 @@ def parse_bill_page(billno, yearcode, cache_locally=True, cachesecs=2*60*60):
        If cache_locally, will save downloaded files to local cache.
        Will try to read back from cache if the cache file isn't more
        than 2 hours old.
+       If stale_ok, an older cache file will do for now (see billrequests).
+       If the page is the same as the last time this bill was parsed,
+       the last result is reused (see parse_memo()).
 
        Does *not* save anything to the flask database.
     """
+    billdic = new_billdic(billno, yearcode)
+    baseurl = bill_url(billno, yearcode)
+
+    cachefile = billrequests.url_to_cache_filename(baseurl, billdic)
+    response = billrequests.get(baseurl, cachefile=cachefile,
+                                cachesecs=cachesecs, stale_ok=stale_ok)
+    if response.status_code != 200:
+        print(billno, "Couldn't fetch bill page: status",
+              response.status_code, "on", baseurl, file=sys.stderr)
+        return None
+
+    memo = parse_memo()
+    if memo:
+        bodyhash = body_hash(response.content, BILL_PARSER_VERSION)
+        parsed = recall_parse(memo, billno, yearcode, bodyhash)
+        if parsed:
+            return parsed
+
+    # Not parsed_soup(): a bill page's soup is used only once,
+    # so keeping it would just crowd out the listings.
+    unchecked = []
+    billdic = parse_bill_soup(billdic, baseurl,
+                              billrequests.timed_soup(response),
+                              _check_later(unchecked))
+    if not billdic:
+        return billdic
+
+    if memo:
+        remember_parse(memo, bodyhash, billdic, unchecked)
+    check_links(billdic, unchecked)
+
+    return billdic
+
+
+def new_billdic(billno, yearcode):
+    """The start of a billdic, before its page is parsed."""
     billdic = { 'billno': billno }
     (billdic['chamber'], billdic['billtype'], billdic['number']) \
         = billno_to_parts(billno)
     billdic['year'] = yearcode
+    return billdic
+
+
+def remember_parse(memo, bodyhash, billdic, unchecked):
+    """Save a parsed billdic in the memo, without its update_date,
+       along with the links the parser wanted checked, unchecked.
+       Whether those exist can change while the page stays the same,
+       so the billdic should be remembered before check_links().
+    """
+    parsed = dict(billdic)
+    del parsed['update_date']
+    parsed['_unchecked'] = unchecked
+    try:
+        memo.record(billdic['billno'], billdic['year'], bodyhash, parsed)
+    except sqlite3.Error as e:
+        print("Couldn't save parse of", billdic['billno'], ":", e,
+              file=sys.stderr)
+
+
+def recall_parse(memo, billno, yearcode, bodyhash):
+    """The billdic remembered for a page with bodyhash, with its links
+       checked again and a new update_date, or None.
+    """
+    parsed = memo.lookup(billno, yearcode, bodyhash)
+    if not parsed:
+        return None
+    check_links(parsed, parsed.pop('_unchecked', []))
+    parsed['update_date'] = datetime.datetime.now()
+    return parsed
+
+
+def _check_later(unchecked):
+    """An html_exists for parse_bill_soup() that doesn't check,
+       just adds the url to the list unchecked, for check_links().
+    """
+    def html_exists(url):
+        unchecked.append(url)
+        return False
+    return html_exists
+
+
+def check_links(billdic, unchecked):
+    """Check the links that parse_bill_soup() wanted checked.
+       The only one is an HTML version of a PDF committee sub,
+       to use instead.
+    """
+    for url in unchecked:
+        if billrequests.head(url).status_code == 200:
+            billdic['amendlink'] = url
+
+
+def _parse_bill_bytes(billdic, baseurl, content):
+    """Parse a bill page's raw bytes, in a parse_bill_pages() worker.
+       Return (billdic, urls), where urls are the links the parser
+       wanted checked with a HEAD request, which the parent does
+       so the worker needn't touch billrequests.
+    """
+    unchecked = []
+    soup = BeautifulSoup(content.decode(errors="replace"), "lxml")
+    return parse_bill_soup(billdic, baseurl, soup,
+                           _check_later(unchecked)), unchecked
+
 
-    baseurl = 'https://www.nmlegis.gov/Legislation/Legislation?chamber=%s&legtype=%s&legno=%s&year=%s' \
-        % (billdic['chamber'], billdic['billtype'],
-           billdic['number'], billdic['year'])
+# The pool for parse_bill_pages(): None until it's needed,
+# False if it can't be used in this process.
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
 
-    soup = billrequests.soup_from_cache_or_net(baseurl, billdic,
-                                               cachesecs=cachesecs)
+# Recent seconds per page parsed, in the pool and in this process.
+_parse_secs_per_page = { "pool": None, "serial": None }
+
+
+def parse_pool():
+    """The worker pool for parse_bill_pages(), started the first time
+       it's asked for, or None if there isn't one.
+    """
+    global _parse_pool
+
+    if not PARSE_WORKERS or PARSE_WORKERS < 2:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            python = PARSE_PYTHON or sys.executable
+            if not python or "python" not in os.path.basename(python):
+                print("Not starting parse workers: %s isn't python;"
+                      " set PARSE_PYTHON" % python, file=sys.stderr)
+                _parse_pool = False
+                return None
+            # spawn, not fork: the parent has threads (and their locks)
+            # that a forked child would inherit in whatever state
+            # they're in.
+            context = multiprocessing.get_context("spawn")
+            context.set_executable(python)
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                              mp_context=context)
+        return _parse_pool or None
+
+
+def _record_parse_time(how, seconds, pages):
+    """Remember how long parsing pages took, "pool" or "serial"."""
+    if not pages:
+        return
+    per_page = seconds / pages
+    if _parse_secs_per_page[how] is None:
+        _parse_secs_per_page[how] = per_page
+    else:
+        _parse_secs_per_page[how] = .7 * _parse_secs_per_page[how] \
+            + .3 * per_page
+
+
+def _pool_is_faster():
+    """Whether the pool has been faster per page than parsing here;
+       True until there's a time for both.
+    """
+    pool = _parse_secs_per_page["pool"]
+    serial = _parse_secs_per_page["serial"]
+    return pool is None or serial is None or pool < serial
+
+
+def parse_bill_pages(billnos, yearcode, cachesecs=2*60*60):
+    """Fetch and parse the pages for many bills, for bulk refreshes.
+       Pages are fetched several at a time, and with PARSE_WORKERS
+       set, may be parsed in a pool of worker processes.
+       Return a list of billdics as from parse_bill_page(),
+       in the same order as billnos, with None for any bill
+       that couldn't be fetched or parsed.
+       Like parse_bill_page(), it doesn't touch the flask database.
+    """
+    billdics = {}
+    baseurls = {}
+    items = []
+    for billno in billnos:
+        try:
+            billdics[billno] = new_billdic(billno, yearcode)
+        except RuntimeError:
+            continue
+        baseurls[billno] = bill_url(billno, yearcode)
+        items.append((baseurls[billno], billdics[billno]))
+    billnos_by_url = { url: billno for billno, url in baseurls.items() }
+
+    memo = parse_memo()
+    results = {}
+    bodyhashes = {}
+    toparse = []
+    for url, response in billrequests.get_many(items, cachesecs=cachesecs):
+        billno = billnos_by_url[url]
+        if response.status_code != 200:
+            print(billno, "Couldn't fetch bill page: status",
+                  response.status_code, "on", url, file=sys.stderr)
+            continue
+        if memo:
+            bodyhashes[billno] = body_hash(response.content,
+                                           BILL_PARSER_VERSION)
+            parsed = recall_parse(memo, billno, yearcode, bodyhashes[billno])
+            if parsed:
+                results[billno] = parsed
+                continue
+        toparse.append((billdics[billno], url, response.content))
+
+    global _parse_pool
+    parses = None
+    if len(toparse) >= PARSE_POOL_MIN and _pool_is_faster():
+        # The first batch also pays for starting the workers,
+        # so it isn't a fair time.
+        starting = _parse_pool is None
+        pool = parse_pool()
+        if pool:
+            start = time.perf_counter()
+            try:
+                parses = list(pool.map(_parse_bill_bytes, *zip(*toparse),
+                                       chunksize=8))
+                if not starting:
+                    _record_parse_time("pool", time.perf_counter() - start,
+                                       len(toparse))
+            except Exception as e:
+                print("Parse workers failed, parsing in this process"
+                      " from now on:", e, file=sys.stderr)
+                pool.shutdown(wait=False, cancel_futures=True)
+                _parse_pool = False
+    if parses is None:
+        start = time.perf_counter()
+        parses = [ _parse_bill_bytes(*args) for args in toparse ]
+        _record_parse_time("serial", time.perf_counter() - start,
+                           len(toparse))
+
+    for (billdic, unchecked) in parses:
+        if not billdic:
+            continue
+        if memo:
+            remember_parse(memo, bodyhashes[billdic['billno']], billdic,
+                           unchecked)
+        check_links(billdic, unchecked)
+        results[billdic['billno']] = billdic
+
+    return [ results.get(billno) for billno in billnos ]
+
+
+def parse_bill_soup(billdic, baseurl, soup, html_exists=None):
+    """Parse the soup of a bill's page, fetched from baseurl.
+       billdic already has billno, chamber, billtype, number and year;
+       fill in the rest as described in parse_bill_page()
+       and return it, or None if the page isn't a bill page.
+       html_exists(url) says whether there's an HTML version of a
+       committee sub PDF; by default, ask the server.
+    """
+    billno = billdic['billno']
 
     # If something failed -- for instance, if we got an empty file
     # or an error page -- then the title span won't be there.
@@ -279,7 +582,10 @@ def parse_bill_page(billno, yearcode, cache_locally=True, cachesecs=2*60*60):
             # in the same directory. See if there is:
             if billdic['amendlink'].endswith('.pdf'):
                 html_cs = re.sub('.pdf', '.html', billdic['amendlink'])
-                if billrequests.head(html_cs).status_code == 200:
+                if html_exists:
+                    if html_exists(html_cs):
+                        billdic['amendlink'] = html_cs
+                elif billrequests.head(html_cs).status_code == 200:
                     billdic['amendlink'] = html_cs
 
     # Bills have an obscure but useful actiontext code, e.g.
@@ -348,6 +654,28 @@ def parse_bill_page(billno, yearcode, cache_locally=True, cachesecs=2*60*60):
     return billdic
 
 
+def fetch_bill_pages(billnos, yearcode, cachesecs=2*60*60):
+    """Make sure the cached pages for a list of bills are fresh,
+       fetching any that aren't several at a time.
+       A parse_bill_page() on any of them afterward won't have to
+       wait for the network.
+       Returns a list of billnos that couldn't be fetched.
+    """
+    items = []
+    failed = []
+    for billno in billnos:
+        try:
+            items.append((bill_url(billno, yearcode),
+                          { 'billno': billno, 'year': yearcode }))
+        except RuntimeError:
+            failed.append(billno)
+    billnos_by_url = { url: billdic['billno'] for url, billdic in items }
+    for url, response in billrequests.get_many(items, cachesecs=cachesecs):
+        if response.status_code != 200:
+            failed.append(billnos_by_url[url])
+    return failed
+
+
 def update_legislative_session_list():
     """Read the list of legislative sessions from the legislative website.
        Return a list of dictionaries that include at least these keys:
@@ -451,13 +779,64 @@ g_allbills = { "_schema": '20230204' }
 #      "status": "",
 #      "history": [ ["2023-01-30", "Introduced", "ORIGINAL TITLE"],
 #                   ["2023-02-02", "titlechanged", "CUR TITLE" ] ]
+#    },
+#    "_rowhashes": { "HB17": "0123456789abcdef", ... }
+# _rowhashes are hashes of each bill's row in Legislation_List
+# the last time update_allbills() read it, so it only has to
+# look at what changed since.
 
 # It's saved as JSON in these files (index by yearcode):
 g_allbills_cachefile = {}
 
+# What update_bill_links() saw in each directory listing last time,
+# so it only has to look at what changed since, indexed by yearcode:
+# {
+#   "https://www.nmlegis.gov/Sessions/23%20Regular/firs": {
+#     "HB0017.PDF": [ 123456, "1/30/2023\t5:23 PM MST" ], ...
+#   }, ...
+# }
+# Thousands of files, none of them needed to show a bill,
+# so it's kept out of g_allbills, in dirlists_<yearcode>.json.
+g_dirlists = {}
+
+# and, unless there's no ALLBILLS_STORE_NAME, published to an
+# AllBillsStore that all processes read. Then g_allbills[yearcode]
+# only exists while the list is being updated, and all_bills()
+# returns a StoredAllBills instead.
+# dbfile: AllBillsStore, or None if it couldn't be opened
+_allbills_stores = {}
+# (dbfile, yearcode): StoredAllBills
+_allbills_views = {}
+_allbills_stores_lock = threading.Lock()
+
+
+def stored_allbills(yearcode):
+    """The StoredAllBills for yearcode in the current cache directory,
+       or None if the lists are kept in g_allbills instead.
+       Like parse_memo(), LOCAL_MODE doesn't use the store.
+    """
+    if not ALLBILLS_STORE_NAME or billrequests.LOCAL_MODE:
+        return None
+    dbfile = os.path.join(billrequests.CACHEDIR, ALLBILLS_STORE_NAME)
+    with _allbills_stores_lock:
+        if dbfile not in _allbills_stores:
+            try:
+                _allbills_stores[dbfile] = AllBillsStore(dbfile)
+            except sqlite3.Error as e:
+                print("Couldn't open allbills store", dbfile, ":", e,
+                      file=sys.stderr)
+                _allbills_stores[dbfile] = None
+        if not _allbills_stores[dbfile]:
+            return None
+        if (dbfile, yearcode) not in _allbills_views:
+            _allbills_views[(dbfile, yearcode)] = StoredAllBills(
+                _allbills_stores[dbfile], yearcode)
+        return _allbills_views[(dbfile, yearcode)]
+
 
 def save_allbills_json(yearcode):
-    """Save g_allbills to the JSON cachefile.
+    """Save g_allbills to the JSON cachefile, and the shared store
+       if there is one.
        This should be called after creating g_allbills_lockfile first,
        which should be removed/unlocked afterward.
     """
@@ -487,6 +866,53 @@ def save_allbills_json(yearcode):
         print("*** Problem saving allbills cache file for yearcode", yearcode,
               ":", e, file=sys.stderr)
 
+    view = stored_allbills(yearcode)
+    if view is not None:
+        try:
+            generation = view.store.replace(yearcode, g_allbills[yearcode])
+            print("Published allbills", yearcode, "generation", generation,
+                  file=sys.stderr)
+        except sqlite3.Error as e:
+            print("*** Problem publishing allbills for yearcode", yearcode,
+                  ":", e, file=sys.stderr)
+
+
+def dirlists_cachefile(yearcode):
+    return os.path.join(billrequests.CACHEDIR, 'dirlists_%s.json' % yearcode)
+
+
+def load_dirlists(yearcode):
+    """Read what update_bill_links() saw last time from its cachefile,
+       which another process may have written since.
+       Older allbills files kept it in g_allbills[yearcode]["_dirlists"].
+    """
+    oldlistings = None
+    if yearcode in g_allbills:
+        oldlistings = g_allbills[yearcode].pop("_dirlists", None)
+    try:
+        with open(dirlists_cachefile(yearcode)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print("Couldn't read", dirlists_cachefile(yearcode), ":", e,
+              file=sys.stderr)
+    return oldlistings or {}
+
+
+def save_dirlists(yearcode):
+    """Save g_dirlists[yearcode], if update_bill_links() has set it."""
+    if yearcode not in g_dirlists:
+        return
+    cachefile = dirlists_cachefile(yearcode)
+    try:
+        tmpfile = cachefile + ".tmp"
+        with open(tmpfile, "w") as fp:
+            json.dump(g_dirlists[yearcode], fp)
+        os.rename(tmpfile, cachefile)
+    except Exception as e:
+        print("*** Problem saving", cachefile, ":", e, file=sys.stderr)
+
 
 def update_allbills_if_needed(yearcode, sessionid=None, force_update=False):
     """Decide whether we need to re-read the allbills json file,
@@ -501,18 +927,32 @@ def update_allbills_if_needed(yearcode, sessionid=None, force_update=False):
         g_allbills_cachefile[yearcode] = '%s/allbills_%s.json' % (
             billrequests.CACHEDIR, yearcode)
 
-    if yearcode not in g_allbills:
+    view = stored_allbills(yearcode)
+    if view is None and yearcode not in g_allbills:
         g_allbills[yearcode] = {}
 
     try:
         filetime = os.stat(g_allbills_cachefile[yearcode]).st_mtime
 
+        if view is not None:
+            # The store is shared, so there's nothing to read unless
+            # it has never had this session's list, or the cache file
+            # was saved without being published (or after).
+            # Checking the generation also drops anything the view
+            # cached from an older list.
+            if not view.refresh() or filetime > view.replaced_at:
+                print("Filling the allbills store from cache file",
+                      file=sys.stderr)
+                with open(g_allbills_cachefile[yearcode]) as fp:
+                    view.store.replace(yearcode, json.load(fp))
+                view.refresh()
+
         # Is the cachefile newer than g_allbills in memory? Read it in.
         # Need this even if we're going to update it, because we don't
         # want to lose the accumulated history entries.
         # Also initialize if g_allbills hasn't been initialized yet
         # in this session, _updated will be 0.
-        if (yearcode not in g_allbills or
+        elif (yearcode not in g_allbills or
             "_updated" not in g_allbills[yearcode] or
             filetime > g_allbills[yearcode]["_updated"]):
             print("Refreshing g_allbills from cache file", file=sys.stderr)
@@ -535,15 +975,15 @@ def update_allbills_if_needed(yearcode, sessionid=None, force_update=False):
 
     # Make sure there's a sessionid either as an argument or in
     # g_allbills. If neither, return.
-    try:
+    if not sessionid:
+        current = g_allbills[yearcode] if view is None else view
+        sessionid = current.get("_sessionid")
         if not sessionid:
-            sessionid = g_allbills[yearcode]["_sessionid"]
-        elif "_sessionid" not in g_allbills[yearcode]:
-            g_allbills[yearcode]["_sessionid"] = sessionid
-    except KeyError:
-        print("ERROR: Can't update_allbills without sessionid",
-              file=sys.stderr)
-        return
+            print("ERROR: Can't update_allbills without sessionid",
+                  file=sys.stderr)
+            return
+    elif view is None and "_sessionid" not in g_allbills[yearcode]:
+        g_allbills[yearcode]["_sessionid"] = sessionid
 
     # Is g_allbills cachefile too old and needs to be updated?
     # Or is force_update specified?
@@ -562,6 +1002,12 @@ def update_allbills_if_needed(yearcode, sessionid=None, force_update=False):
         print("Opened the lockfile", g_allbills_lockfile[yearcode],
               file=sys.stderr)
 
+        # Updating needs the whole list in memory, in this process only.
+        if view is not None:
+            g_allbills[yearcode] = view.store.load(yearcode)
+            if "_sessionid" not in g_allbills[yearcode]:
+                g_allbills[yearcode]["_sessionid"] = sessionid
+
         # If there isn't already a g_allbills[yearcode],
         # then we have to wait until it's created.
         # But if there is one, start an update in the background.
@@ -572,7 +1018,10 @@ def update_allbills_if_needed(yearcode, sessionid=None, force_update=False):
         if g_allbills[yearcode]:
             print("Updating allbills in the FOREGROUND for",
                   yearcode, file=sys.stderr)
-            update_allbills(yearcode, sessionid)
+            # Someone may be waiting on this page, so a stale
+            # Legislation_List is better than waiting on nmlegis,
+            # unless this was an explicit refresh.
+            update_allbills(yearcode, sessionid, stale_ok=not force_update)
 
             # print("Updating all_bills in the background ...",
             #       file=sys.stderr)
@@ -585,6 +1034,12 @@ def update_allbills_if_needed(yearcode, sessionid=None, force_update=False):
                   "yet; updating in foreground", file=sys.stderr)
             update_allbills(yearcode, sessionid)
 
+        # It's in the store now; other readers will see the new
+        # generation, and this process doesn't need its own copy.
+        if view is not None:
+            g_allbills.pop(yearcode, None)
+            view.refresh()
+
         return
 
     except FileExistsError:
@@ -602,13 +1057,38 @@ def update_allbills_if_needed(yearcode, sessionid=None, force_update=False):
                   "seconds", file=sys.stderr)
 
 
+def refresh_reason(billinfo, title, actioncode):
+    """Does a bill's page need to be parsed again?
+       Compare what the database has for the bill (title, and the
+       action code from Bill.get_actioncode()) with billinfo,
+       its entry in g_allbills, which comes from Legislation_List.
+       Return "new", "unlisted", "title" or "actions" saying why it needs
+       a refresh, or None if nothing seems to have changed.
+    """
+    if not billinfo:
+        return "unlisted"
+    if not actioncode:
+        return "new"
+    if "title" in billinfo and billinfo["title"] != title:
+        return "title"
+    # Legislation_List and the bill page space the codes differently.
+    if "actions" in billinfo and \
+       billinfo["actions"].split() != actioncode.split():
+        return "actions"
+    return None
+
+
 def bill_info(billno, yearcode, sessionid):
     """Return a dictionary for a single bill.
-       The info comes from g_allbills and should be updated as needed.
+       The info comes from the shared store or g_allbills
+       and should be updated as needed.
     """
     update_allbills_if_needed(yearcode, sessionid)
 
     try:
+        view = stored_allbills(yearcode)
+        if view is not None:
+            return view[billno]
         return g_allbills[yearcode][billno]
     except:
         return None
@@ -621,88 +1101,167 @@ def all_bills(sessionid, yearcode):
        Mostly this comes from cached files, but periodically those
        cached files will be updated from the Legislation_List URL.
 
-       Returns g_allbills[yearcode]
+       Returns g_allbills[yearcode], or with a shared store,
+       a StoredAllBills that reads bills from it as needed
+       (use items() to go through them all).
     """
     # if yearcode not in g_leg_sessions:
     #     g_leg_sessions[yearcode] = sessionid
 
     update_allbills_if_needed(yearcode, sessionid)
 
+    view = stored_allbills(yearcode)
+    if view is not None:
+        return view
     return g_allbills[yearcode]
 
 
-def update_allbills(yearcode, sessionid):
-    """Fetch and parse Legislation_List?Session=NN (numeric session id)
-       to update the global g_allbills[yearcode]
-       and save to g_allbills_cachefile
-       (which should already be initialized with existing bills).
+def allbills_rows_soup(soup):
+    """Yield a dict for each bill in a BeautifulSoup of Legislation_List:
+       billno, href (relative to the Legislation directory), title,
+       sponsor_hrefs (a list) and actions (None if there weren't any).
+       Rows that aren't bills are skipped.
+       Returns None if there's no bill table.
     """
-    print("Updating allbills", yearcode, file=sys.stderr)
-
-    baseurl = 'https://www.nmlegis.gov/Legislation'
-    url = baseurl + '/Legislation_List?Session=%2d' % sessionid
-
-    today = datetime.date.today()
-    todaystr = today.strftime("%Y-%m-%d")
-
-    # re-fetch if needed. Pass a cache time that's a little less than
-    # the one we're using for the allbills cachefile
-    soup = billrequests.soup_from_cache_or_net(
-        url, cachesecs=billrequests.CACHESECS-60)
-    if not soup:
-        print("Couldn't fetch all bills: no soup", file=sys.stderr)
-        return None, None
-
     footable = soup.find('table', id='MainContent_gridViewLegislation')
     # footable is nmlegis' term for this bill table. Not my fault. :-)
     if not footable:
-        print("Can't read the all-bills list: no footable", file=sys.stderr)
-        return
+        return None
 
+    rows = []
     for tr in footable.find_all('tr'):
         billno_a = tr.find('a', id=allbills_billno_pat)
         title_span = tr.find('span', id=title_pat)
         if not billno_a or not title_span:
             continue
+        action_span = tr.find('span', id=action_pat)
+        rows.append({
+            # Text under the link might be something like "HB  1"
+            # or might have stars, so remove spaces and stars:
+            "billno": billno_a.text.replace(' ', '').replace('*', ''),
+            "href": billno_a['href'],
+            "title": title_span.text,
+            "sponsor_hrefs": [ a["href"]
+                               for a in tr.find_all("a", id=sponsor_pat) ],
+            "actions": action_span.text if action_span else None
+        })
+    return rows
+
+
+def allbills_rows_lxml(html):
+    """The same as allbills_rows_soup, but from the HTML text,
+       using lxml and looking only at the rows of the bill table.
+    """
+    tree = lxml.html.fromstring(html)
+    tables = tree.xpath('//table[@id="MainContent_gridViewLegislation"]')
+    if not tables:
+        return None
 
-        # Text under the link might be something like "HB  1"
-        # or might have stars, so remove spaces and stars:
-        billno_str = billno_a.text.replace(' ', '').replace('*', '')
+    rows = []
+    for tr in tables[0].iter('tr'):
+        billno_a = None
+        title_span = None
+        action_span = None
+        sponsor_hrefs = []
+        # Like BeautifulSoup's find() with an id pattern,
+        # take the first element whose id matches.
+        for el in tr.iter('a', 'span'):
+            elid = el.get('id')
+            if not elid:
+                continue
+            if el.tag == 'a':
+                if billno_a is None and allbills_billno_pat.search(elid):
+                    billno_a = el
+                if sponsor_pat.search(elid):
+                    sponsor_hrefs.append(el.get('href'))
+            else:
+                if title_span is None and title_pat.search(elid):
+                    title_span = el
+                if action_span is None and action_pat.search(elid):
+                    action_span = el
+        if billno_a is None or title_span is None:
+            continue
+        rows.append({
+            "billno": billno_a.text_content().replace(' ', '')
+                                             .replace('*', ''),
+            "href": billno_a.get('href'),
+            "title": title_span.text_content(),
+            "sponsor_hrefs": sponsor_hrefs,
+            "actions": action_span.text_content() if action_span is not None
+                       else None
+        })
+    return rows
+
+
+def allbills_row_hash(row):
+    """A short hash of a row from allbills_rows_soup/allbills_rows_lxml,
+       to tell whether anything in it changed.
+    """
+    return hashlib.sha1(json.dumps(row, sort_keys=True).encode()) \
+                  .hexdigest()[:16]
+
+
+def apply_allbills_rows(yearcode, rows):
+    """Update g_allbills[yearcode] from Legislation_List rows
+       as from allbills_rows_soup() or allbills_rows_lxml().
+       Rows that are the same as last time, according to the hashes
+       in g_allbills[yearcode]["_rowhashes"], are skipped.
+       Return a list of billnos that are new or changed.
+    """
+    baseurl = 'https://www.nmlegis.gov/Legislation'
+    today = datetime.date.today()
+    todaystr = today.strftime("%Y-%m-%d")
+
+    rowhashes = g_allbills[yearcode].setdefault("_rowhashes", {})
+    changed = []
+
+    for row in rows:
+        billno_str = row["billno"]
+
+        # Skip rows that haven't changed since last time.
+        rowhash = allbills_row_hash(row)
+        if billno_str in g_allbills[yearcode] and \
+           rowhashes.get(billno_str) == rowhash:
+            continue
+        rowhashes[billno_str] = rowhash
+        changed.append(billno_str)
 
         # Add this billno and billurl to the global list if not there already.
         # Don't know the contents or amend urls yet, so leave blank.
         if billno_str not in g_allbills[yearcode]:
             g_allbills[yearcode][billno_str] = {
-                "history": [ [ todaystr, "introduced", title_span.text ] ]
+                "history": [ [ todaystr, "introduced", row["title"] ] ]
             }
 
         # Update history if title changed.
         if "title" in g_allbills[yearcode][billno_str] and \
-           title_span.text != g_allbills[yearcode][billno_str]["title"]:
+           row["title"] != g_allbills[yearcode][billno_str]["title"]:
             if "history" not in g_allbills[yearcode][billno_str]:
                 g_allbills[yearcode][billno_str]["history"] = []
             g_allbills[yearcode][billno_str]["history"].append( [
-                todaystr, "titlechanged", title_span.text ])
+                todaystr, "titlechanged", row["title"] ])
 
-        g_allbills[yearcode][billno_str]["title"] = title_span.text
+        g_allbills[yearcode][billno_str]["title"] = row["title"]
 
         g_allbills[yearcode][billno_str]["url"] = \
-            baseurl + "/" + billno_a['href']
+            baseurl + "/" + row["href"]
 
         # Build sponsor list, replacing what was there before
         # since it might have changed
         g_allbills[yearcode][billno_str]["sponsors"] = []
-        for sponsor_a in tr.find_all("a", id=sponsor_pat):
+        for sponsor_href in row["sponsor_hrefs"]:
             try:
                 g_allbills[yearcode][billno_str]["sponsors"].append(
-                    sponcode_pat.match(sponsor_a["href"]).group(1))
+                    sponcode_pat.match(sponsor_href).group(1))
             except:
-                print("Couldn't match sponcode in", sponsor_a["href"],
+                print("Couldn't match sponcode in", sponsor_href,
                       file=sys.stderr)
 
         # Action codes
         try:
-            actions = tr.find('span', id=action_pat).text
+            actions = row["actions"]
+            if actions is None:
+                raise ValueError("No actions")
             g_allbills[yearcode][billno_str]["actions"] = actions
 
             # Try to determine if this is a dummy bill.
@@ -729,7 +1288,7 @@ def update_allbills(yearcode, sessionid):
                 dummy_plus_pat.match(actions)):
                 g_allbills[yearcode][billno_str]["dummy"] = todaystr
                 g_allbills[yearcode][billno_str]["history"].append(
-                    [ todaystr, "dummyactivated", title_span.text ])
+                    [ todaystr, "dummyactivated", row["title"] ])
 
         except:
             print("Couldn't get actions for", billno_str, file=sys.stderr)
@@ -740,6 +1299,61 @@ def update_allbills(yearcode, sessionid):
             g_allbills[yearcode][billno_str]["overview"] = bill_overview_url(
                 billno_str, yearcode)
 
+    return changed
+
+
+def update_allbills(yearcode, sessionid, stale_ok=False):
+    """Fetch and parse Legislation_List?Session=NN (numeric session id)
+       to update the global g_allbills[yearcode]
+       and save to g_allbills_cachefile
+       (which should already be initialized with existing bills).
+       If stale_ok, an old Legislation_List will do while a fresh one
+       is fetched in the background; the allbills file is then
+       marked as needing another update.
+       Return a list of the billnos that are new or whose row
+       in Legislation_List changed, or None if it couldn't be read.
+    """
+    print("Updating allbills", yearcode, file=sys.stderr)
+
+    baseurl = 'https://www.nmlegis.gov/Legislation'
+    url = baseurl + '/Legislation_List?Session=%2d' % sessionid
+
+    # re-fetch if needed. Pass a cache time that's a little less than
+    # the one we're using for the allbills cachefile
+    cachefile = billrequests.url_to_cache_filename(url)
+    response = billrequests.get(url, cachefile=cachefile,
+                                cachesecs=billrequests.CACHESECS-60,
+                                stale_ok=stale_ok)
+    if response.status_code != 200:
+        print("Couldn't fetch all bills: status", response.status_code,
+              file=sys.stderr)
+        return None
+    # Note this now: by the time the links are updated, the refresh
+    # may well have finished.
+    listing_was_stale = response.stale
+
+    rows = None
+    if FAST_ALLBILLS_PARSER:
+        try:
+            rows = allbills_rows_lxml(response.text)
+        except Exception as e:
+            print("Fast parser couldn't read the all-bills list:", e,
+                  file=sys.stderr)
+    if rows is None:
+        soup = billrequests.parsed_soup(cachefile, response)
+        if not soup:
+            print("Couldn't fetch all bills: no soup", file=sys.stderr)
+            return None
+        rows = allbills_rows_soup(soup)
+
+    if rows is None:
+        print("Can't read the all-bills list: no footable", file=sys.stderr)
+        return None
+
+    changed = apply_allbills_rows(yearcode, rows)
+    print(len(changed), "of", len(rows), "bills are new or changed",
+          file=sys.stderr)
+
     # If there are new bills, they'll need content links too.
     # Update them in the background since it involves a lot of fetching
     # from nmlegis, and so will hang for a while when nmlegis goes down.
@@ -753,17 +1367,37 @@ def update_allbills(yearcode, sessionid):
     # the cache file, or otherwise it should run in the foreground.
     # XXX To avoid all the fetching, the html dirlists should be cached locally.
     print("Updating bill links in FOREGROUND", file=sys.stderr)
-    update_bill_links(yearcode)
+    linkchanges = update_bill_links(yearcode)
+    for listingurl in linkchanges:
+        print("Changed in", listingurl, ":",
+              ", ".join("%d %s" % (len(linkchanges[listingurl][k]), k)
+                        for k in ("added", "modified", "removed")),
+              file=sys.stderr)
 
     # Now bills and links should be up to date,
     # as should g_allbills[yearcode]
     g_allbills[yearcode]["_updated"] = int(time.time())
     save_allbills_json(yearcode)
+    # Only after the links they led to are saved:
+    save_dirlists(yearcode)
+
+    # If that was from a stale Legislation_List, backdate the allbills
+    # file so the next request (in any process) updates it again,
+    # by which time the fresh list should be in the cache.
+    if listing_was_stale:
+        print("allbills used a stale Legislation_List, will update again",
+              file=sys.stderr)
+        backdate = time.time() - billrequests.CACHESECS - 1
+        try:
+            os.utime(g_allbills_cachefile[yearcode], (backdate, backdate))
+        except OSError as e:
+            print("Couldn't backdate", g_allbills_cachefile[yearcode], e,
+                  file=sys.stderr)
 
     print("Finished updating allbills; clearing lockfile", file=sys.stderr)
     os.unlink(g_allbills_lockfile[yearcode])
 
-    return g_allbills
+    return changed
 
 
 # Updating the list of bills doesn't update the links to bill
@@ -774,11 +1408,43 @@ def update_allbills(yearcode, sessionid):
 # https://www.nmlegis.gov/Sessions/20%20Special2/bills/senate/SB0001.HTML
 # https://www.nmlegis.gov/Sessions/21%20Regular/Amendments_In_Context/SR01.pdf
 
+def dirlist_changes(oldlisting, dirlist):
+    """Compare a directory listing from get_html_dirlist() to
+       oldlisting, { name: [size, "Last Modified"] } from last time.
+       Return (newlisting, changed, removed):
+       newlisting in the same form as oldlisting,
+       changed, the entries of dirlist that are new or have a different
+       size or modification time, in listing order,
+       and removed, the names in oldlisting that aren't there any more.
+    """
+    newlisting = {}
+    changed = []
+    for l in dirlist:
+        name = l['name']
+        newlisting[name] = [ l['size'], l['Last Modified'] ]
+        if oldlisting.get(name) != newlisting[name]:
+            changed.append(l)
+    removed = [ name for name in oldlisting if name not in newlisting ]
+    return newlisting, changed, removed
+
+
 def update_bill_links(yearcode):
     """Update all relevant bill links found as files at
        https://www.nmlegis.gov/Sessions/23%20Regular/bills/chamber
        where chamber is house or senate.
        Modify g_allbills.
+
+       Only files that are new or changed since the last time
+       (according to load_dirlists(yearcode)) are looked at, along
+       with the other files for the same bills. What was seen this
+       time is left in g_dirlists[yearcode] for save_dirlists().
+       Files for bills not yet in g_allbills aren't remembered,
+       so they'll be looked at again once the bill shows up.
+       Return the changes, { listingurl: { "added": [names],
+       "modified": [names], "removed": [names] } } for each
+       directory where anything changed.
+       Files that were removed are reported, but links to them
+       are left in g_allbills.
     """
     if len(yearcode) == 2:
         sessionlong = "Regular"
@@ -814,6 +1480,60 @@ def update_bill_links(yearcode):
     dirs_by_chamber = [ "bills", "memorials", "resolutions" ]
     chambers = [ "house", "senate" ]
 
+    # Fetch all the listings at once, since each can take a while
+    # when nmlegis is busy; then go through them in a fixed order.
+    listingurls = [ posixpath.join(baseurl, dirtype)
+                    for dirtype in dirs_direct ]
+    for dirtype in dirs_by_chamber:
+        for chamber in chambers:
+            listingurls.append(posixpath.join(baseurl, dirtype, chamber))
+    listingurls.append(posixpath.join(baseurl, "Tabled_Reports"))
+
+    dirlists = {}
+    timings = []
+    start = time.monotonic()
+    for listingurl, dirlist, secs in \
+            billrequests.get_html_dirlists(listingurls):
+        dirlists[listingurl] = dirlist
+        dirname = listingurl[len(baseurl)+1:]
+        timings.append((secs, dirname))
+        METRICS.observe("billtracker_dirlist_seconds", { "dir": dirname },
+                        secs)
+    print("Fetched %d directory listings in %.1f sec:"
+          % (len(dirlists), time.monotonic() - start),
+          ", ".join("%s %.2f" % (dirname, secs)
+                    for secs, dirname in sorted(timings, reverse=True)),
+          file=sys.stderr)
+
+    oldlistings = load_dirlists(yearcode)
+    newlistings = {}
+    changes = {}
+
+    def changed_entries(listingurl, dirlist):
+        """Return the entries in dirlist that changed since last time,
+           and note the changes.
+        """
+        oldlisting = oldlistings.get(listingurl, {})
+        if not dirlist:
+            # Probably a failed fetch: don't forget what was there.
+            newlistings[listingurl] = oldlisting
+            return []
+        newlistings[listingurl], changed, removed = \
+            dirlist_changes(oldlisting, dirlist)
+        if changed or removed:
+            changes[listingurl] = {
+                "added": [ l['name'] for l in changed
+                           if l['name'] not in oldlisting ],
+                "modified": [ l['name'] for l in changed
+                              if l['name'] in oldlisting ],
+                "removed": removed
+            }
+        return changed
+
+    def not_applied(listingurl, filename):
+        """filename couldn't be used yet: look at it again next time."""
+        newlistings[listingurl].pop(filename, None)
+
     def get_billno_from_filename(amendname):
         """Extract billno from filenames like in Amendments or Tabled_Reports
            which tend to be something like "HB0060CP1T.pdf"
@@ -835,20 +1555,28 @@ def update_bill_links(yearcode):
         # which are the contents links for bills.
         # But the number of zeroes is inconsistent and unpredictable,
         # so get a listing and remove the zeros.
-        dirlist = billrequests.get_html_dirlist(listingurl)
+        dirlist = dirlists[listingurl]
         if not dirlist:
             print("No directory listing at", listingurl, file=sys.stderr)
-            continue
+
+        # Several files can map to the same bill, and the last one
+        # in the listing wins. So a bill with any changed file gets
+        # all its files looked at again, the same as a full pass would,
+        # or an older file that was touched could replace a newer link.
+        changedbills = set(get_billno_from_filename(l['name'])
+                           for l in changed_entries(listingurl, dirlist))
+        changedbills.discard('')
 
         for l in dirlist:
             filename = l['name']   # These are names like 'HB0060CP1T.pdf'
             billno = get_billno_from_filename(filename)
             href = l['url']
 
-            if not billno:
+            if billno not in changedbills:
                 continue
             if billno not in g_allbills[yearcode]:
                 nonexistent.add(billno)
+                not_applied(listingurl, filename)
                 continue
 
             g_allbills[yearcode][billno][dirs_direct[dirtype]] = href
@@ -866,7 +1594,7 @@ def update_bill_links(yearcode):
         for chamber in chambers:
             listingurl = posixpath.join(baseurl, dirtype, chamber)
             nonexistent = set()
-            dirlist = billrequests.get_html_dirlist(listingurl)
+            dirlist = changed_entries(listingurl, dirlists[listingurl])
 
             for l in dirlist:
                 billno = None
@@ -894,6 +1622,7 @@ def update_bill_links(yearcode):
                     # HB0005.HTML/PDF are actually for SB5.
                     if billno not in g_allbills[yearcode]:
                         nonexistent.add(billno)
+                        not_applied(listingurl, filename)
                         continue
 
                     href = l['url']
@@ -917,6 +1646,7 @@ def update_bill_links(yearcode):
                               "for nonexistent bill", billno,
                               file=sys.stderr)
                         nonexistent.add(billno)
+                        not_applied(listingurl, filename)
                         continue
                     # Last Modified is a string like '3/14/2025\t5:23 PM MST'
                     # %I must be used instead of %H for %p to get PM right
@@ -995,22 +1725,26 @@ def update_bill_links(yearcode):
 
     # Special treatment for tabled bills
     listingurl = posixpath.join(baseurl, "Tabled_Reports")
-    dirlist = billrequests.get_html_dirlist(listingurl)
+    dirlist = changed_entries(listingurl, dirlists[listingurl])
     nonexistent = set()
     for l in dirlist:
         filename = l['name']   # These are names like 'HB0060CP1T.pdf'
         billno = get_billno_from_filename(filename)
         if billno not in g_allbills[yearcode]:
             nonexistent.add(billno)
+            if billno:
+                not_applied(listingurl, filename)
             continue
         g_allbills[yearcode][billno]["tabled"] = True
     if nonexistent:
         print("Nonexistent tabled bills", ', '.join(nonexistent),
               "reffed in", listingurl, file=sys.stderr)
 
-    # Don't save the file; assume we're called from update_allbills()
+    g_dirlists[yearcode] = newlistings
+
+    # Don't save the files; assume we're called from update_allbills()
     # which will save the JSON.
-    return g_allbills
+    return changes
 
 
 def expand_house_or_senate(code, cache_locally=True):
@@ -1096,6 +1830,27 @@ def expand_house_or_senate(code, cache_locally=True):
     return ret
 
 
+def committee_url(code):
+    return 'https://www.nmlegis.gov/Committee/Standing_Committee?CommitteeCode=%s' % code
+
+
+def prefetch_committees(codes):
+    """Refresh the cached pages for a list of committee codes
+       several at a time, so expand_committee() won't wait on each one.
+    """
+    urls = []
+    for code in codes:
+        if code == 'House' or code == 'Senate':
+            urls.append("https://www.nmlegis.gov/Entity/%s/Floor_Calendar"
+                        % code)
+            if "https://www.nmlegis.gov/Calendar/Session" not in urls:
+                urls.append("https://www.nmlegis.gov/Calendar/Session")
+        else:
+            urls.append(committee_url(code))
+    for url, response in billrequests.get_many(urls):
+        pass
+
+
 def expand_committee(code):
     """Return a dictionary, with keys
            code       str, short committee code
@@ -1106,7 +1861,7 @@ def expand_committee(code):
     if code == 'House' or code == 'Senate':
         return expand_house_or_senate(code)
 
-    url = 'https://www.nmlegis.gov/Committee/Standing_Committee?CommitteeCode=%s' % code
+    url = committee_url(code)
     soup = billrequests.soup_from_cache_or_net(url)
 
     if not soup:
@@ -1254,6 +2009,13 @@ def expand_committees(jsonsrc=None):
 
     committees = {}
 
+    # Fetch all the committee pages at once, rather than one at a time
+    # in the loop below.
+    prefetch_committees(set(
+        commcode for mtgdate in scheduledata if mtgdate[0] != '_'
+        for mtgtime in scheduledata[mtgdate]
+        for commcode in scheduledata[mtgdate][mtgtime]))
+
     for mtgdate in scheduledata:
         if mtgdate[0] == '_':
             continue
@@ -1664,10 +2426,10 @@ def get_all_vote_reports(yearcode, current_yearcode):
 
     # Cached downloaded JSON files:
     dlfiles = [
-        os.path.join(billrequests.CACHEDIR,
-                     'https:__nmlegis.edsantiago.com_committee-reports.json'),
-        os.path.join(billrequests.CACHEDIR,
-                     'https:__nmlegis.edsantiago.com_floor-votes.json'),
+        billrequests.url_to_cache_filename(
+            'https://nmlegis.edsantiago.com/committee-reports.json'),
+        billrequests.url_to_cache_filename(
+            'https://nmlegis.edsantiago.com/floor-votes.json'),
     ]
 
     # Fetch remote files.
@@ -1677,13 +2439,8 @@ def get_all_vote_reports(yearcode, current_yearcode):
         # Save the old sizes
         old_dl_sizes = []
         for f in dlfiles:
-            try:
-                old_dl_sizes.append(os.stat(f).st_size)
-            except (FileNotFoundError, PermissionError):
-                old_dl_sizes.append(0)
-            except Exception as e:
-                print("Exception checking old sizes:", e)
-                old_dl_sizes.append(0)
+            filestat = billrequests.cache_stat(f)
+            old_dl_sizes.append(filestat[1] if filestat else 0)
         if len(old_dl_sizes) != len(dlfiles):
             print("EEK! old_dl_sizes is the wrong length", len(old_dl_sizes),
                   file=sys.stderr)
@@ -1712,16 +2469,16 @@ def get_all_vote_reports(yearcode, current_yearcode):
         # Now we've just downloaded both json files.
         # Are the sizes the same as or larger than the previous data?
         for old_size, new_f in zip(old_dl_sizes, dlfiles):
-            try:
-                if os.stat(new_f).st_size < old_size:
-                    print("*** EEK! Size of %s shrunk" % new_f,
-                          file=sys.stderr)
-                    # Note, this will happen once per session, when the
-                    # new session file first appears.
-                    # XXX Should check for that case here.
-            except:
+            filestat = billrequests.cache_stat(new_f)
+            if not filestat:
                 print("*** EEK! Couldn't stat newly downloaded", new_f,
                       file=sys.stderr)
+            elif filestat[1] < old_size:
+                print("*** EEK! Size of %s shrunk" % new_f,
+                      file=sys.stderr)
+                # Note, this will happen once per session, when the
+                # new session file first appears.
+                # XXX Should check for that case here.
 
         # Start with the committee reports
         g_all_vote_reports[yearcode] = comm_json["reports"]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+A persistent memo of parsed bill pages, so a page that's been
+re-fetched but hasn't changed doesn't have to be parsed again.
+
+For each bill it keeps a hash of the page body it last parsed
+and the resulting billdic. nmlegisbill.parse_bill_page() checks it
+before parsing, and records what it parses. Only the latest parse of
+each bill is kept, so the memo doesn't grow as pages change.
+
+The hash includes a parser version, so bumping
+nmlegisbill.BILL_PARSER_VERSION when the parser changes
+makes every old entry miss.
+"""
+
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+
+
+def body_hash(body, version):
+    """The memo key for a page body (bytes) parsed by parser version."""
+    return hashlib.sha1(b"%d\n" % version + body).hexdigest()
+
+
+class ParseMemo:
+    """Parsed billdics kept in the SQLite file dbfile.
+       Like CacheIndex, safe to share between threads and processes.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.local = threading.local()
+        self._db().execute("""CREATE TABLE IF NOT EXISTS bills (
+                                  billno TEXT,
+                                  yearcode TEXT,
+                                  bodyhash TEXT,
+                                  billdic BLOB,
+                                  parsed_at REAL,
+                                  PRIMARY KEY (billno, yearcode))""")
+
+    def _db(self):
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.dbfile, timeout=10,
+                                            isolation_level=None)
+            self.local.db.execute("PRAGMA journal_mode=WAL")
+            self.local.db.execute("PRAGMA synchronous=NORMAL")
+        return self.local.db
+
+    def lookup(self, billno, yearcode, bodyhash):
+        """Return the billdic parsed from a page with bodyhash,
+           or None if the last page parsed for this bill was different.
+        """
+        row = self._db().execute("SELECT billdic FROM bills"
+                                 " WHERE billno = ? AND yearcode = ?"
+                                 " AND bodyhash = ?",
+                                 (billno, yearcode, bodyhash)).fetchone()
+        if not row:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            return None
+
+    def record(self, billno, yearcode, bodyhash, billdic):
+        """Remember billdic as the parse of the page with bodyhash,
+           replacing anything remembered for this bill before.
+        """
+        self._db().execute("INSERT OR REPLACE INTO bills VALUES"
+                           " (?, ?, ?, ?, ?)",
+                           (billno, yearcode, bodyhash,
+                            pickle.dumps(billdic), time.time()))
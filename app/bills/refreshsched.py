@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Decide which bill pages are most worth re-fetching,
+and keep the total under an hourly budget so nmlegis.gov
+doesn't see more load however often refreshes are asked for.
+
+refresh_score() rates a bill from what the database knows about it:
+how many users track it, whether it's scheduled, whether it's on
+a chamber floor, how recently something happened to it, and how
+long it's been since its page was last read. Hot bills outscore
+dead ones even when they were refreshed more recently, but every
+bill's score keeps growing as it goes stale, so nothing starves.
+
+RefreshBudget counts bill page fetches per clock hour in a small
+JSON file, so all the web server's processes share one budget.
+"""
+
+from . import billrequests
+
+from datetime import datetime, timedelta
+import json
+import os, sys
+import time
+
+# fcntl is only for sharing the budget file between processes,
+# and doesn't exist on Windows.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# How much each thing about a bill multiplies the rate its score
+# grows per hour since it was last refreshed.
+TRACKING_WEIGHT = 1.      # per user tracking it, up to MAX_TRACKERS_COUNTED
+MAX_TRACKERS_COUNTED = 10
+SCHEDULED_WEIGHT = 20.    # scheduled for a hearing today or later
+FLOOR_WEIGHT = 10.        # on the House or Senate floor
+RECENT_WEIGHT = 5.        # had an action within RECENT_ACTION
+RECENT_ACTION = timedelta(days=3)
+DEAD_FACTOR = .1          # signed, chaptered or died: rarely changes
+
+DEAD_LOCATIONS = ( 'Chaptered', 'Signed', 'Died', 'Vetoed' )
+FLOOR_LOCATIONS = ( 'House', 'Senate' )
+
+# Known to have changed (e.g. its action code in Legislation_List
+# is different): worth a day or so of staleness for the hottest bills.
+# Callers that must take changed bills first should sort on that too.
+CHANGED_BONUS = 1000.
+
+# Bills refreshed more recently than this score 0 unless they changed.
+MIN_REFRESH_SECS = 30 * 60
+
+# Bill page fetches allowed per hour, shared by all processes,
+# counted in this file in billrequests.CACHEDIR.
+BUDGET_PER_HOUR = 300
+BUDGET_FILENAME = "refreshbudget.json"
+
+
+def refresh_score(update_date, num_tracking=0, scheduled=False,
+                  location=None, last_action_date=None, changed=False,
+                  now=None):
+    """How urgently a bill's page should be re-fetched; 0 for not at all.
+       update_date is when it was last refreshed (None for never),
+       scheduled is whether it's scheduled in the future,
+       changed is whether it's known to have changed since.
+    """
+    if not now:
+        now = datetime.now()
+
+    if update_date:
+        stale_secs = (now - update_date.replace(tzinfo=None)).total_seconds()
+    else:
+        stale_secs = 7 * 24 * 60 * 60
+    if stale_secs < MIN_REFRESH_SECS and not changed:
+        return 0.
+
+    weight = 1. + TRACKING_WEIGHT * min(num_tracking, MAX_TRACKERS_COUNTED)
+    if scheduled:
+        weight += SCHEDULED_WEIGHT
+    if location in FLOOR_LOCATIONS:
+        weight += FLOOR_WEIGHT
+    if last_action_date and \
+       now - last_action_date.replace(tzinfo=None) < RECENT_ACTION:
+        weight += RECENT_WEIGHT
+    if location in DEAD_LOCATIONS:
+        weight *= DEAD_FACTOR
+
+    score = weight * max(stale_secs, 0) / 3600
+    if changed:
+        score += CHANGED_BONUS
+    return round(score, 2)
+
+
+def budget():
+    """The RefreshBudget for the current cache directory.
+       Like parse_memo(), LOCAL_MODE (e.g. the tests) doesn't use
+       a file, so each RefreshBudget counts only its own fetches.
+    """
+    if billrequests.LOCAL_MODE:
+        return RefreshBudget(None, BUDGET_PER_HOUR)
+    return RefreshBudget(os.path.join(billrequests.CACHEDIR, BUDGET_FILENAME),
+                         BUDGET_PER_HOUR)
+
+
+class RefreshBudget:
+    """At most per_hour bill page fetches per clock hour,
+       counted in budgetfile, or in memory if budgetfile is None.
+       Reading the count doesn't create the file.
+       What's counted is bills chosen to be refreshed, whether or not
+       their pages turn out to need fetching: a page still in the cache
+       uses up budget, which errs on the side of fetching less.
+    """
+
+    def __init__(self, budgetfile, per_hour):
+        self.budgetfile = budgetfile
+        self.per_hour = per_hour
+        self.usage = {}
+
+    @staticmethod
+    def _hour():
+        return time.strftime("%Y-%m-%d %H")
+
+    def _this_hour(self, usage):
+        """usage, or a fresh count if it's from an earlier hour."""
+        if usage.get("hour") != self._hour():
+            return { "hour": self._hour(), "spent": 0 }
+        return usage
+
+    def _read(self):
+        if not self.budgetfile:
+            return self._this_hour(self.usage)
+        try:
+            with open(self.budgetfile) as fp:
+                if fcntl:
+                    fcntl.flock(fp, fcntl.LOCK_SH)
+                return self._this_hour(json.load(fp))
+        except (FileNotFoundError, ValueError):
+            return self._this_hour({})
+
+    def _add(self, spend, capped=False):
+        """Add spend to this hour's count, or if capped, as much of it
+           as is left this hour. Checking and adding happen under one
+           lock, so processes sharing the file can't both take the last
+           of the budget. Return (how much was added, the new count).
+        """
+        if not self.budgetfile:
+            self.usage = self._this_hour(self.usage)
+            if capped:
+                spend = max(min(spend, self.per_hour - self.usage["spent"]),
+                            0)
+            self.usage["spent"] += spend
+            return spend, self.usage["spent"]
+        with open(self.budgetfile, "a+") as fp:
+            if fcntl:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            try:
+                usage = self._this_hour(json.load(fp))
+            except ValueError:
+                usage = self._this_hour({})
+            if capped:
+                spend = max(min(spend, self.per_hour - usage["spent"]), 0)
+            usage["spent"] += spend
+            fp.seek(0)
+            fp.truncate()
+            json.dump(usage, fp)
+            return spend, usage["spent"]
+
+    def spent(self):
+        """Fetches used so far this hour."""
+        try:
+            return self._read()["spent"]
+        except OSError:
+            return 0
+
+    def remaining(self):
+        return max(self.per_hour - self.spent(), 0)
+
+    def spend(self, n):
+        """Count n fetches, even past the budget; return the new count."""
+        if not n:
+            return self.spent()
+        try:
+            return self._add(n)[1]
+        except OSError as e:
+            print("Couldn't update refresh budget", self.budgetfile, ":", e,
+                  file=sys.stderr)
+            return 0
+
+    def reserve(self, n):
+        """Take up to n fetches from what's left this hour,
+           and return how many were granted.
+           If the count can't be kept, all n are granted (up to per_hour).
+        """
+        if n <= 0:
+            return 0
+        try:
+            return self._add(n, capped=True)[0]
+        except OSError as e:
+            print("Couldn't update refresh budget", self.budgetfile, ":", e,
+                  file=sys.stderr)
+            return min(n, self.per_hour)
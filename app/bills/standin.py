@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Record and replay nmlegis traffic, for benchmarking without
+touching the real site.
+
+Recording: set billrequests.RECORD_DIR to a directory, and every
+network request billrequests makes is saved there as a cassette:
+NAME.json (method, url, status, headers, elapsed time) plus NAME.body.
+
+Replaying: run the stand-in server on the cassettes,
+    python3 -m app.bills.standin cassettedir --port 8642 \
+        --latency .3 --throughput 200000 --error-rate .05
+and set billrequests.STANDIN_URL = "http://127.0.0.1:8642".
+billrequests then sends every request to the stand-in instead of
+the real host (cache file names don't change), and the stand-in
+answers from the cassettes, with whatever latency, bandwidth and
+errors you asked it to simulate. URLs with no cassette get a 404.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+import argparse
+import hashlib
+import json
+import os, sys
+import random
+import time
+
+
+def cassette_name(method, url):
+    """The base name for a cassette of method on url (a full URL,
+       including any query string).
+    """
+    return hashlib.sha1(("%s %s" % (method, url)).encode()).hexdigest()[:20]
+
+
+def record_cassette(cassettedir, method, url, status, headers, body,
+                    elapsed):
+    """Save one response as a cassette in cassettedir."""
+    name = cassette_name(method, url)
+    os.makedirs(cassettedir, exist_ok=True)
+    with open(os.path.join(cassettedir, name + ".body"), "wb") as fp:
+        fp.write(body or b'')
+    with open(os.path.join(cassettedir, name + ".json"), "w") as fp:
+        json.dump({ "method": method, "url": url, "status": status,
+                    "headers": dict(headers), "elapsed": elapsed },
+                  fp, indent=2)
+
+
+def load_cassettes(cassettedir):
+    """Return { (method, url): cassette dict } for all the cassettes
+       in cassettedir. Each dict also gets "bodyfile".
+    """
+    cassettes = {}
+    for filename in os.listdir(cassettedir):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(cassettedir, filename)) as fp:
+            cassette = json.load(fp)
+        cassette["bodyfile"] = os.path.join(cassettedir,
+                                            filename[:-5] + ".body")
+        cassettes[(cassette["method"], cassette["url"])] = cassette
+    return cassettes
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Answers requests for /<quoted original URL> from the cassettes.
+       The server it's attached to has the settings:
+       cassettes, latency, jitter, throughput, error_rate, drop_rate,
+       recorded_latency.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.replay("GET")
+
+    def do_HEAD(self):
+        self.replay("HEAD")
+
+    def replay(self, method):
+        server = self.server
+        url = unquote(self.path[1:])
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        cassette = server.cassettes.get((method, url))
+        # A HEAD can be answered from a recorded GET
+        if not cassette and method == "HEAD":
+            cassette = server.cassettes.get(("GET", url))
+        if cassette and server.recorded_latency:
+            delay = cassette["elapsed"]
+        if delay > 0:
+            time.sleep(delay)
+
+        roll = random.random()
+        if roll < server.drop_rate:
+            # Hang up without answering, like a reset connection
+            self.close_connection = True
+            return
+        if roll < server.drop_rate + server.error_rate:
+            self.send_error(503, "Injected error")
+            return
+        if not cassette:
+            self.send_error(404, "No cassette")
+            return
+
+        with open(cassette["bodyfile"], "rb") as fp:
+            body = fp.read()
+        self.send_response(cassette["status"])
+        for header, value in cassette["headers"].items():
+            # The body is sent as recorded, so these would be wrong
+            if header.lower() not in ("content-length", "content-encoding",
+                                      "transfer-encoding", "connection"):
+                self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if method == "HEAD":
+            return
+
+        if not server.throughput:
+            self.wfile.write(body)
+            return
+        # Send a tenth of a second's worth at a time
+        chunksize = max(1, int(server.throughput / 10))
+        for start in range(0, len(body), chunksize):
+            self.wfile.write(body[start:start + chunksize])
+            time.sleep(.1)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(cassettedir, port=0, latency=0, jitter=0, throughput=0,
+                error_rate=0, drop_rate=0, recorded_latency=False,
+                verbose=False):
+    """Make a stand-in server for the cassettes in cassettedir,
+       on localhost:port (0 picks a free port; see server.server_address).
+       latency, jitter: seconds to wait before answering, plus up to jitter.
+       throughput: bytes per second, 0 for as fast as possible.
+       error_rate, drop_rate: fraction of requests answered with a 503,
+       or with a dropped connection.
+       recorded_latency: wait as long as the real server took instead.
+       Call serve_forever() on the result.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandinHandler)
+    server.daemon_threads = True
+    server.cassettes = load_cassettes(cassettedir)
+    server.latency = latency
+    server.jitter = jitter
+    server.throughput = throughput
+    server.error_rate = error_rate
+    server.drop_rate = drop_rate
+    server.recorded_latency = recorded_latency
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve recorded nmlegis responses for benchmarking")
+    parser.add_argument("cassettedir")
+    parser.add_argument("--port", type=int, default=8642)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="up to this many more seconds, at random")
+    parser.add_argument("--recorded-latency", action="store_true",
+                        help="take as long as the real server did")
+    parser.add_argument("--throughput", type=int, default=0,
+                        help="bytes per second (default unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of requests that get a 503")
+    parser.add_argument("--drop-rate", type=float, default=0,
+                        help="fraction of connections dropped")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = make_server(args.cassettedir, port=args.port,
+                         latency=args.latency, jitter=args.jitter,
+                         throughput=args.throughput,
+                         error_rate=args.error_rate,
+                         drop_rate=args.drop_rate,
+                         recorded_latency=args.recorded_latency,
+                         verbose=args.verbose)
+    print("Serving %d cassettes from %s on http://127.0.0.1:%d"
+          % (len(server.cassettes), args.cassettedir,
+             server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nBye!")
@@ -497,6 +497,9 @@ def track_untrack():
             db.session.commit()
 
             # Now, do the slow part: fetch the bills that need to be fetched.
+            # Fetch all the pages concurrently first, so make_new_bill
+            # can parse them from the cache.
+            nmlegisbill.fetch_bill_pages(new_billnos, session["yearcode"])
             new_bills = []
             for billno in new_billnos:
                 bill = make_new_bill(billno, session["yearcode"])
@@ -661,38 +664,39 @@ def allbills():
     # [ [billno, title, link, fulltext_link, tracked_by_user ] ]
     # and might also have other items, like num_tracking, amended,
     # comm_sub_links, etc.
-    for billno in allbills:
+    # items() reads a stored list in one go, rather than bill by bill.
+    for billno, info in allbills.items():
         if billno.startswith("_"):
             # Skip entries like _updated and _schema
             continue
 
         # Prepare the structure expected by allbills.html
         args = { "billno": billno,
-                 "title": allbills[billno].get("title", ""),
-                 "url": allbills[billno].get("url", ""),
-                 "contentsurl": allbills[billno].get("contents", ""),
+                 "title": info.get("title", ""),
+                 "url": info.get("url", ""),
+                 "contentsurl": info.get("contents", ""),
                  "user_tracking": billno in bills_tracking
                }
-        if "Amendments_In_Context" in allbills[billno]:
-            args["amended"] = allbills[billno]["Amendments_In_Context"]
-        elif "Floor_Amendments" in allbills[billno]:
-            args["amended"] = allbills[billno]["Floor_Amendments"]
-        elif 'comm_sub_links' in allbills[billno]:
+        if "Amendments_In_Context" in info:
+            args["amended"] = info["Amendments_In_Context"]
+        elif "Floor_Amendments" in info:
+            args["amended"] = info["Floor_Amendments"]
+        elif 'comm_sub_links' in info:
             # comm_sub_links is a list of [(link, date)]
             # XXX which probably all the amendment types should be
-            lastsub = max(allbills[billno]["comm_sub_links"], key=lambda x: x[1])
+            lastsub = max(info["comm_sub_links"], key=lambda x: x[1])
             args["amended"] = lastsub[0]
             args["amended_date"] = lastsub[1]
-        elif "amend" in allbills[billno] and allbills[billno]["amend"]:
-            args["amended"] = allbills[billno]["amend"][-1]
+        elif "amend" in info and info["amend"]:
+            args["amended"] = info["amend"][-1]
 
-        if "overview" in allbills[billno]:
-            args["overview"] = allbills[billno]["overview"]
+        if "overview" in info:
+            args["overview"] = info["overview"]
 
         if user and billno not in bills_seen:
             unseen.append(args)
-        elif "history" in allbills[billno] and allbills[billno]["history"]:
-            lasthist = allbills[billno]["history"][-1]
+        elif "history" in info and info["history"]:
+            lasthist = info["history"][-1]
             try:
                 lastmod = datetime.strptime(lasthist[0], "%Y-%m-%d").date()
                 # print(billno, "lastmod:", lastmod, "diff", today - lastmod)
@@ -702,8 +706,8 @@ def allbills():
 
                     # Handle title changes
                     if lasthist[1] == "titlechanged" and \
-                       len(allbills[billno]["history"]) > 1:
-                        oldtitle = allbills[billno]["history"][-2][2]
+                       len(info["history"]) > 1:
+                        oldtitle = info["history"][-2][2]
                         args["oldtitle"] = oldtitle
                 else:
                     oldbills.append(args)
@@ -97,9 +97,11 @@ def html_bill_table(bill_list, sortby=None, yearcode=None, inline=False):
     return outstr
 
 
-def make_new_bill(billno, yearcode):
+def make_new_bill(billno, yearcode, b=None):
     """Create a new Bill object, not previously in the database,
        by fetching and parsing its page.
+       If b is given, it's the already parsed page
+       (e.g. from nmlegisbill.parse_bill_pages()).
        Don't actually add it to the database, just return the Bill object.
     """
     if not yearcode:
@@ -119,9 +121,11 @@ def make_new_bill(billno, yearcode):
 
         return bills[0]
 
-    # Populate the new bill by parsing the bill page
-    b = nmlegisbill.parse_bill_page(billno, yearcode=yearcode,
-                                    cache_locally=True)
+    # Populate the new bill by parsing the bill page.
+    # The user is waiting, so an old copy will do while it's refreshed.
+    if not b:
+        b = nmlegisbill.parse_bill_page(billno, yearcode=yearcode,
+                                        cache_locally=True, stale_ok=True)
     if not b:
         return None
 
@@ -183,8 +183,10 @@ def main():
     #
     if now.hour in bill_hours:
         responses['bills'] = "Updating some bills")
+        # Bills whose actions or title changed are always refreshed;
+        # PERCENT is how many of the rest to refresh anyway.
         requests.post('%s/api/refresh_percent_of_bills' % BASEURL,
-                      { "PERCENT": 34, "KEY": KEY })
+                      { "PERCENT": 5, "KEY": KEY })
 
     # Email comes last, in case anything else needed updating.
     if now.hour in email_hours:
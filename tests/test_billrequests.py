@@ -0,0 +1,776 @@
+#!/usr/bin/env python3
+
+"""Tests for the caching layer in billrequests.
+   These need a web server to talk to, so they start a tiny one
+   on localhost rather than touching nmlegis.
+"""
+
+from app.bills import billrequests
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import tempfile
+import shutil
+import time
+import os
+import json
+
+
+class FakeNMLegisHandler(BaseHTTPRequestHandler):
+    """Serves FakeNMLegisHandler.pages, honoring If-None-Match,
+       and counts what it was asked for.
+    """
+    # path: (etag, body)
+    pages = {}
+    # list of (method, path, status)
+    hits = []
+    # path: seconds to wait before answering
+    delays = {}
+    # path: error status to answer with instead of the page
+    errors = {}
+
+    def do_GET(self):
+        if self.path in self.delays:
+            time.sleep(self.delays[self.path])
+        if self.path in self.errors:
+            self.hits.append(("GET", self.path, self.errors[self.path]))
+            self.send_response(self.errors[self.path])
+            self.end_headers()
+            return
+
+        # Record hits before responding, so the client never sees
+        # a response before it's been counted.
+        if self.path not in self.pages:
+            self.hits.append(("GET", self.path, 404))
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        etag, body = self.pages[self.path]
+        if etag and self.headers.get("If-None-Match") == etag:
+            self.hits.append(("GET", self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.hits.append(("GET", self.path, 200))
+        self.send_response(200)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        if self.path in self.errors:
+            status = self.errors[self.path]
+        elif self.path in self.pages:
+            status = 200
+        else:
+            status = 404
+        self.hits.append(("HEAD", self.path, status))
+        self.send_response(status)
+        if status == 200:
+            self.send_header("Content-Length",
+                             str(len(self.pages[self.path][1])))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeNMLegisHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+
+def setup_module():
+    global server, baseurl, cachedir, saved_cachedir, saved_local_mode
+    server, baseurl = start_server()
+    cachedir = tempfile.mkdtemp()
+    saved_cachedir = billrequests.CACHEDIR
+    saved_local_mode = billrequests.LOCAL_MODE
+    billrequests.CACHEDIR = cachedir
+    billrequests.LOCAL_MODE = False
+
+
+def teardown_module():
+    server.shutdown()
+    shutil.rmtree(cachedir)
+    billrequests.CACHEDIR = saved_cachedir
+    billrequests.LOCAL_MODE = saved_local_mode
+
+
+def test_conditional_revalidation():
+    FakeNMLegisHandler.pages["/etag.html"] = ('"v1"', b"<p>version one</p>")
+    FakeNMLegisHandler.hits.clear()
+    url = baseurl + "/etag.html"
+    cachefile = os.path.join(cachedir, "etag.html")
+
+    r = billrequests.get(url, cachefile=cachefile)
+    assert r.status_code == 200
+    assert r.content == b"<p>version one</p>"
+    assert billrequests.read_validators(cachefile) == { "ETag": '"v1"' }
+
+    # Make the cache file look old, so it will be revalidated.
+    old = time.time() - 3 * billrequests.CACHESECS
+    billrequests.cache_index().touch(cachefile, old)
+    assert billrequests.cache_stat(cachefile)[0] == old
+
+    r = billrequests.get(url, cachefile=cachefile)
+    assert r.status_code == 200
+    assert r.content == b"<p>version one</p>"
+    assert FakeNMLegisHandler.hits[-1] == ("GET", "/etag.html", 304)
+    # A 304 counts as a refresh
+    assert time.time() - os.stat(cachefile).st_mtime < 60
+
+    # Now the page changes.
+    FakeNMLegisHandler.pages["/etag.html"] = ('"v2"', b"<p>version two</p>")
+    billrequests.cache_index().touch(cachefile, old)
+    r = billrequests.get(url, cachefile=cachefile)
+    assert r.content == b"<p>version two</p>"
+    assert FakeNMLegisHandler.hits[-1] == ("GET", "/etag.html", 200)
+    with open(cachefile, "rb") as fp:
+        assert fp.read() == b"<p>version two</p>"
+    assert billrequests.read_validators(cachefile) == { "ETag": '"v2"' }
+
+    # The index knows what's cached, and how old it is.
+    entry = billrequests.cache_index().lookup(cachefile)
+    assert entry["url"] == url
+    assert entry["size"] == len(b"<p>version two</p>")
+    assert url in [ e["url"] for e in billrequests.cache_index().inventory() ]
+    assert url not in [ e["url"] for e
+                        in billrequests.cache_index().inventory(older_than=60) ]
+
+    # The cache file is removed by hand, but the index still has it:
+    # no If-None-Match, since a 304 would leave nothing to return.
+    billrequests.cache_index().touch(cachefile, old)
+    os.unlink(cachefile)
+    r = billrequests.get(url, cachefile=cachefile)
+    assert r.status_code == 200
+    assert r.content == b"<p>version two</p>"
+    assert FakeNMLegisHandler.hits[-1] == ("GET", "/etag.html", 200)
+
+    # And if it goes missing after the validators were sent,
+    # the 304 is no use.
+    os.unlink(cachefile)
+    assert billrequests.not_modified_response(cachefile, {}) is None
+
+
+def test_rate_limiter():
+    limiter = billrequests.RateLimiter(rate=10, burst=3)
+    # The burst is free, after that each request waits 1/rate longer.
+    assert [ limiter.reserve() for i in range(3) ] == [ 0, 0, 0 ]
+    assert 0.05 < limiter.reserve() <= 0.1
+    assert 0.15 < limiter.reserve() <= 0.2
+
+    assert billrequests.rate_limiter("https://www.nmlegis.gov/Legislation") \
+        is billrequests.rate_limiter("https://nmlegis.gov/Sessions/")
+    assert billrequests.rate_limiter(baseurl) is None
+
+    # Fetches share one pooled session
+    FakeNMLegisHandler.pages["/pooled"] = (None, b"pooled")
+    assert billrequests.net_get(baseurl + "/pooled").content == b"pooled"
+    assert billrequests.http_session() is billrequests.http_session()
+
+
+def test_get_many():
+    for i in range(20):
+        FakeNMLegisHandler.pages["/many/%d" % i] = (None, b"page %d" % i)
+    urls = [ baseurl + "/many/%d" % i for i in range(20) ]
+    urls.append(baseurl + "/many/nonexistent")
+
+    results = dict(billrequests.get_many(urls, max_workers=4))
+    assert set(results) == set(urls)
+    for i in range(20):
+        assert results[urls[i]].status_code == 200
+        assert results[urls[i]].content == b"page %d" % i
+    assert results[baseurl + "/many/nonexistent"].status_code == 404
+
+    # Everything that succeeded is now cached.
+    FakeNMLegisHandler.hits.clear()
+    results = dict(billrequests.get_many(urls[:20]))
+    assert results[urls[3]].content == b"page 3"
+    assert not FakeNMLegisHandler.hits
+
+
+def test_async_get():
+    from app.bills import abillrequests
+    import asyncio
+
+    for i in range(10):
+        FakeNMLegisHandler.pages["/async/%d" % i] = ('"a%d"' % i,
+                                                     b"async %d" % i)
+    urls = [ baseurl + "/async/%d" % i for i in range(10) ]
+
+    async def fetch_all():
+        try:
+            return await asyncio.gather(*[ abillrequests.aget(url)
+                                           for url in urls ])
+        finally:
+            await abillrequests.aclose()
+
+    responses = asyncio.run(fetch_all())
+    assert [ r.content for r in responses ] == \
+        [ b"async %d" % i for i in range(10) ]
+
+    # Same cache files as the synchronous version
+    FakeNMLegisHandler.hits.clear()
+    assert billrequests.get(urls[4]).content == b"async 4"
+    assert not FakeNMLegisHandler.hits
+    assert billrequests.read_validators(
+        billrequests.url_to_cache_filename(urls[4])) == { "ETag": '"a4"' }
+
+    # ahead answers like head(): a status, even when the host is down,
+    # and its breaker is consulted.
+    deadurl = "http://localhost:1/nothing.html"
+    deadbreaker = billrequests.circuit_breaker(deadurl)
+
+    async def heads():
+        try:
+            return await asyncio.gather(
+                abillrequests.ahead(baseurl + "/async/nonexistent.html"),
+                abillrequests.ahead(deadurl))
+        finally:
+            await abillrequests.aclose()
+
+    try:
+        missing, dead = asyncio.run(heads())
+        assert missing.status_code == 404
+        assert dead.status_code == 503
+        assert deadbreaker.failures == 1
+
+        deadbreaker.max_failures = 2
+        deadbreaker.failure()
+        assert deadbreaker.is_open()
+        dead = asyncio.run(heads())[1]
+        assert dead.status_code == 503
+        assert deadbreaker.failures == 2
+    finally:
+        deadbreaker.max_failures = billrequests.BREAKER_FAILURES
+        deadbreaker.success()
+
+
+def test_gzip_store():
+    from app.bills import cachestore
+
+    storedir = os.path.join(cachedir, "gzstore")
+    os.mkdir(storedir)
+    store = cachestore.GzipStore(storedir, max_bytes=3000, low_water=.7,
+                                 compresslevel=1)
+
+    # Plain files from the flat layout are still readable.
+    plainfile = os.path.join(storedir, "plain.html")
+    with open(plainfile, "wb") as fp:
+        fp.write(b"plain old page")
+    assert store.read(plainfile) == b"plain old page"
+    assert store.stat(plainfile)[1] == len(b"plain old page")
+
+    # Writing replaces the plain copy with a compressed one.
+    store.write(plainfile, b"x" * 5000)
+    assert not os.path.exists(plainfile)
+    assert os.path.getsize(plainfile + ".gz") < 5000
+    assert store.read(plainfile) == b"x" * 5000
+    assert store.stat(plainfile)[1] == 5000
+
+    # Random bytes don't compress, so these will blow the budget
+    # and the least recently used ones get evicted.
+    for i in range(5):
+        store.write(os.path.join(storedir, "page%d" % i), os.urandom(800))
+        # page0 keeps getting used, so it should survive.
+        store.read(os.path.join(storedir, "page0"))
+    assert store.stat(os.path.join(storedir, "page0"))
+    assert not store.stat(os.path.join(storedir, "page1"))
+    assert sum(os.path.getsize(os.path.join(storedir, f))
+               for f in os.listdir(storedir) if f.endswith(".gz")) <= 3000
+
+    # billrequests.get goes through whatever store is configured.
+    FakeNMLegisHandler.pages["/gz"] = ('"gz"', b"<p>gzipped</p>")
+    billrequests.CACHE_STORE = store
+    try:
+        cachefile = os.path.join(storedir, "gz.html")
+        assert billrequests.get(baseurl + "/gz",
+                                cachefile=cachefile).content \
+            == b"<p>gzipped</p>"
+        assert os.path.exists(cachefile + ".gz")
+        FakeNMLegisHandler.hits.clear()
+        assert billrequests.get(baseurl + "/gz",
+                                cachefile=cachefile).content \
+            == b"<p>gzipped</p>"
+        assert not FakeNMLegisHandler.hits
+
+        # Evicting it takes it out of the index too.
+        assert billrequests.cache_index().lookup(cachefile)
+        for i in range(6):
+            store.write(os.path.join(storedir, "more%d" % i),
+                        os.urandom(800))
+        assert not store.stat(cachefile)
+        assert not billrequests.cache_index().lookup(cachefile)
+    finally:
+        billrequests.CACHE_STORE = None
+
+
+def test_soup_cache():
+    FakeNMLegisHandler.pages["/souped.html"] = (None, b"<p>soup one</p>")
+    url = baseurl + "/souped.html"
+    billrequests.clear_soup_cache()
+    before = billrequests.soup_cache_stats()
+
+    soup = billrequests.soup_from_cache_or_net(url)
+    assert soup.p.text == "soup one"
+    assert billrequests.soup_from_cache_or_net(url) is soup
+    stats = billrequests.soup_cache_stats()
+    assert stats["misses"] == before["misses"] + 1
+    assert stats["hits"] == before["hits"] + 1
+    assert stats["entries"] == 1
+
+    # A refreshed cache file gets parsed again.
+    FakeNMLegisHandler.pages["/souped.html"] = (None, b"<p>soup number two</p>")
+    soup = billrequests.soup_from_cache_or_net(url, cachesecs=0)
+    assert soup.p.text == "soup number two"
+    assert billrequests.soup_cache_stats()["entries"] == 1
+
+
+def test_fetch_lock():
+    # Different pages have different locks, so holding one
+    # doesn't hold up fetching another, even in the same process.
+    one = os.path.join(billrequests.CACHEDIR, "one.html")
+    two = os.path.join(billrequests.CACHEDIR, "two.html")
+    assert billrequests.fetch_lock_file(one) != \
+        billrequests.fetch_lock_file(two)
+    t0 = time.time()
+    with billrequests.fetch_lock(one):
+        with billrequests.fetch_lock(two):
+            pass
+    assert time.time() - t0 < .5
+
+    # By default, waiting for another fetch of the same page lasts
+    # as long as that fetch could, retries and all.
+    assert billrequests.FETCH_LOCK_TIMEOUT is None
+    assert billrequests.max_fetch_secs() >= \
+        (billrequests.FETCH_RETRIES + 1) * billrequests.FETCH_TIMEOUT
+
+
+def test_single_flight():
+    FakeNMLegisHandler.pages["/slow"] = (None, b"slow page")
+    FakeNMLegisHandler.delays["/slow"] = .5
+    FakeNMLegisHandler.hits.clear()
+    url = baseurl + "/slow"
+
+    results = []
+    threads = [ threading.Thread(
+                    target=lambda: results.append(billrequests.get(url)))
+                for i in range(6) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert [ r.content for r in results ] == [ b"slow page" ] * 6
+    assert FakeNMLegisHandler.hits == [ ("GET", "/slow", 200) ]
+    assert not billrequests._inflight
+
+
+def test_stale_ok():
+    FakeNMLegisHandler.pages["/stale"] = (None, b"old news")
+    url = baseurl + "/stale"
+    cachefile = billrequests.url_to_cache_filename(url)
+    assert billrequests.get(url).content == b"old news"
+
+    # The page changes, and nmlegis is slow today.
+    FakeNMLegisHandler.pages["/stale"] = (None, b"new news")
+    FakeNMLegisHandler.delays["/stale"] = .5
+    old = time.time() - billrequests.CACHESECS - 60
+    billrequests.cache_index().touch(cachefile, old)
+
+    # stale_ok doesn't wait for the network.
+    t0 = time.time()
+    response = billrequests.get(url, stale_ok=True)
+    assert response.content == b"old news"
+    assert response.stale
+    assert time.time() - t0 < .4
+    assert billrequests.refresh_pending(cachefile)
+
+    # ... but the cache gets refreshed.
+    while billrequests.refresh_pending(cachefile):
+        time.sleep(.05)
+    response = billrequests.get(url)
+    assert response.content == b"new news"
+    assert not response.stale
+
+    # Too stale is too stale.
+    billrequests.cache_index().touch(
+        cachefile, old - billrequests.MAX_STALE)
+    FakeNMLegisHandler.pages["/stale"] = (None, b"newer news")
+    assert billrequests.get(url, stale_ok=True).content == b"newer news"
+
+
+def test_negative_cache():
+    url = baseurl + "/no/such/bill"
+    FakeNMLegisHandler.hits.clear()
+    before = billrequests.negative_cache_stats()
+
+    assert billrequests.get(url).status_code == 404
+    assert billrequests.get(url).status_code == 404
+    assert billrequests.head(url).status_code == 404
+    assert FakeNMLegisHandler.hits == [ ("GET", "/no/such/bill", 404) ]
+    stats = billrequests.negative_cache_stats()
+    assert stats["hits"] == before["hits"] + 2
+
+    # After NEGATIVE_CACHESECS, ask again.
+    cachefile = billrequests.url_to_cache_filename(url)
+    billrequests.cache_index().record_failure(
+        cachefile, url, 404,
+        fetched_at=time.time() - billrequests.NEGATIVE_CACHESECS)
+    FakeNMLegisHandler.pages["/no/such/bill"] = (None, b"here now")
+    assert billrequests.get(url).content == b"here now"
+    assert not billrequests.cache_index().lookup_failure(cachefile)
+
+    # A server that won't answer HEAD for a page can still serve it.
+    url = baseurl + "/nohead"
+    FakeNMLegisHandler.pages["/nohead"] = (None, b"got it anyway")
+    FakeNMLegisHandler.errors["/nohead"] = 405
+    try:
+        assert billrequests.head(url).status_code == 405
+        assert billrequests.head(url).status_code == 405
+        del FakeNMLegisHandler.errors["/nohead"]
+        FakeNMLegisHandler.hits.clear()
+        assert billrequests.get(url).content == b"got it anyway"
+        assert FakeNMLegisHandler.hits == [ ("GET", "/nohead", 200) ]
+        # and the good copy clears the HEAD failure.
+        assert not billrequests.cache_index().lookup_failure(
+            billrequests.url_to_cache_filename(url), "HEAD")
+        assert billrequests.head(url).status_code == 200
+    finally:
+        FakeNMLegisHandler.errors.pop("/nohead", None)
+
+
+def test_retry_and_circuit_breaker():
+    saved = (billrequests.RETRY_BACKOFF, billrequests.BREAKER_FAILURES)
+    billrequests.RETRY_BACKOFF = .01
+    FakeNMLegisHandler.pages["/flaky"] = (None, b"flaky page")
+    url = baseurl + "/flaky"
+    breaker = billrequests.circuit_breaker(url)
+    breaker.max_failures = 4
+    try:
+        assert billrequests.get(url).content == b"flaky page"
+
+        # The server starts failing: each get tries FETCH_RETRIES+1 times,
+        # then serves the stale copy.
+        FakeNMLegisHandler.errors["/flaky"] = 503
+        FakeNMLegisHandler.hits.clear()
+        r = billrequests.get(url, cachesecs=0)
+        assert r.status_code == 200 and r.content == b"flaky page"
+        assert r.stale
+        assert len(FakeNMLegisHandler.hits) == billrequests.FETCH_RETRIES + 1
+
+        # That 503 is remembered briefly, with the stale copy served.
+        FakeNMLegisHandler.hits.clear()
+        assert billrequests.get(url, cachesecs=0).content == b"flaky page"
+        assert not FakeNMLegisHandler.hits
+
+        # Enough failures open the breaker (here, partway through
+        # the retries), and then nothing is tried.
+        try:
+            billrequests.net_get(url)
+        except billrequests.CircuitOpenError:
+            pass
+        assert breaker.is_open()
+        FakeNMLegisHandler.hits.clear()
+        t0 = time.time()
+        try:
+            billrequests.net_get(url)
+            assert False, "net_get should have raised CircuitOpenError"
+        except billrequests.CircuitOpenError:
+            pass
+        assert time.time() - t0 < .1
+        assert not FakeNMLegisHandler.hits
+
+        # head() doesn't raise, it says the server is unavailable.
+        r = billrequests.head(baseurl + "/flaky.html")
+        assert r.status_code == 503
+        assert not FakeNMLegisHandler.hits
+
+    finally:
+        del FakeNMLegisHandler.errors["/flaky"]
+        billrequests.RETRY_BACKOFF = saved[0]
+        breaker.max_failures = saved[1]
+        breaker.success()
+
+
+def test_download():
+    FakeNMLegisHandler.pages["/LegInfo.zip"] = (None, b"z" * 1000000)
+    outfile = os.path.join(cachedir, "LegInfo.zip")
+    r = billrequests.download(baseurl + "/LegInfo.zip", outfile)
+    assert r.status_code == 200
+    assert os.path.getsize(outfile) == 1000000
+    assert not [ f for f in os.listdir(cachedir) if f.endswith(".tmp") ]
+
+    # A failed download leaves the old file alone.
+    r = billrequests.download(baseurl + "/nonexistent.zip", outfile)
+    assert r.status_code == 404
+    assert os.path.getsize(outfile) == 1000000
+
+
+def test_sharded_layout():
+    billurl = "https://www.nmlegis.gov/Legislation/Legislation?" \
+        "chamber=H&legtype=B&legno=123&year=25"
+    cachefile = billrequests.url_to_cache_filename(billurl)
+    assert cachefile.startswith(os.path.join(cachedir, "25") + os.sep)
+    assert cachefile.endswith(os.sep + "2025-HB123.html")
+    assert billrequests.cache_shard(
+        "Sessions_20%20Special2_bills_senate") == "20s2"
+    assert billrequests.cache_shard("Committee_Standing_Committee") \
+        == "other"
+
+    # A file from the flat layout is still found where it is ...
+    flatfile = os.path.join(cachedir, "2025-SB7.html")
+    with open(flatfile, "w") as fp:
+        fp.write("flat bill")
+    billdic = { "year": "25", "billno": "SB7" }
+    assert billrequests.url_to_cache_filename("", billdic) == flatfile
+
+    # ... until it's migrated.
+    billrequests.migrate_to_sharded()
+    assert not os.path.exists(flatfile)
+    assert billrequests.url_to_cache_filename("", billdic) \
+        == billrequests.sharded_cache_filename("2025-SB7.html")
+    with open(billrequests.url_to_cache_filename("", billdic)) as fp:
+        assert fp.read() == "flat bill"
+
+
+def test_migrate_gzip_store():
+    from app.bills import cachestore
+
+    # A flat GzipStore cache, with validators in the cache index
+    gzcachedir = os.path.join(cachedir, "gzmigrate")
+    os.mkdir(gzcachedir)
+    saved_cachedir = billrequests.CACHEDIR
+    billrequests.CACHEDIR = gzcachedir
+    store = cachestore.GzipStore(gzcachedir, max_bytes=100000)
+    billrequests.CACHE_STORE = store
+    try:
+        flatfile = os.path.join(gzcachedir, "2025-SB8.html")
+        billrequests.save_to_cache("https://example.com/SB8", flatfile,
+                                   b"gzipped bill", { "ETag": '"sb8"' })
+        assert os.path.exists(flatfile + ".gz")
+        assert store.atimes
+        atime = store.atimes["2025-SB8.html.gz"]
+
+        billrequests.migrate_to_sharded()
+        newfile = billrequests.sharded_cache_filename("2025-SB8.html")
+        assert os.path.exists(newfile + ".gz")
+        assert store.read(newfile) == b"gzipped bill"
+        assert billrequests.read_validators(newfile) == { "ETag": '"sb8"' }
+        assert billrequests.read_validators(flatfile) == {}
+
+        # The store's last-used times moved along too, and were saved.
+        relpath = os.path.relpath(newfile + ".gz", gzcachedir)
+        assert "2025-SB8.html.gz" not in store.atimes
+        with open(os.path.join(gzcachedir, store.INDEXNAME)) as fp:
+            assert json.load(fp)[relpath] >= atime
+    finally:
+        billrequests.CACHE_STORE = None
+        billrequests.CACHEDIR = saved_cachedir
+
+
+def test_record_and_replay():
+    from app.bills import standin
+
+    FakeNMLegisHandler.pages["/recorded?a=1"] = ('"r1"', b"recorded page")
+    cassettedir = os.path.join(cachedir, "cassettes")
+    billrequests.RECORD_DIR = cassettedir
+    try:
+        r = billrequests.net_get(baseurl + "/recorded", params={ "a": 1 })
+    finally:
+        billrequests.RECORD_DIR = None
+    assert r.content == b"recorded page"
+
+    # Now the real server is gone, and the stand-in answers instead,
+    # slowly.
+    del FakeNMLegisHandler.pages["/recorded?a=1"]
+    server = standin.make_server(cassettedir, latency=.2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    billrequests.STANDIN_URL = "http://127.0.0.1:%d" \
+        % server.server_address[1]
+    try:
+        t0 = time.time()
+        r = billrequests.net_get(baseurl + "/recorded?a=1")
+        assert r.content == b"recorded page"
+        assert r.headers["ETag"] == '"r1"'
+        assert time.time() - t0 >= .2
+        assert billrequests.net_get(baseurl + "/unrecorded").status_code \
+            == 404
+
+        server.latency = 0
+        server.error_rate = 1
+        saved_retries = billrequests.FETCH_RETRIES
+        billrequests.FETCH_RETRIES = 0
+        try:
+            assert billrequests.net_get(baseurl + "/recorded?a=1") \
+                .status_code == 503
+        finally:
+            billrequests.FETCH_RETRIES = saved_retries
+            billrequests.circuit_breaker(baseurl).success()
+    finally:
+        billrequests.STANDIN_URL = None
+        server.shutdown()
+
+
+def test_metrics():
+    from app.bills.fetchmetrics import METRICS
+
+    FakeNMLegisHandler.pages["/Sessions/25%20Regular/bills/house/"] = \
+        (None, b"<pre></pre>")
+    url = baseurl + "/Sessions/25%20Regular/bills/house/"
+    labels = { "host": "127.0.0.1", "urlclass": "dirlist" }
+    assert billrequests.url_class(url) == "dirlist"
+    assert billrequests.url_class(
+        "https://www.nmlegis.gov/Legislation/Legislation?"
+        "chamber=H&legtype=B&legno=1&year=25") == "bill"
+
+    fetched = METRICS.counter("billtracker_get_total",
+                              dict(labels, outcome="fetched"))
+    hits = METRICS.counter("billtracker_get_total",
+                           dict(labels, outcome="cache_hit"))
+    billrequests.get(url)
+    billrequests.get(url)
+    assert METRICS.counter("billtracker_get_total",
+                           dict(labels, outcome="fetched")) == fetched + 1
+    assert METRICS.counter("billtracker_get_total",
+                           dict(labels, outcome="cache_hit")) == hits + 1
+
+    text = billrequests.metrics_text()
+    assert "# TYPE billtracker_network_seconds histogram" in text
+    assert 'billtracker_network_bytes_total{host="127.0.0.1",' \
+        'method="GET",urlclass="dirlist"} ' in text
+    assert 'billtracker_soup_cache{stat="hits"}' in text
+
+    # Everything exported has its own HELP and a TYPE.
+    # (test_single_flight has made sure there's a coalesced fetch.)
+    from app.bills.fetchmetrics import HELP
+    assert METRICS.counter("billtracker_coalesced_total", {})
+    for name in list(METRICS.counters) + list(METRICS.histograms):
+        assert name in HELP
+    lines = text.splitlines()
+    helps = { line.split()[2]: line.split(None, 3)[3]
+              for line in lines if line.startswith("# HELP ") }
+    types = { line.split()[2] for line in lines if line.startswith("# TYPE ") }
+    for line in lines:
+        if line.startswith("#"):
+            continue
+        name = line.split("{")[0].split()[0]
+        if name not in types:
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+        assert name in types
+        assert helps[name] != name
+
+
+def old_dirlist_parser(listing):
+    """get_html_dirlist's parser before DirEntry, for comparison."""
+    import re
+    hrefpat = re.compile('href="([^"]*)">([^<]+)<', flags=re.IGNORECASE)
+    pre = listing.find("<pre>")
+    if pre > 0:
+        listing = listing[pre+5:]
+    pre = listing.find("</pre>")
+    if pre > 0:
+        listing = listing[:pre]
+    ls = []
+    for line in listing.split("<br>"):
+        words = line.split()
+        if len(words) != 6:
+            continue
+        try:
+            dic = { "size": int(words[3]) }
+            month, day, year = [int(n) for n in words[0].split("/")]
+            hour, minute = [int(n) for n in words[1].split(":")]
+            dic["Last Modified"] = "%s\t%s %s MST" % tuple(words[0:3])
+            match = hrefpat.match(words[5])
+            dic["url"] = "https://www.nmlegis.gov/" + match.group(1).lstrip('/')
+            dic["name"] = match.group(2)
+        except Exception:
+            continue
+        ls.append(dic)
+    return ls
+
+
+def test_dirlist_parser():
+    listfile = os.path.join(os.path.dirname(__file__), "cache",
+                            "Sessions_19%20Regular_bills_house")
+    with open(listfile) as fp:
+        listing = fp.read()
+
+    entries = list(billrequests.parse_html_dirlist(listing))
+    expected = old_dirlist_parser(listing)
+    assert len(entries) == len(expected) > 1000
+    for entry, dic in zip(entries, expected):
+        for key in dic:
+            assert entry[key] == dic[key]
+    assert entries[0]["name"] == "HB0001.HTML"
+    assert entries[0]["url"] == \
+        "https://www.nmlegis.gov/Sessions/19%20Regular/bills/house/HB0001.HTML"
+
+    # Micro-benchmark
+    reps = 20
+    t0 = time.perf_counter()
+    for i in range(reps):
+        old_dirlist_parser(listing)
+    oldtime = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i in range(reps):
+        list(billrequests.parse_html_dirlist(listing))
+    newtime = time.perf_counter() - t0
+    print("\nDirlist parse, %d entries: old %.2f ms, new %.2f ms"
+          % (len(entries), oldtime * 1000 / reps, newtime * 1000 / reps))
+    assert newtime < oldtime
+
+
+def test_get_html_dirlists():
+    listfile = os.path.join(os.path.dirname(__file__), "cache",
+                            "Sessions_19%20Regular_bills_senate")
+    with open(listfile, "rb") as fp:
+        listing = fp.read()
+    urls = []
+    for i in range(3):
+        path = "/dirlists/%d" % i
+        FakeNMLegisHandler.pages[path] = (None, listing)
+        FakeNMLegisHandler.delays[path] = .5
+        urls.append(baseurl + path)
+
+    start = time.monotonic()
+    results = { url: (dirlist, secs) for url, dirlist, secs
+                in billrequests.get_html_dirlists(urls, max_workers=3) }
+    # They were fetched at the same time, not one after another.
+    assert time.monotonic() - start < 1.2
+    assert set(results) == set(urls)
+    for url in urls:
+        dirlist, secs = results[url]
+        assert secs >= .5
+        assert [ l['name'] for l in dirlist ] == \
+            [ l['name'] for l in billrequests.get_html_dirlist(url) ]
+        assert dirlist[0]['name'] == 'SB0001.HTML'
+
+    # A listing revalidated with a 304 isn't parsed again,
+    # even though its cache entry now has a new time.
+    path = "/dirlists/etag"
+    FakeNMLegisHandler.pages[path] = ('"list1"', listing)
+    url = baseurl + path
+    first = billrequests.get_html_dirlist(url)
+    cachefile = billrequests.url_to_cache_filename(url)
+    billrequests.cache_index().touch(
+        cachefile, time.time() - 3 * billrequests.CACHESECS)
+    FakeNMLegisHandler.hits.clear()
+    assert billrequests.get_html_dirlist(url) is first
+    assert FakeNMLegisHandler.hits == [ ("GET", path, 304) ]
+
+    # A changed listing is.
+    FakeNMLegisHandler.pages[path] = ('"list2"', listing.replace(
+        b"SB0001.HTML", b"SB0001.html"))
+    billrequests.cache_index().touch(
+        cachefile, time.time() - 3 * billrequests.CACHESECS)
+    assert billrequests.get_html_dirlist(url)[0]['name'] == 'SB0001.html'
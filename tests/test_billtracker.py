@@ -19,6 +19,8 @@ from app import routes, models, api, mailapi
 
 from config import Config, basedir
 
+import re
+
 KEY = 'TESTING_NOT_SO_SECRET_KEY'
 app.config['SQLALCHEMY_DATABASE_URI'] = setup_flask.DATABASE_URL
 app.config['TESTING'] = True
@@ -144,6 +146,20 @@ def test_billtracker():
             response = test_client.get("/api/bills_by_update_date?yearcode=19")
             assert response.get_data(as_text=True) == 'HB73'
 
+            # Refresh bills that changed. The cached Legislation_List
+            # is from later than HB73's page and shows more actions,
+            # so HB73 counts as changed.
+            response = test_client.post("/api/refresh_percent_of_bills",
+                                        data={ 'YEARCODE': '19',
+                                               'KEY': KEY })
+            # It's listed with its refresh score, which is mostly
+            # the bonus for having changed.
+            assert re.fullmatch(
+                r'OK Refreshed changed bills and 0% of the rest:\n'
+                r'  19: Updated HB73 \(100\d\.\d\)\n'
+                r'Budget: \d+ of \d+ bill fetches used this hour',
+                response.get_data(as_text=True))
+
             # Test whether the bill just added is in the database
             bill = Bill.query.filter_by(billno="HB73").first()
             assert bill.billno == "HB73"
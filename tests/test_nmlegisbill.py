@@ -16,10 +16,14 @@ import unittest
 import sys, os
 
 from app.bills import nmlegisbill, billutils, billrequests, decodenmlegis
+from app.bills import refreshsched
+from app.bills import allbillsstore
+from app.bills.allbillsstore import AllBillsStore
 
 import json
 
 import datetime
+import threading
 
 
 billrequests.LOCAL_MODE = True
@@ -34,7 +38,10 @@ def test_parse_bills():
     billrequests.LOCAL_MODE = True
     billrequests.CACHEDIR = 'tests/cache'
 
+    billrequests.clear_soup_cache()
     bill = nmlegisbill.parse_bill_page('HB73', yearcode='19')
+    # Bill pages are parsed once, so their soups aren't kept.
+    assert billrequests.soup_cache_stats()["entries"] == 0
     # mod date keeps changing. Don't try to test it.
     bill['mod_date'] = None
     bill['update_date'] = None
@@ -109,6 +116,490 @@ SPREF [1] SCORC/SFC-SCORC [3] DP-SFC [5] DP  [7] PASSED/S (29-6) [5] HTRC-HTRC [
     }
 
 
+def test_update_bill_links():
+    billrequests.LOCAL_MODE = True
+    billrequests.CACHEDIR = 'tests/cache'
+
+    with open('tests/cache/allbills_19.json') as fp:
+        allbills = json.load(fp)
+    del allbills['HB1']['contents']
+    saved = nmlegisbill.g_allbills.get('19')
+    nmlegisbill.g_allbills['19'] = allbills
+    dirlistsfile = nmlegisbill.dirlists_cachefile('19')
+    try:
+        houseurl = 'https://www.nmlegis.gov/Sessions/19%20Regular/bills/house'
+
+        # The first time, everything is new.
+        changes = nmlegisbill.update_bill_links('19')
+        assert 'HB0001.HTML' in changes[houseurl]['added']
+        assert allbills['HB1']['contents'] == houseurl + '/HB0001.HTML'
+        dirlists = nmlegisbill.g_dirlists['19']
+        assert dirlists[houseurl]['HB0001.HTML'] == \
+            [ 26816, '1/15/2019\t3:58 PM MST' ]
+        # The listings are saved on their own, not with the bills.
+        assert '_dirlists' not in allbills
+        nmlegisbill.save_dirlists('19')
+        with open(dirlistsfile) as fp:
+            assert json.load(fp) == dirlists
+
+        # Nothing changed, so nothing to do.
+        del allbills['HB1']['contents']
+        assert nmlegisbill.update_bill_links('19') == {}
+        assert 'contents' not in allbills['HB1']
+
+        # A file that changed is looked at again.
+        dirlists[houseurl]['HB0001.HTML'][0] = 1
+        nmlegisbill.g_dirlists['19'] = dirlists
+        nmlegisbill.save_dirlists('19')
+        changes = nmlegisbill.update_bill_links('19')
+        assert changes == { houseurl: { 'added': [],
+                                        'modified': ['HB0001.HTML'],
+                                        'removed': [] } }
+        assert allbills['HB1']['contents'] == houseurl + '/HB0001.HTML'
+        nmlegisbill.save_dirlists('19')
+
+        # So is one that disappeared and came back.
+        dirlists = nmlegisbill.g_dirlists['19']
+        dirlists[houseurl]['NOSUCHFILE.PDF'] = \
+            dirlists[houseurl].pop('HB0001.HTML')
+        nmlegisbill.save_dirlists('19')
+        changes = nmlegisbill.update_bill_links('19')
+        assert changes[houseurl]['added'] == ['HB0001.HTML']
+        assert changes[houseurl]['removed'] == ['NOSUCHFILE.PDF']
+        nmlegisbill.save_dirlists('19')
+
+    finally:
+        if saved is None:
+            del nmlegisbill.g_allbills['19']
+        else:
+            nmlegisbill.g_allbills['19'] = saved
+        nmlegisbill.g_dirlists.pop('19', None)
+        if os.path.exists(dirlistsfile):
+            os.unlink(dirlistsfile)
+
+
+def test_update_bill_links_several_files(monkeypatch):
+    """When one of several files for a bill changes, the bill's link
+       is worked out from all of them, as it was the first time.
+    """
+    billrequests.LOCAL_MODE = True
+    billrequests.CACHEDIR = 'tests/cache'
+
+    baseurl = 'https://www.nmlegis.gov/Sessions/19%20Regular'
+    fldurl = baseurl + '/Floor_Amendments'
+    floorlist = [
+        { 'name': 'HB0001FA1.pdf', 'url': fldurl + '/HB0001FA1.pdf',
+          'size': 100, 'Last Modified': '2/1/2019\t3:58 PM MST' },
+        { 'name': 'HB0001FA2.pdf', 'url': fldurl + '/HB0001FA2.pdf',
+          'size': 200, 'Last Modified': '2/8/2019\t3:58 PM MST' },
+    ]
+
+    def fake_dirlists(urls):
+        for url in urls:
+            yield url, floorlist if url == fldurl else [], 0
+    monkeypatch.setattr(billrequests, 'get_html_dirlists', fake_dirlists)
+
+    saved = nmlegisbill.g_allbills.get('19')
+    nmlegisbill.g_allbills['19'] = { 'HB1': { 'history': [] } }
+    dirlistsfile = nmlegisbill.dirlists_cachefile('19')
+    try:
+        changes = nmlegisbill.update_bill_links('19')
+        assert changes[fldurl]['added'] == ['HB0001FA1.pdf', 'HB0001FA2.pdf']
+        assert nmlegisbill.g_allbills['19']['HB1']['Floor_Amendments'] \
+            == fldurl + '/HB0001FA2.pdf'
+        nmlegisbill.save_dirlists('19')
+
+        # The older file is touched again: the newer link stays.
+        floorlist[0]['Last Modified'] = '2/9/2019\t3:58 PM MST'
+        changes = nmlegisbill.update_bill_links('19')
+        assert changes[fldurl]['modified'] == ['HB0001FA1.pdf']
+        assert nmlegisbill.g_allbills['19']['HB1']['Floor_Amendments'] \
+            == fldurl + '/HB0001FA2.pdf'
+    finally:
+        if saved is None:
+            del nmlegisbill.g_allbills['19']
+        else:
+            nmlegisbill.g_allbills['19'] = saved
+        nmlegisbill.g_dirlists.pop('19', None)
+        if os.path.exists(dirlistsfile):
+            os.unlink(dirlistsfile)
+
+
+def test_allbills_parsers():
+    from bs4 import BeautifulSoup
+    import time
+
+    for filename in ('tests/cache/Legislation_List_Session=57',
+                     'tests/cache/Legislation_List_Session=57.titlechange'):
+        with open(filename) as fp:
+            html = fp.read()
+
+        start = time.perf_counter()
+        soup_rows = nmlegisbill.allbills_rows_soup(
+            BeautifulSoup(html, 'lxml'))
+        souptime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        lxml_rows = nmlegisbill.allbills_rows_lxml(html)
+        lxmltime = time.perf_counter() - start
+
+        assert len(lxml_rows) == 1663
+        assert lxml_rows == soup_rows
+        print("\n%s: %d rows, BeautifulSoup %.0f rows/sec, lxml %.0f rows/sec"
+              % (os.path.basename(filename), len(lxml_rows),
+                 len(soup_rows) / souptime, len(lxml_rows) / lxmltime))
+
+    assert lxml_rows[72] == {
+        'billno': 'HB73',
+        'href': 'Legislation?chamber=H&legType=B&legNo=73&year=19',
+        'title': 'THIS IS A NEW TITLE FOR THIS BILL',
+        'sponsor_hrefs': [ '../Members/Legislator?SponCode=HGONZ' ],
+        'actions': 'HPREF [2] HSEIC/HJC-HSEIC [3] DP/a-HJC [6] DP  [7] '
+                   'PASSED/H (35-32) [12] SPAC/SJC-SPAC API.'
+    }
+    assert nmlegisbill.allbills_rows_lxml('<html><p>Down for maintenance') \
+        is None
+
+
+def test_allbills_row_hashes():
+    with open('tests/cache/Legislation_List_Session=57') as fp:
+        rows = nmlegisbill.allbills_rows_lxml(fp.read())
+    with open('tests/cache/Legislation_List_Session=57.titlechange') as fp:
+        newrows = nmlegisbill.allbills_rows_lxml(fp.read())
+
+    saved = nmlegisbill.g_allbills.get('19')
+    nmlegisbill.g_allbills['19'] = {}
+    try:
+        allbills = nmlegisbill.g_allbills['19']
+
+        # Everything is new the first time, and nothing the second.
+        changed = nmlegisbill.apply_allbills_rows('19', rows)
+        assert len(changed) == len(rows) == 1663
+        assert len(allbills['_rowhashes']) == 1663
+        assert nmlegisbill.apply_allbills_rows('19', rows) == []
+
+        # Only the bills whose rows changed are touched.
+        hb73 = allbills['HB73']
+        hb1 = allbills['HB1']
+        hb1['title'] = 'NOT CHANGED BY apply_allbills_rows'
+        changed = nmlegisbill.apply_allbills_rows('19', newrows)
+        assert changed == [ old['billno'] for old, new in zip(rows, newrows)
+                            if old != new ]
+        assert 'HB73' in changed
+        assert hb73['title'] == 'THIS IS A NEW TITLE FOR THIS BILL'
+        assert hb73['history'][-1][1:] == [ 'titlechanged',
+                                            'THIS IS A NEW TITLE FOR THIS BILL' ]
+        assert hb1['title'] == 'NOT CHANGED BY apply_allbills_rows'
+    finally:
+        if saved is None:
+            del nmlegisbill.g_allbills['19']
+        else:
+            nmlegisbill.g_allbills['19'] = saved
+
+
+def test_parse_memo():
+    import shutil, tempfile, time
+
+    cachedir = tempfile.mkdtemp()
+    saved_version = nmlegisbill.BILL_PARSER_VERSION
+    billrequests.LOCAL_MODE = False
+    billrequests.CACHEDIR = cachedir
+    try:
+        # A fresh copy of the cached page, so nothing is fetched.
+        url = nmlegisbill.bill_url('HB73', '19')
+        cachefile = billrequests.url_to_cache_filename(
+            url, { 'billno': 'HB73', 'year': '19' })
+        os.makedirs(os.path.dirname(cachefile))
+        shutil.copy('tests/cache/2019-HB73.html', cachefile)
+
+        start = time.perf_counter()
+        bill = nmlegisbill.parse_bill_page('HB73', '19')
+        parsetime = time.perf_counter() - start
+        assert bill['title'] == 'EXEMPT NM FROM DAYLIGHT SAVINGS TIME'
+
+        memo = nmlegisbill.parse_memo()
+        assert memo.dbfile == os.path.join(cachedir, 'parsememo.sqlite')
+
+        # The page hasn't changed, so the last parse is reused.
+        start = time.perf_counter()
+        again = nmlegisbill.parse_bill_page('HB73', '19')
+        memotime = time.perf_counter() - start
+        assert again['update_date'] >= bill['update_date']
+        bill['update_date'] = again['update_date']
+        assert again == bill
+        print("\nParsing HB73: %.1f ms, from the memo: %.1f ms"
+              % (parsetime * 1000, memotime * 1000))
+
+        # Prove it wasn't parsed again, by changing what was remembered.
+        bodyhash = nmlegisbill.body_hash(
+            billrequests.cache_store().read(cachefile),
+            nmlegisbill.BILL_PARSER_VERSION)
+        del again['update_date']
+        again['title'] = 'FROM THE MEMO'
+        memo.record('HB73', '19', bodyhash, again)
+        assert nmlegisbill.parse_bill_page('HB73', '19')['title'] \
+            == 'FROM THE MEMO'
+
+        # The HTML version of a committee sub can show up while the
+        # bill page stays the same, so it's looked for on every reuse.
+        csurl = 'https://www.nmlegis.gov/Sessions/19%20Regular/bills/house/HB0073CS'
+        again['amendlink'] = csurl + '.pdf'
+        again['_unchecked'] = [ csurl + '.html' ]
+        memo.record('HB73', '19', bodyhash, again)
+        csfile = billrequests.url_to_cache_filename(csurl + '.html')
+        os.makedirs(os.path.dirname(csfile), exist_ok=True)
+        with open(csfile, 'w') as fp:
+            fp.write('<html>committee sub</html>')
+        assert nmlegisbill.parse_bill_page('HB73', '19')['amendlink'] \
+            == csurl + '.html'
+        assert memo.lookup('HB73', '19', bodyhash)['amendlink'] \
+            == csurl + '.pdf'
+
+        # A new parser version doesn't use old parses.
+        nmlegisbill.BILL_PARSER_VERSION += 1
+        assert nmlegisbill.parse_bill_page('HB73', '19')['title'] \
+            == 'EXEMPT NM FROM DAYLIGHT SAVINGS TIME'
+    finally:
+        nmlegisbill.BILL_PARSER_VERSION = saved_version
+        billrequests.LOCAL_MODE = True
+        billrequests.CACHEDIR = 'tests/cache'
+        shutil.rmtree(cachedir)
+
+
+def test_allbills_store():
+    import shutil, tempfile
+
+    cachedir = tempfile.mkdtemp()
+    billrequests.LOCAL_MODE = False
+    billrequests.CACHEDIR = cachedir
+    saved_cachefile = nmlegisbill.g_allbills_cachefile.pop('19', None)
+    saved = nmlegisbill.g_allbills.pop('19', None)
+    try:
+        # A fresh allbills file, so nothing is fetched.
+        with open('tests/cache/allbills_19.json') as fp:
+            allbills = json.load(fp)
+        shutil.copy('tests/cache/allbills_19.json',
+                    os.path.join(cachedir, 'allbills_19.json'))
+
+        # The first reader fills the store from the file,
+        # and nothing is kept in g_allbills.
+        view = nmlegisbill.all_bills(57, '19')
+        assert view.generation == 1
+        assert '19' not in nmlegisbill.g_allbills
+        assert len(view) == len(allbills)
+        assert 'HB73' in view and 'HB99999' not in view
+        assert view['HB73'] == allbills['HB73']
+        assert dict(view.items()) == allbills
+        assert nmlegisbill.bill_info('HB73', '19', 57) == allbills['HB73']
+
+        # Another process publishes a new list: readers see it next time.
+        store = AllBillsStore(os.path.join(cachedir, 'allbills.sqlite'))
+        allbills['HB73']['title'] = 'NEW TITLE'
+        assert store.replace('19', allbills) == 2
+        assert nmlegisbill.bill_info('HB73', '19', 57)['title'] \
+            == 'NEW TITLE'
+        assert view.generation == 2
+
+        # The cache file was saved but never published: it's newer
+        # than the store, so it's published on the next read.
+        allbills['HB73']['title'] = 'SAVED BUT NOT PUBLISHED'
+        jsonfile = os.path.join(cachedir, 'allbills_19.json')
+        with open(jsonfile, 'w') as fp:
+            json.dump(allbills, fp)
+        later = view.replaced_at + 1
+        os.utime(jsonfile, (later, later))
+        assert nmlegisbill.bill_info('HB73', '19', 57)['title'] \
+            == 'SAVED BUT NOT PUBLISHED'
+        assert view.generation == 3
+
+        # items() always reads one whole generation, and the view
+        # moves to it, so it agrees with lookups made afterward.
+        view['HB73']
+        newbills = { 'HB73': dict(allbills['HB73'], title='ITEMS TITLE'),
+                     'HB1000': allbills['HB73'] }
+        assert store.replace('19', newbills) == 4
+        assert dict(view.items()) == newbills
+        assert view.generation == 4
+        assert view['HB73']['title'] == 'ITEMS TITLE'
+        assert set(view) == set(newbills)
+        assert store.replace('19', allbills) == 5
+        assert view.values() == list(allbills.values())
+        assert view.generation == 5
+
+        # Only the most recently used bills are kept decoded.
+        for billno in view:
+            view[billno]
+        assert len(view._snapshot.cache) == \
+            min(len(view), allbillsstore.MAX_CACHED_BILLS)
+
+        # Readers in other threads don't trip over refreshes.
+        errors = []
+        def read():
+            try:
+                for i in range(200):
+                    assert 'HB73' in view and 'HB99999' not in view
+                    assert view['HB73']['title']
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target=read) for i in range(4) ]
+        for t in threads:
+            t.start()
+        for i in range(20):
+            store.replace('19', allbills)
+            view.refresh()
+        for t in threads:
+            t.join()
+        assert not errors
+    finally:
+        billrequests.LOCAL_MODE = True
+        billrequests.CACHEDIR = 'tests/cache'
+        nmlegisbill.g_allbills_cachefile.pop('19', None)
+        if saved_cachefile:
+            nmlegisbill.g_allbills_cachefile['19'] = saved_cachefile
+        if saved:
+            nmlegisbill.g_allbills['19'] = saved
+        shutil.rmtree(cachedir)
+
+
+def test_parse_bill_pages():
+    billrequests.LOCAL_MODE = True
+    billrequests.CACHEDIR = 'tests/cache'
+
+    billnos = [ 'SB11', 'HB999', 'HB73' ]
+    expected = [ nmlegisbill.parse_bill_page(billno, '19')
+                 for billno in billnos ]
+    assert expected[1] is None
+
+    def check(parsed):
+        assert len(parsed) == len(billnos)
+        for b, e in zip(parsed, expected):
+            if e is None:
+                assert b is None
+                continue
+            b['update_date'] = e['update_date']
+            assert b == e
+
+    saved_pool_min = nmlegisbill.PARSE_POOL_MIN
+    saved_workers = nmlegisbill.PARSE_WORKERS
+    saved_times = dict(nmlegisbill._parse_secs_per_page)
+    nmlegisbill.PARSE_WORKERS = 2
+    try:
+        # In worker processes: the first time starts the pool,
+        # the second is timed.
+        nmlegisbill.PARSE_POOL_MIN = 1
+        check(nmlegisbill.parse_bill_pages(billnos, '19'))
+        assert nmlegisbill._parse_pool
+        assert nmlegisbill._parse_secs_per_page["pool"] is None
+        check(nmlegisbill.parse_bill_pages(billnos, '19'))
+        assert nmlegisbill._parse_secs_per_page["pool"] > 0
+
+        # Too few pages for the pool: parsed in this process.
+        nmlegisbill.PARSE_POOL_MIN = len(billnos) + 1
+        check(nmlegisbill.parse_bill_pages(billnos, '19'))
+        assert nmlegisbill._parse_secs_per_page["serial"] > 0
+
+        # The pool isn't used when it's been slower.
+        nmlegisbill.PARSE_POOL_MIN = 1
+        nmlegisbill._parse_secs_per_page["pool"] = 1000.
+        check(nmlegisbill.parse_bill_pages(billnos, '19'))
+        assert nmlegisbill._parse_secs_per_page["pool"] == 1000.
+    finally:
+        nmlegisbill.PARSE_POOL_MIN = saved_pool_min
+        nmlegisbill.PARSE_WORKERS = saved_workers
+        nmlegisbill._parse_secs_per_page.update(saved_times)
+        if nmlegisbill._parse_pool:
+            nmlegisbill._parse_pool.shutdown()
+        nmlegisbill._parse_pool = None
+
+
+def test_refresh_reason():
+    billrequests.LOCAL_MODE = True
+    billrequests.CACHEDIR = 'tests/cache'
+
+    bill = nmlegisbill.parse_bill_page('HB73', '19')
+    # What Bill.get_actioncode() would give
+    actioncode = bill['statustext'].split('\n')[-1]
+
+    # Legislation_List spaces the codes differently
+    billinfo = { 'title': bill['title'],
+                 'actions': '  '.join(actioncode.split()) }
+    assert nmlegisbill.refresh_reason(billinfo, bill['title'],
+                                      actioncode) is None
+    assert nmlegisbill.refresh_reason(billinfo, 'OLD TITLE',
+                                      actioncode) == 'title'
+    assert nmlegisbill.refresh_reason(billinfo, bill['title'],
+                                      '') == 'new'
+    assert nmlegisbill.refresh_reason(None, bill['title'],
+                                      actioncode) == 'unlisted'
+
+    # The Legislation_List fixture is from later than the bill page,
+    # after more actions.
+    with open('tests/cache/Legislation_List_Session=57') as fp:
+        row = [ row for row in nmlegisbill.allbills_rows_lxml(fp.read())
+                if row['billno'] == 'HB73' ][0]
+    billinfo = { 'title': row['title'], 'actions': row['actions'] }
+    assert nmlegisbill.refresh_reason(billinfo, bill['title'],
+                                      actioncode) == 'actions'
+
+
+def test_refresh_scheduler(tmp_path):
+    now = datetime.datetime(2019, 2, 15, 12, 0)
+    hoursago = lambda h: now - datetime.timedelta(hours=h)
+    score = lambda **kw: refreshsched.refresh_score(now=now, **kw)
+
+    # Just refreshed: not worth fetching, unless it changed.
+    assert score(update_date=hoursago(.1)) == 0
+    assert score(update_date=hoursago(.1), changed=True) > \
+        score(update_date=hoursago(24), num_tracking=1)
+
+    # A hot bill refreshed an hour ago beats a dead one from yesterday,
+    # but the dead one still gets a turn eventually.
+    hot = score(update_date=hoursago(1), num_tracking=3, scheduled=True,
+                location='House', last_action_date=hoursago(20))
+    dead = score(update_date=hoursago(24), location='Signed')
+    assert hot > dead > 0
+    assert score(update_date=hoursago(1000), location='Signed') > hot
+
+    # Reading the budget doesn't create its file.
+    budgetfile = str(tmp_path / "refreshbudget.json")
+    budget = refreshsched.RefreshBudget(budgetfile, 10)
+    assert budget.remaining() == 10
+    assert not os.path.exists(budgetfile)
+
+    budget.spend(4)
+    budget.spend(4)
+    assert budget.spent() == 8
+    assert refreshsched.RefreshBudget(budgetfile, 10).remaining() == 2
+    budget.spend(4)
+    assert budget.remaining() == 0
+    assert budget.reserve(3) == 0
+    assert budget.spent() == 12
+
+    # Reserving never hands out more than is left, even to
+    # several at once.
+    budgetfile = str(tmp_path / "reserved.json")
+    granted = []
+
+    def reserve():
+        granted.append(refreshsched.RefreshBudget(budgetfile, 10).reserve(3))
+    threads = [ threading.Thread(target=reserve) for i in range(8) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(granted) == 10
+    assert sorted(granted) == [0, 0, 0, 0, 1, 3, 3, 3]
+    assert refreshsched.RefreshBudget(budgetfile, 10).remaining() == 0
+
+    # LOCAL_MODE keeps the count in memory.
+    billrequests.LOCAL_MODE = True
+    budget = refreshsched.budget()
+    assert budget.budgetfile is None
+    budget.spend(3)
+    assert budget.spent() == 3
+    assert budget.reserve(budget.per_hour) == budget.per_hour - 3
+
+
 # Set this to True to re-generate the comparison files
 GENERATE = False
 